@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+对比按字符分块（CHUNK_SIZE）与按 token 分块（CHUNK_TOKENS）的装填效率
+
+    python benchmarks/chunk_packing.py --text samples/sample.txt --api-type deepseek
+
+对每种分块方式输出分块数、每块 token 数的平均/最小/最大值、装填率
+（总 token 数 / (分块数 × token 预算)，越接近 100% 请求数越少）、
+按 CHUNK_OUTPUT_RATIO 估算输出会超出 MODEL_MAX_TOKENS 的分块数，以及分块耗时。
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT_DIR))
+
+import config
+from src.tokenizer import chunk_token_budget, get_tokenizer
+from src.utils import split_text_into_chunks
+
+DEFAULT_TEXT = ROOT_DIR / 'benchmarks' / 'samples' / 'sample.txt'
+
+
+def measure(label, chunker, tokenizer, budget):
+    start = time.time()
+    chunks = chunker()
+    elapsed = time.time() - start
+    sizes = [tokenizer.count(chunk) for chunk in chunks]
+    limit = config.MODEL_MAX_TOKENS / config.CHUNK_OUTPUT_RATIO
+    return {
+        'label': label,
+        'chunks': len(chunks),
+        'avg': sum(sizes) / len(sizes) if sizes else 0,
+        'min': min(sizes) if sizes else 0,
+        'max': max(sizes) if sizes else 0,
+        'fill': sum(sizes) / (len(sizes) * budget) if sizes else 0,
+        'overflow': sum(1 for n in sizes if n > limit),
+        'time': elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='字符分块与 token 分块的装填效率对比')
+    parser.add_argument('--text', default=str(DEFAULT_TEXT), help='测试文本（转写结果）')
+    parser.add_argument('--api-type', default=config.API_TYPE, help='按哪个服务商的分词器计数')
+    parser.add_argument('--chunk-size', type=int, default=config.CHUNK_SIZE, help='字符分块上限')
+    parser.add_argument('--chunk-tokens', type=int, default=None, help='token 分块上限（默认按配置计算）')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.text):
+        print(f'缺少测试文本: {args.text}')
+        print('请放入一段转写文本，或通过 --text 指定')
+        return 1
+
+    with open(args.text, 'r', encoding='utf-8') as f:
+        text = f.read()
+    tokenizer = get_tokenizer(args.api_type)
+    budget = args.chunk_tokens or chunk_token_budget()
+    print(f'文本长度: {len(text)} 字符 / {tokenizer.count(text)} tokens（{tokenizer.name}），'
+          f'token 预算: {budget}，字符上限: {args.chunk_size}')
+
+    results = [
+        measure(f'chars:{args.chunk_size}',
+                lambda: split_text_into_chunks(text, args.chunk_size), tokenizer, budget),
+        measure(f'tokens:{budget}',
+                lambda: split_text_into_chunks(text, budget, tokenizer.count), tokenizer, budget),
+    ]
+
+    print(f"{'方式':<16}{'分块数':>8}{'平均':>8}{'最小':>8}{'最大':>8}{'装填率':>10}{'溢出':>6}{'耗时(s)':>10}")
+    for r in results:
+        print(f"{r['label']:<16}{r['chunks']:>8}{r['avg']:>8.0f}{r['min']:>8}{r['max']:>8}"
+              f"{r['fill']:>10.1%}{r['overflow']:>6}{r['time']:>10.3f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
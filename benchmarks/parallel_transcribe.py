@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+对比串行转写与并行转写（TRANS_PARALLEL_WORKERS）的实际耗时
+
+    python benchmarks/parallel_transcribe.py --audio lecture.m4a --workers 4
+
+串行：在当前进程中加载模型，对整段音频调用一次 run_model；
+并行：按静音切分后交给 worker 进程池（与 transcribe_audio 走同一条路径）。
+两者都不计模型加载时间，并行的第一轮包含 worker 进程加载模型，因此默认跑两轮取最快一次。
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT_DIR))
+
+import config
+from src.transcription import resolve_model_settings, get_model_loader, run_model, transcribe_parallel
+from src.video_processor import decode_audio_pcm
+
+
+def bench_serial(settings, audio, prompt):
+    _, loader = get_model_loader(settings)
+    load_start = time.time()
+    model = loader()
+    load_time = time.time() - load_start
+    start = time.time()
+    result = run_model(settings, model, audio, prompt)
+    return load_time, time.time() - start, result['text']
+
+
+def bench_parallel(settings, audio_path, prompt, workers, runs):
+    best = None
+    text = ''
+    for i in range(runs):
+        result = transcribe_parallel(audio_path, prompt, settings, workers)
+        elapsed = result['wall_time']
+        print(f'并行第 {i + 1} 轮: {elapsed:.2f} 秒')
+        best = elapsed if best is None else min(best, elapsed)
+        text = result['text']
+    return best, text
+
+
+def main():
+    parser = argparse.ArgumentParser(description='串行与并行转写耗时对比')
+    parser.add_argument('--audio', required=True, help='测试音频，建议 10 分钟以上')
+    parser.add_argument('--workers', type=int, default=config.TRANS_PARALLEL_WORKERS or os.cpu_count() // 2 or 2,
+                        help='worker 进程数（默认：TRANS_PARALLEL_WORKERS）')
+    parser.add_argument('--model-type', default=None, help='模型类型（默认：TRANS_MODEL_TYPE）')
+    parser.add_argument('--model-size', default=None, help='模型规格（默认：TRANS_MODEL_SIZE）')
+    parser.add_argument('--prompt', default='', help='initial_prompt')
+    parser.add_argument('--runs', type=int, default=2, help='并行重复次数，取最快一次')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.audio):
+        print(f'测试音频不存在: {args.audio}')
+        return 1
+    if args.workers <= 1:
+        print('--workers 需大于 1')
+        return 1
+
+    settings = resolve_model_settings(args.model_type, args.model_size, 'cpu')
+    prompt = args.prompt or None
+    audio = decode_audio_pcm(args.audio)
+    duration = len(audio) / 16000
+    print(f"音频时长: {duration:.1f} 秒，模型: {settings['model_type']}-{settings['model_size']}，"
+          f"CPU 核数: {os.cpu_count()}，worker: {args.workers}")
+
+    load_time, serial_time, serial_text = bench_serial(settings, audio, prompt)
+    print(f'串行: 模型加载 {load_time:.2f} 秒，转写 {serial_time:.2f} 秒')
+    parallel_time, parallel_text = bench_parallel(settings, args.audio, prompt, args.workers, args.runs)
+
+    print(f"{'模式':<6}{'转写(s)':>10}{'RTF':>8}{'字数':>8}")
+    print(f"{'串行':<6}{serial_time:>10.2f}{serial_time / duration:>8.3f}{len(serial_text):>8}")
+    print(f"{'并行':<6}{parallel_time:>10.2f}{parallel_time / duration:>8.3f}{len(parallel_text):>8}")
+    print(f'并行相对串行：加速 {serial_time / parallel_time:.2f}x')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
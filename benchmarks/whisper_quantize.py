@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+对比 openai-whisper 在 fp32 与动态 int8 量化（TRANS_QUANTIZE=dynamic）下的速度与准确率
+
+    python benchmarks/whisper_quantize.py --audio samples/sample.wav --reference samples/sample.txt
+
+输出每种模式的模型加载耗时、转写耗时、实时率（RTF = 转写耗时 / 音频时长，越小越快）
+以及相对参考文本的错误率：英文按词计算 WER，中文按字计算 CER。
+"""
+import argparse
+import os
+import re
+import sys
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT_DIR))
+
+import config
+from src.transcription import resolve_model_settings, get_model_loader, run_model
+from src.video_processor import decode_audio_pcm
+
+DEFAULT_AUDIO = ROOT_DIR / 'benchmarks' / 'samples' / 'sample.wav'
+DEFAULT_REFERENCE = ROOT_DIR / 'benchmarks' / 'samples' / 'sample.txt'
+
+CJK_RE = re.compile(r'[一-鿿]')
+PUNCT_RE = re.compile(r'[^\w\s]|_')
+
+
+def tokenize(text):
+    text = PUNCT_RE.sub(' ', text.lower())
+    if CJK_RE.search(text):
+        return [c for c in text if not c.isspace()]
+    return text.split()
+
+
+def error_rate(reference, hypothesis):
+    ref = tokenize(reference)
+    hyp = tokenize(hypothesis)
+    if not ref:
+        return 0.0 if not hyp else 1.0
+    prev = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        cur = [i] + [0] * len(hyp)
+        for j, h in enumerate(hyp, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (r != h))
+        prev = cur
+    return prev[-1] / len(ref)
+
+
+def bench(mode, audio, duration, model_size, prompt, runs):
+    config.TRANS_QUANTIZE = 'dynamic' if mode == 'int8' else ''
+    settings = resolve_model_settings('whisper', model_size, 'cpu')
+    _, loader = get_model_loader(settings)
+
+    load_start = time.time()
+    model = loader()
+    load_time = time.time() - load_start
+
+    best = None
+    text = ''
+    for _ in range(runs):
+        start = time.time()
+        result = run_model(settings, model, audio, prompt)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+        text = result['text']
+    return {'mode': mode, 'load': load_time, 'time': best, 'rtf': best / duration, 'text': text}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='whisper fp32 与动态 int8 量化对比')
+    parser.add_argument('--audio', default=str(DEFAULT_AUDIO), help='测试音频')
+    parser.add_argument('--reference', default=str(DEFAULT_REFERENCE), help='参考文本（人工校对过的转写）')
+    parser.add_argument('--model-size', default='small', help='whisper 模型规格（默认：small）')
+    parser.add_argument('--prompt', default='', help='initial_prompt')
+    parser.add_argument('--runs', type=int, default=1, help='每种模式重复次数，取最快一次')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.audio) or not os.path.exists(args.reference):
+        print(f'缺少测试音频或参考文本: {args.audio} / {args.reference}')
+        print('请放入一段音频及其人工校对的转写文本，或通过 --audio / --reference 指定')
+        return 1
+
+    with open(args.reference, 'r', encoding='utf-8') as f:
+        reference = f.read()
+    audio = decode_audio_pcm(args.audio)
+    duration = len(audio) / 16000
+    print(f'音频时长: {duration:.1f} 秒，模型: whisper-{args.model_size}，CPU 线程: {os.cpu_count()}')
+
+    results = [bench(mode, audio, duration, args.model_size, args.prompt or None, args.runs)
+               for mode in ('fp32', 'int8')]
+
+    print(f"{'模式':<6}{'加载(s)':>10}{'转写(s)':>10}{'RTF':>8}{'错误率':>10}")
+    for r in results:
+        r['err'] = error_rate(reference, r['text'])
+        print(f"{r['mode']:<6}{r['load']:>10.2f}{r['time']:>10.2f}{r['rtf']:>8.3f}{r['err']:>10.2%}")
+    fp32, int8 = results
+    print(f"int8 相对 fp32：速度 {fp32['time'] / int8['time']:.2f}x，错误率变化 {int8['err'] - fp32['err']:+.2%}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
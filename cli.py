@@ -1,14 +1,12 @@
 #!/usr/bin/env python3
 import argparse
 import os
+import sys
 import logging
 
 from src.logging_config import setup_logging
 from src.errors import Codes, format_message
-from src.video_processor import preprocess_video
-from src.transcription import transcribe_audio
-from src.text_processor import add_punctuation, process_with_prompts
-from src.utils import save_text_to_file, move_file, copy_file
+from src.pipeline import Pipeline, parse_steps, plan_target_steps
 
 import config
 
@@ -19,44 +17,6 @@ AUTHOR = 'RaidriarB'
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-VIDEO_EXTS = {'.mp4', '.avi', '.mkv', '.mov', '.flv', '.webm', '.m4v'}
-AUDIO_EXTS = {'.mp3', '.wav', '.m4a', '.aac', '.flac', '.ogg'}
-TEXT_EXTS = {'.txt'}
-
-def detect_input_kind(path):
-    ext = os.path.splitext(path)[1].lower()
-    if ext in TEXT_EXTS:
-        return 'text'
-    if ext in AUDIO_EXTS:
-        return 'audio'
-    if ext in VIDEO_EXTS:
-        return 'video'
-    return 'unknown'
-
-def parse_steps(steps_str):
-    """
-    解析用户输入的步骤字符串
-    
-    Args:
-        steps_str (str): 用户输入的步骤字符串，如 '01234'
-    
-    Returns:
-        list: 要执行的步骤列表
-    """
-    valid_steps = set('1234')
-    if not steps_str:
-        raise ValueError('steps 不能为空')
-    if any(s not in valid_steps for s in steps_str):
-        raise ValueError('steps 只支持 1-4 的组合，例如 "12"、"234"')
-    steps = []
-    for s in steps_str:
-        step = int(s)
-        if step not in steps:
-            steps.append(step)
-    if steps != sorted(steps):
-        raise ValueError('steps 必须按顺序执行，例如 "12"、"234"')
-    return steps
-
 def print_banner():
     banner = f"""
     ███████╗██╗   ██╗███╗   ███╗███╗   ███╗██╗███████╗██╗   ██╗ █████╗ ██╗
@@ -95,16 +55,24 @@ def main():
 
     4. 从已有的转写文本开始处理：
         python cli.py -i transcript.txt --steps 34
+
+    5. 只重新生成过期的产物（如修改提示词后只重跑对应的总结）：
+        python cli.py -i lecture.mp4 --target summaries
+
+    6. 批量处理多个文件（在同一进程内依次处理，复用已加载的转写模型）：
+        python cli.py -i lecture1.mp4 lecture2.mp4 podcast.mp3
         ''',
     formatter_class=argparse.RawTextHelpFormatter  # 保留换行
     )
     parser.add_argument('-i','--input', 
                       required=True,
+                      nargs='+',
                       help='''
-输入文件路径。支持的格式：
+输入文件路径，可指定多个。支持的格式：
 - 视频文件：mp4, avi, mkv等
 - 音频文件：mp3, wav, m4a等
 - 文本文件：txt（仅用于步骤3和4）
+指定多个文件时，每个文件的结果保存在输出目录下与文件同名的子目录中
                       ''')
     parser.add_argument('-s','--steps', 
                       default='1234', 
@@ -135,6 +103,7 @@ def main():
                       help='''
 语音转写模型类型（可选）：
 - whisper
+- faster-whisper（CTranslate2，CPU int8 推理更快）
 - paraformer
 为空则使用 config.py 或环境变量配置
                       ''')
@@ -143,11 +112,34 @@ def main():
                       default=None,
                       help='''
 语音转写模型大小或名称（可选）。
-示例：whisper 可用 tiny/base/small/medium/large-v3/large-v3-turbo
+示例：whisper / faster-whisper 可用 tiny/base/small/medium/large-v3/large-v3-turbo
 paraformer 可用 paraformer-zh/paraformer-en/paraformer-zh-streaming 等
 为空则使用 config.py 或环境变量配置
                       ''')
 
+    parser.add_argument('-t','--target',
+                      default=None,
+                      choices=['audio', 'transcript', 'fixed', 'summaries'],
+                      help='''
+目标产物（可选），指定后忽略 --steps，并以增量方式执行：
+- audio: 预处理音频
+- transcript: 转写文本
+- fixed: 修正润色后的文本
+- summaries: 各提示词的总结
+输入与参数均未变化的步骤会被跳过，例如只修改了某个提示词时，
+只会针对该提示词重新生成总结
+                      ''')
+
+    parser.add_argument('--incremental',
+                      action='store_true',
+                      default=False,
+                      help="按 --steps 执行，但跳过产物已是最新的步骤，并复用产物缓存；不加时所有步骤都重新生成")
+
+    parser.add_argument('--retry-failed',
+                      action='store_true',
+                      default=False,
+                      help="只重试上次修正润色中失败的分块（其余分块从检查点读取），已是最新的步骤会被跳过")
+
     parser.add_argument('--nobanner',
                       action='store_true',
                       default=False,
@@ -161,161 +153,60 @@ paraformer 可用 paraformer-zh/paraformer-en/paraformer-zh-streaming 等
     # 检查输入参数
     if not args.input:
         logger.error(format_message(Codes.INVALID_ARGS, '未提供输入文件'))
-        return
+        return 1
 
     # 确保输入文件存在
-    if not os.path.exists(args.input):
-        logger.error(format_message(Codes.INPUT_NOT_FOUND, f'输入文件不存在: {args.input}'))
-        return
-    
-    # 确保输出目录存在
-    os.makedirs(args.output_dir, exist_ok=True)
-    
-    # 解析要执行的步骤
-    try:
-        steps = parse_steps(args.steps)
-    except ValueError as e:
-        logger.error(format_message(Codes.INVALID_ARGS, str(e)))
-        return
-    logger.info(f'将执行以下步骤: {steps}')
-    
-    current_file = args.input
-    base_name = os.path.splitext(os.path.basename(args.input))[0]
-    input_kind = detect_input_kind(args.input)
+    for input_file in args.input:
+        if not os.path.exists(input_file):
+            logger.error(format_message(Codes.INPUT_NOT_FOUND, f'输入文件不存在: {input_file}'))
+            return 1
 
-    # 校验步骤与输入类型的匹配关系
-    if input_kind == 'unknown':
-        logger.error(format_message(Codes.UNSUPPORTED_INPUT, '无法识别的输入文件类型'))
-        return
-    if 1 in steps and input_kind == 'text':
-        logger.error(format_message(Codes.STEP_MISMATCH, '步骤1不支持文本输入，请提供音频或视频文件'))
-        return
-    if 2 in steps and input_kind == 'text':
-        logger.error(format_message(Codes.STEP_MISMATCH, '步骤2需要音频输入，请先执行步骤1或提供音频文件'))
-        return
-    if 2 in steps and input_kind == 'video' and 1 not in steps:
-        logger.error(format_message(Codes.STEP_MISMATCH, '输入为视频时需要先执行步骤1'))
-        return
-    if any(s in steps for s in [3, 4]) and 2 not in steps and input_kind != 'text':
-        logger.error(format_message(Codes.STEP_MISMATCH, '步骤3/4需要文本输入，请先执行步骤2或提供txt文件'))
-        return
-    
-    try:
-
-        # 步骤1：音频预处理
-        if 1 in steps:
-            logger.info('步骤1：开始音频预处理')
-            processed_audio = preprocess_video(current_file, output_dir=os.path.join(config.TEMP_DIR, '1'))
-            if not processed_audio:
-                logger.error(format_message(Codes.PREPROCESS_FAIL, '音频预处理失败'))
-                return
-            current_file = processed_audio
-            # 移动到data/1目录（如已在目标目录则跳过）
-            data_file = os.path.join(config.TEMP_DIR, '1', os.path.basename(current_file))
-            if os.path.abspath(current_file) != os.path.abspath(data_file):
-                if not move_file(current_file, data_file):
-                    logger.error(format_message(Codes.FILE_IO, '移动预处理结果失败'))
-                    return
-                current_file = data_file
-            
-            # 如果步骤1是最后一步，将结果复制到output目录
-            if steps[-1] == 1:
-                output_file = os.path.join(args.output_dir, os.path.basename(current_file))
-                if not copy_file(current_file, output_file):
-                    logger.error(format_message(Codes.FILE_IO, '复制预处理结果到output目录失败'))
-                    return
-        
-        # 步骤2：语音转写
-        if 2 in steps:
-            logger.info('步骤2：开始语音转写')
-            prompt = '将以下音频转写成中文文本,确保使用正确的标点符号。'
-            transcribed_file = transcribe_audio(
-                current_file,
-                prompt,
-                model_type=args.transcribe_model_type,
-                model_size=args.transcribe_model_size,
-            )
-            if not transcribed_file:
-                logger.error(format_message(Codes.TRANSCRIBE_FAIL, '语音转写失败'))
-                return
-            
-            current_file = os.path.join(os.path.dirname(current_file), transcribed_file)
-            # 移动到data/2目录
-            data_file = os.path.join(config.TEMP_DIR, '2', os.path.basename(current_file))
-            if not move_file(current_file, data_file):
-                logger.error(format_message(Codes.FILE_IO, '移动转写结果失败'))
-                return
-            current_file = data_file
-            
-            # 始终将转写结果复制到output目录，方便Web端预览
-            output_file = os.path.join(args.output_dir, os.path.basename(current_file))
-            if not copy_file(current_file, output_file):
-                logger.error(format_message(Codes.FILE_IO, '复制转写结果到output目录失败'))
-                return
-        
-        # 步骤3：AI文本修正润色
-        if 3 in steps:
-            logger.info('步骤3：开始AI文本修正润色')
-            api_key = config.API_KEY
-            if not api_key:
-                logger.error(format_message(Codes.AI_KEY_MISSING, '未配置API密钥'))
-                return
-            
-            with open(current_file, 'r', encoding='utf-8') as f:
-                text = f.read()
-            
-            prompt =  '''
-            我通过语音转写，把一篇文本转换为了文字稿，然后分成了一些小部分。请你帮我添文本修正润色，并且改正语句中的偶尔转换错误。
-            你可以适当的给文本分段处理。
-            注意！必须忠实于文本，语句可能是被截取的、不完整的，禁止自己发挥，续写额外内容。
-            只需要回复我最终结果即可。
-            '''
-            punctuated_text = add_punctuation(
-                text,
-                api_key,
-                prompt,
-                config.CHUNK_SIZE,
-                config.API_TYPE
-            )
-            
-            if punctuated_text:
-                punctuated_file = os.path.join(args.output_dir, f'{base_name}_fixed.md')
-                if save_text_to_file(punctuated_text, punctuated_file):
-                    current_file = punctuated_file
-                    # 保存到data/3目录
-                    data_file = os.path.join(config.TEMP_DIR, '3', os.path.basename(current_file))
-                    if not copy_file(current_file, data_file):
-                        logger.error(format_message(Codes.FILE_IO, '保存文本修正润色结果失败'))
-                        return
-                    
-                    # 如果步骤3是最后一步，将结果复制到output目录?
-                    # 无需这样做，因为步骤3的结果已经被输出到output目录
-                else:
-                    logger.error(format_message(Codes.FILE_IO, '保存文本修正润色文本失败'))
-                    return
+    # 解析要执行的步骤
+    jobs = []
+    output_dirs = set()
+    for input_file in args.input:
+        try:
+            if args.target:
+                steps = plan_target_steps(input_file, args.target)
             else:
-                logger.error(format_message(Codes.AI_CALL_FAIL, 'AI文本修正润色失败'))
-                return
-        
-        # 步骤4：AI总结
-        if 4 in steps:
-            logger.info('步骤4：开始AI总结')
-            api_key = config.API_KEY
-            if not api_key:
-                logger.error(format_message(Codes.AI_KEY_MISSING, '未配置API密钥'))
-                return
-            
-            with open(current_file, 'r', encoding='utf-8') as f:
-                text = f.read()
-            
-            if not process_with_prompts(text, api_key, config.API_TYPE, args.prompts_dir, args.output_dir):
-                logger.error(format_message(Codes.AI_CALL_FAIL, 'AI总结失败'))
-                return
-        
-        logger.info('所有步骤处理完成')
-        
-    except Exception as e:
-        logger.error(format_message(Codes.INTERNAL, '处理过程出错', str(e)))
+                steps = parse_steps(args.steps)
+        except ValueError as e:
+            logger.error(format_message(Codes.INVALID_ARGS, str(e), input_file))
+            return 1
+        output_dir = args.output_dir
+        if len(args.input) > 1:
+            # 批量处理时每个文件单独一个子目录，同名文件依次加序号
+            base_name = os.path.splitext(os.path.basename(input_file))[0]
+            output_dir = os.path.join(args.output_dir, base_name)
+            index = 2
+            while output_dir in output_dirs:
+                output_dir = os.path.join(args.output_dir, f'{base_name}_{index}')
+                index += 1
+            output_dirs.add(output_dir)
+        jobs.append((input_file, output_dir, steps))
+
+    # 所有文件在同一进程内依次处理，转写模型加载一次后由模型池复用
+    failed = []
+    for input_file, output_dir, steps in jobs:
+        pipeline = Pipeline(
+            input_file,
+            output_dir,
+            steps,
+            prompts_dir=args.prompts_dir,
+            model_type=args.transcribe_model_type,
+            model_size=args.transcribe_model_size,
+            incremental=args.incremental or bool(args.target) or args.retry_failed,
+            retry_failed=args.retry_failed,
+        )
+        result = pipeline.run()
+        if not result['ok']:
+            failed.append((input_file, result))
+
+    if len(jobs) > 1:
+        logger.info(f'批量处理完成：成功 {len(jobs) - len(failed)}/{len(jobs)} 个文件')
+        for input_file, result in failed:
+            logger.error(format_message(result['code'], f'处理失败: {input_file}', result['message']))
+    return 1 if failed else 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -27,15 +27,58 @@ TRANS_MODEL_SIZE = os.getenv('TRANS_MODEL_SIZE', 'large-v3-turbo')
 
 '''
 选择语音转写模型类型
-whisper 或 paraformer
+whisper、faster-whisper 或 paraformer
 '''
 TRANS_MODEL_TYPE = os.getenv('TRANS_MODEL_TYPE', 'whisper').lower()
 
+'''
+openai-whisper 的量化方式（仅 CPU 生效）
+- 空 不量化，使用 fp32
+- dynamic 加载时对 Linear 层做 torch 动态 int8 量化，量化后的模型随模型池常驻
+'''
+TRANS_QUANTIZE = os.getenv('TRANS_QUANTIZE', '').lower()
+
 # Paraformer 默认配置
 TRANS_PARA_VAD_MODEL = os.getenv('TRANS_PARA_VAD_MODEL', 'fsmn-vad')
 TRANS_PARA_PUNC_MODEL = os.getenv('TRANS_PARA_PUNC_MODEL', 'ct-punc')
 TRANS_PARA_BATCH_SIZE_S = int(os.getenv('TRANS_PARA_BATCH_SIZE_S', '300'))
 
+'''
+faster-whisper（CTranslate2）配置，CPU 上推荐 int8
+- TRANS_FW_COMPUTE_TYPE 计算精度：int8 / int8_float32 / float32（GPU 还可用 int8_float16 / float16）
+- TRANS_FW_CPU_THREADS CPU 线程数，0 表示由 CTranslate2 自动决定
+- TRANS_FW_NUM_WORKERS 同一模型允许的并发转写数
+- TRANS_FW_BEAM_SIZE beam search 宽度
+'''
+TRANS_FW_COMPUTE_TYPE = os.getenv('TRANS_FW_COMPUTE_TYPE', 'int8').lower()
+TRANS_FW_CPU_THREADS = int(os.getenv('TRANS_FW_CPU_THREADS', '0'))
+TRANS_FW_NUM_WORKERS = int(os.getenv('TRANS_FW_NUM_WORKERS', '1'))
+TRANS_FW_BEAM_SIZE = int(os.getenv('TRANS_FW_BEAM_SIZE', '5'))
+
+'''
+转写模型池：已加载的模型常驻内存，同一进程内的后续任务直接复用
+- TRANS_POOL_MAX_MODELS 最多常驻的模型数量（不同的模型键），0 表示不限制；
+  同一模型可同时常驻多个实例，数量不超过调度器的转写槽位数，以便同一模型的转写并发执行
+- TRANS_POOL_MEMORY_MB 常驻模型的内存预算（MB），超出时按 LRU 淘汰，0 表示不限制
+- TRANS_POOL_IDLE_TTL 模型空闲多少秒后释放，0 表示不释放
+'''
+TRANS_POOL_ENABLED = os.getenv('TRANS_POOL_ENABLED', '1').lower() in ('1', 'true', 'yes', 'on')
+TRANS_POOL_MAX_MODELS = int(os.getenv('TRANS_POOL_MAX_MODELS', '2'))
+TRANS_POOL_MEMORY_MB = int(os.getenv('TRANS_POOL_MEMORY_MB', '0'))
+TRANS_POOL_IDLE_TTL = float(os.getenv('TRANS_POOL_IDLE_TTL', '1800'))
+
+'''
+并行转写（仅 CPU）：长音频按静音切分后在多个进程中同时转写
+- TRANS_PARALLEL_WORKERS worker 进程数，0 或 1 表示关闭
+- TRANS_PARALLEL_SEGMENT_SECONDS 每段的目标时长（秒），实际切点落在附近的静音处
+- TRANS_PARALLEL_MIN_SECONDS 音频短于该时长时仍走串行转写
+- TRANS_PARALLEL_THREADS 每个 worker 的 torch 线程数，0 表示按 CPU 核数平均分配
+'''
+TRANS_PARALLEL_WORKERS = int(os.getenv('TRANS_PARALLEL_WORKERS', '0'))
+TRANS_PARALLEL_SEGMENT_SECONDS = float(os.getenv('TRANS_PARALLEL_SEGMENT_SECONDS', '300'))
+TRANS_PARALLEL_MIN_SECONDS = float(os.getenv('TRANS_PARALLEL_MIN_SECONDS', '600'))
+TRANS_PARALLEL_THREADS = int(os.getenv('TRANS_PARALLEL_THREADS', '0'))
+
 
 ############################
 #     高级设置，请谨慎修改！  #
@@ -46,11 +89,145 @@ TRANS_PARA_BATCH_SIZE_S = int(os.getenv('TRANS_PARA_BATCH_SIZE_S', '300'))
 '''
 CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', '4000'))
 
+'''
+分块方式
+- tokens 按 token 数分块（默认）：中英文的字符/token 比差别很大，按 token 计数才能让每块都接近预算
+- chars 按字符数分块，上限为 CHUNK_SIZE
+CHUNK_TOKENS 每块输入 token 上限；修正润色的输出约为输入的 CHUNK_OUTPUT_RATIO 倍，
+实际上限还会被压到 MODEL_MAX_TOKENS / CHUNK_OUTPUT_RATIO 以内，避免输出被截断
+TOKENIZER_MODE 计数方式：auto（OpenAI 用 tiktoken，其他服务商估算）/ estimate / tiktoken
+TOKENIZER_ENCODING 非 OpenAI 服务商使用 tiktoken 时的词表
+'''
+CHUNK_MODE = os.getenv('CHUNK_MODE', 'tokens').lower()
+CHUNK_TOKENS = int(os.getenv('CHUNK_TOKENS', '2400'))
+CHUNK_OUTPUT_RATIO = float(os.getenv('CHUNK_OUTPUT_RATIO', '1.2'))
+TOKENIZER_MODE = os.getenv('TOKENIZER_MODE', 'auto').lower()
+TOKENIZER_ENCODING = os.getenv('TOKENIZER_ENCODING', 'cl100k_base')
+
+'''
+分层（map-reduce）总结：文本超过 SUMMARY_MAP_REDUCE_TOKENS 时，按 SUMMARY_CHUNK_TOKENS 分块分别总结再合并，
+部分结果过多时逐层合并。每个提示词的合并模板放在 prompts/reduce/<同名>.txt（{prompt} 会被替换为原提示词），
+没有时使用内置模板。SUMMARY_MAP_REDUCE_TOKENS 为 0 表示始终整篇发送
+'''
+SUMMARY_MAP_REDUCE_TOKENS = int(os.getenv('SUMMARY_MAP_REDUCE_TOKENS', '30000'))
+SUMMARY_CHUNK_TOKENS = int(os.getenv('SUMMARY_CHUNK_TOKENS', '12000'))
+
+'''
+总结请求的消息布局：
+- system 提示词作为系统消息放在最前（默认，与旧版输出一致）
+- prefix 所有提示词共用固定的系统消息，转写文本在前、提示词在后，多个提示词之间共享同一段前缀，
+  可以命中 DeepSeek 的上下文硬盘缓存与 OpenAI 的自动前缀缓存，Claude 会在文本末尾加 cache_control 断点。
+  提示词不再作为系统消息，总结的风格可能与 system 布局略有不同，需要时手动开启
+'''
+AI_SUMMARY_LAYOUT = os.getenv('AI_SUMMARY_LAYOUT', 'system').lower()
+
 MODEL_TEMPERATURE = float(os.getenv('MODEL_TEMPERATURE', '0.9'))
 MODEL_MAX_TOKENS = int(os.getenv('MODEL_MAX_TOKENS', '8000'))
 AI_THREADS = int(os.getenv('AI_THREADS', '4'))
+# 总结步骤是否流式请求：内容边生成边写入输出文件并推送到网页
+AI_STREAM = os.getenv('AI_STREAM', '1').lower() in ('1', 'true', 'yes', 'on')
+# 每个服务商同时在途的AI请求数，所有请求由一个事件循环线程驱动，可以设置得远大于线程数；0 表示等于 AI_THREADS
+AI_CONCURRENCY = int(os.getenv('AI_CONCURRENCY', '0')) or AI_THREADS
 AI_RETRY_MAX = int(os.getenv('AI_RETRY_MAX', '2'))
 AI_RETRY_BACKOFF_SECONDS = float(os.getenv('AI_RETRY_BACKOFF_SECONDS', '1.0'))
+AI_RETRY_MAX_BACKOFF_SECONDS = float(os.getenv('AI_RETRY_MAX_BACKOFF_SECONDS', '60'))
+
+'''
+AI 请求限流（每个服务商一个令牌桶）
+- AI_RPM / AI_TPM 每分钟请求数 / token 数上限，0 表示不主动限制（此时会采用响应头返回的额度）
+- AI_RPM_DEEPSEEK、AI_TPM_OPENAI 等可单独覆盖某个服务商
+- AI_ADAPTIVE_CONCURRENCY 自适应并发：服务商正常时并发数从 AI_CONCURRENCY 逐步增长到 AI_CONCURRENCY_MAX，
+  收到限流（429）时减半，最低为 AI_CONCURRENCY_MIN
+'''
+AI_RPM = int(os.getenv('AI_RPM', '0'))
+AI_TPM = int(os.getenv('AI_TPM', '0'))
+AI_RATE_LIMITS = {
+    provider: (
+        int(os.getenv(f'AI_RPM_{provider.upper()}', AI_RPM)),
+        int(os.getenv(f'AI_TPM_{provider.upper()}', AI_TPM)),
+    )
+    for provider in ('deepseek', 'claude', 'openai')
+}
+AI_ADAPTIVE_CONCURRENCY = os.getenv('AI_ADAPTIVE_CONCURRENCY', '1').lower() in ('1', 'true', 'yes', 'on')
+AI_CONCURRENCY_MIN = int(os.getenv('AI_CONCURRENCY_MIN', '1'))
+AI_CONCURRENCY_MAX = int(os.getenv('AI_CONCURRENCY_MAX', '0')) or AI_CONCURRENCY * 4
+
+'''
+对冲请求与多服务商故障切换
+- AI_FAILOVER 首选服务商重试后仍失败时，按顺序切换的备选服务商，如 openai,claude；
+  备选服务商的密钥通过 DEEPSEEK_API_KEY / OPENAI_API_KEY / CLAUDE_API_KEY 配置
+- AI_HEDGE_ENABLED 请求耗时超过该服务商同档请求的 AI_HEDGE_QUANTILE 分位数后，再发一个相同请求，取先返回的结果
+- AI_HEDGE_MIN_SAMPLES 分位数至少需要的样本数，不足时使用 AI_HEDGE_DELAY_SECONDS（0 表示不对冲）
+- AI_HEDGE_TARGET same 向同一服务商对冲，alternate 向 AI_FAILOVER 中的下一个服务商对冲
+- AI_HEDGE_MAX_RATIO 对冲请求占总请求数的上限
+'''
+AI_FAILOVER = [p.strip().lower() for p in os.getenv('AI_FAILOVER', '').split(',') if p.strip()]
+AI_API_KEYS = {
+    'deepseek': os.getenv('DEEPSEEK_API_KEY', ''),
+    'openai': os.getenv('OPENAI_API_KEY', ''),
+    'claude': os.getenv('CLAUDE_API_KEY', '') or os.getenv('ANTHROPIC_API_KEY', ''),
+}
+AI_HEDGE_ENABLED = os.getenv('AI_HEDGE_ENABLED', '0').lower() in ('1', 'true', 'yes', 'on')
+AI_HEDGE_QUANTILE = float(os.getenv('AI_HEDGE_QUANTILE', '0.95'))
+AI_HEDGE_MIN_SAMPLES = int(os.getenv('AI_HEDGE_MIN_SAMPLES', '20'))
+AI_HEDGE_DELAY_SECONDS = float(os.getenv('AI_HEDGE_DELAY_SECONDS', '0'))
+AI_HEDGE_TARGET = os.getenv('AI_HEDGE_TARGET', 'same').lower()
+AI_HEDGE_MAX_RATIO = float(os.getenv('AI_HEDGE_MAX_RATIO', '0.1'))
+
+'''
+AI 请求的 HTTP 连接池，同一服务商与密钥的所有调用共用一组长连接
+- AI_HTTP_MAX_CONNECTIONS 最大连接数，应不小于 AI_THREADS
+- AI_HTTP_MAX_KEEPALIVE 空闲时保留的连接数
+- AI_HTTP_KEEPALIVE_EXPIRY 空闲连接保留秒数
+- AI_HTTP2 是否启用 HTTP/2（需要安装 h2）
+'''
+AI_HTTP_MAX_CONNECTIONS = int(os.getenv('AI_HTTP_MAX_CONNECTIONS', '32'))
+AI_HTTP_MAX_KEEPALIVE = int(os.getenv('AI_HTTP_MAX_KEEPALIVE', '16'))
+AI_HTTP_KEEPALIVE_EXPIRY = float(os.getenv('AI_HTTP_KEEPALIVE_EXPIRY', '120'))
+AI_HTTP_TIMEOUT = float(os.getenv('AI_HTTP_TIMEOUT', '600'))
+AI_HTTP_CONNECT_TIMEOUT = float(os.getenv('AI_HTTP_CONNECT_TIMEOUT', '10'))
+AI_HTTP2 = os.getenv('AI_HTTP2', '0').lower() in ('1', 'true', 'yes', 'on')
+
+'''
+Web 端任务执行方式
+- inprocess 在 web 进程内直接执行流水线，模型常驻复用（默认）
+- worker 在常驻的 worker 进程内执行（每个并发任务一个 worker 进程），web 进程不加载 torch
+- subprocess 每个任务启动一个 cli.py 子进程，隔离性最好但每次都要重新加载模型
+'''
+TASK_EXEC_MODE = os.getenv('TASK_EXEC_MODE', 'inprocess').lower()
+# Web 端同时执行的任务数，同一个文件的任务始终串行；0 表示自动（inprocess 为调度器槽位总数，其他模式为 1）
+WEB_TASK_WORKERS = int(os.getenv('WEB_TASK_WORKERS', '0'))
+
+'''
+Web 端任务队列（SQLite），重启后未完成的任务会继续执行，多个 web 进程可共用同一个数据库
+- WEB_TASK_DB 数据库路径，为空则使用 web/data/tasks.sqlite3
+- WEB_TASK_LEASE_SECONDS 执行中任务的租约时长，执行进程定期续期，崩溃后租约过期的任务重新排队
+- WEB_TASK_MAX_ATTEMPTS 任务最多被领取的次数，超过后标记为失败
+- WEB_TASK_RETENTION_DAYS 已结束任务记录的保留天数
+'''
+WEB_TASK_DB = os.getenv('WEB_TASK_DB', '')
+WEB_TASK_LEASE_SECONDS = float(os.getenv('WEB_TASK_LEASE_SECONDS', '120'))
+WEB_TASK_MAX_ATTEMPTS = int(os.getenv('WEB_TASK_MAX_ATTEMPTS', '3'))
+WEB_TASK_RETENTION_DAYS = float(os.getenv('WEB_TASK_RETENTION_DAYS', '7'))
+# 推送给列表页（queue 频道）的队列汇总状态的最短间隔秒数，间隔内的多次变化合并为一次推送
+WEB_QUEUE_STATUS_INTERVAL = float(os.getenv('WEB_QUEUE_STATUS_INTERVAL', '1'))
+# Web 端转写记录数据库（SQLite），为空则使用 web/data/records.sqlite3；旧版 transcription_records.json 首次启动时自动导入
+WEB_RECORDS_DB = os.getenv('WEB_RECORDS_DB', '')
+# 后台检查上传目录变化并补建记录的间隔秒数（目录修改时间未变化时跳过），0 表示只在启动时检查一次
+WEB_RECORDS_SYNC_SECONDS = float(os.getenv('WEB_RECORDS_SYNC_SECONDS', '5'))
+
+'''
+步骤调度器：同一进程内的任务按步骤占用不同的资源池，步骤结束即释放槽位
+- SCHED_FFMPEG_SLOTS 同时执行的音频预处理数，0 表示 CPU 核数 / 4
+- SCHED_TRANSCRIBE_SLOTS 同时执行的转写数，0 表示按 CPU 核数与转写模型内存自动计算
+- SCHED_AI_SLOTS 同时执行修正/总结步骤的任务数（只等待网络，实际请求并发由 AI_CONCURRENCY 控制）
+'''
+SCHED_FFMPEG_SLOTS = int(os.getenv('SCHED_FFMPEG_SLOTS', '0'))
+SCHED_TRANSCRIBE_SLOTS = int(os.getenv('SCHED_TRANSCRIBE_SLOTS', '0'))
+SCHED_AI_SLOTS = int(os.getenv('SCHED_AI_SLOTS', '8'))
+
+# Web 端任务是否增量执行：输入与参数都未变化的步骤（及未修改的提示词）直接跳过
+WEB_INCREMENTAL = os.getenv('WEB_INCREMENTAL', '1').lower() in ('1', 'true', 'yes', 'on')
 
 # 日志配置
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
@@ -59,15 +236,6 @@ LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', '5000000'))
 LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '3'))
 
 
-'''选用的语音转写模型
-whisper 或 paraformer
-'''
-# TODO 未来再支持faster-whisper
-# whisper已经很好用，而faster-whisper只支持cuda mode，Macbook M系列和windows都不太适合
-# whisper直接cpu mode跑就可以了
-# TRANS_MODEL_TYPE = 'whisper'
-
-
 '''cpu or gpu
 gpu需要cuda，未必支持，请自行确认。
 Macbook M系列，不管是whisper还是faster-whisper都不能gpu模式
@@ -75,5 +243,56 @@ Macbook M系列，不管是whisper还是faster-whisper都不能gpu模式
 TRANS_DEVICE = os.getenv('TRANS_DEVICE', 'cpu')
 
 
+'''
+音频预处理输出格式
+- m4a 44.1 kHz 双声道 AAC，便于试听和下载
+- pcm 16 kHz 单声道 float32 原始采样，转写时直接内存映射读取，省去一次编码和一次解码
+'''
+PREPROCESS_FORMAT = os.getenv('PREPROCESS_FORMAT', 'm4a').lower()
+
 # 数据临时文件夹
 TEMP_DIR = os.getenv('TEMP_DIR', 'tempdata')
+
+'''
+任务工作目录：每次执行流水线在 WORKSPACE_DIR/<任务ID>/ 下存放中间文件，多个任务并发执行互不干扰
+- WORKSPACE_DIR 为空则使用 TEMP_DIR/jobs
+- WORKSPACE_KEEP 任务结束后是否保留工作目录：never 不保留 / failed 只保留失败的任务（默认）/ always 全部保留
+- WORKSPACE_KEEP_TTL_DAYS 保留的工作目录超过该天数后自动删除，0 表示一直保留
+'''
+WORKSPACE_DIR = os.getenv('WORKSPACE_DIR', '')
+WORKSPACE_KEEP = os.getenv('WORKSPACE_KEEP', 'failed').lower()
+WORKSPACE_KEEP_TTL_DAYS = float(os.getenv('WORKSPACE_KEEP_TTL_DAYS', '7'))
+
+'''
+步骤产物缓存：以输入内容哈希 + 步骤参数为键缓存预处理音频、转写、修正与总结结果，
+增量执行（cli.py --incremental / WEB_INCREMENTAL）时重复处理同一文件直接复用。
+修正与总结结果遵循 AI_CACHE_SKIP_NONDETERMINISTIC：温度大于 0 时默认不缓存
+- ARTIFACT_CACHE_DIR 缓存目录，为空则使用 TEMP_DIR/cache
+- ARTIFACT_CACHE_MAX_MB 缓存总大小上限（MB），超出时按最近使用时间淘汰，0 表示不限制
+'''
+ARTIFACT_CACHE_ENABLED = os.getenv('ARTIFACT_CACHE_ENABLED', '1').lower() in ('1', 'true', 'yes', 'on')
+ARTIFACT_CACHE_DIR = os.getenv('ARTIFACT_CACHE_DIR', '')
+ARTIFACT_CACHE_MAX_MB = int(os.getenv('ARTIFACT_CACHE_MAX_MB', '2048'))
+
+'''
+修正润色的分块检查点：每个分块完成即保存，部分分块失败时再次执行只请求缺失或失败的分块，
+全部成功后自动删除
+- FIX_CHECKPOINT_DIR 检查点目录，为空则使用 TEMP_DIR/split
+- FIX_CHECKPOINT_TTL_DAYS 超过该天数未更新的检查点视为放弃并删除，0 表示不清理
+'''
+FIX_CHECKPOINT_DIR = os.getenv('FIX_CHECKPOINT_DIR', '')
+FIX_CHECKPOINT_TTL_DAYS = float(os.getenv('FIX_CHECKPOINT_TTL_DAYS', '7'))
+
+'''
+AI 响应缓存：以完整请求（服务商、模型、温度、系统提示词、输入文本等）的哈希为键，
+保存在 SQLite 中，重新执行修正或总结时相同的分块不再重复计费
+- AI_CACHE_PATH 缓存数据库路径，为空则使用 TEMP_DIR/ai_cache.sqlite3
+- AI_CACHE_TTL_DAYS 条目有效天数，0 表示永不过期
+- AI_CACHE_MAX_MB 缓存总大小上限（MB），超出时按最近访问时间淘汰，0 表示不限制
+- AI_CACHE_SKIP_NONDETERMINISTIC 温度大于 0 时结果不确定，默认这类请求不读写缓存；设为 0 则同样缓存（每次得到相同的结果）
+'''
+AI_CACHE_ENABLED = os.getenv('AI_CACHE_ENABLED', '1').lower() in ('1', 'true', 'yes', 'on')
+AI_CACHE_PATH = os.getenv('AI_CACHE_PATH', '')
+AI_CACHE_TTL_DAYS = float(os.getenv('AI_CACHE_TTL_DAYS', '30'))
+AI_CACHE_MAX_MB = int(os.getenv('AI_CACHE_MAX_MB', '256'))
+AI_CACHE_SKIP_NONDETERMINISTIC = os.getenv('AI_CACHE_SKIP_NONDETERMINISTIC', '1').lower() in ('1', 'true', 'yes', 'on')
@@ -1,29 +1,948 @@
+import asyncio
+import atexit
+import bisect
+import contextlib
+import contextvars
+import hashlib
+import math
+import json
 import logging
+import os
+import random
+import re
+import sqlite3
+import threading
 import time
-from openai import OpenAI
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import httpx
+from openai import AsyncOpenAI, OpenAI
 import config
 from .errors import Codes, format_message
+from .tokenizer import count_tokens
 
 logger = logging.getLogger(__name__)
 
-def _sleep_with_backoff(attempt):
-    backoff = config.AI_RETRY_BACKOFF_SECONDS * (2 ** attempt)
-    time.sleep(backoff)
+DEEPSEEK_BASE_URL = "https://api.deepseek.com"
 
-def _call_with_retries(fn, api_type):
+_clients = {}
+_clients_lock = threading.Lock()
+
+_engine = None
+_engine_lock = threading.Lock()
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+_hedge_stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'failovers': 0}
+_hedge_stats_lock = threading.Lock()
+
+# 请求布局：system 为提示词在系统消息、文本在用户消息；prefix 为文本在前、提示词在后，便于命中服务商的前缀缓存
+LAYOUT_SYSTEM = 'system'
+LAYOUT_PREFIX = 'prefix'
+# prefix 布局下所有请求共用的系统消息，保持不变才能让缓存前缀从第一个 token 开始对齐
+PREFIX_SYSTEM_PROMPT = '你是一个文本处理助手。用户会先给出一段材料，材料之后是针对这段材料的处理要求，请严格按要求处理材料。'
+PREFIX_INSTRUCTION_HEADER = '以上是材料。请按以下要求处理：\n'
+
+
+class _ClientEntry:
+    def __init__(self, client, http_client):
+        self.client = client
+        self.http_client = http_client
+        self.created = time.time()
+        self.last_used = self.created
+        self.requests = 0
+
+
+def _http2_enabled():
+    if not config.AI_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning('AI_HTTP2 已开启但未安装 h2 依赖（pip install httpx[http2]），回退到 HTTP/1.1')
+        return False
+    return True
+
+
+def _build_http_client(provider, use_async=False):
+    """按配置创建带连接池与 keep-alive 的 httpx 客户端，响应头中的限流信息会同步给限流器"""
+    limits = httpx.Limits(
+        max_connections=config.AI_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=config.AI_HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=config.AI_HTTP_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(config.AI_HTTP_TIMEOUT, connect=config.AI_HTTP_CONNECT_TIMEOUT)
+    limiter = get_rate_limiter(provider)
+    if use_async:
+        async def on_response(response):
+            limiter.update_from_headers(response.headers, response.status_code)
+
+        return httpx.AsyncClient(limits=limits, timeout=timeout, http2=_http2_enabled(),
+                                 event_hooks={'response': [on_response]})
+
+    def on_response(response):
+        limiter.update_from_headers(response.headers, response.status_code)
+
+    return httpx.Client(limits=limits, timeout=timeout, http2=_http2_enabled(),
+                        event_hooks={'response': [on_response]})
+
+
+def _create_client(provider, api_key, base_url, http_client, use_async=False):
+    # 关闭 SDK 自带的重试：429/5xx 由 _retry_policy 统一退避，并反馈给限速器与自适应并发
+    if provider == 'claude':
+        try:
+            import anthropic
+        except Exception as e:
+            raise RuntimeError("未安装 anthropic 依赖，无法使用 Claude API") from e
+        client_cls = anthropic.AsyncAnthropic if use_async else anthropic.Anthropic
+        return client_cls(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+    client_cls = AsyncOpenAI if use_async else OpenAI
+    return client_cls(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+
+
+def _get_client(provider, api_key, base_url, use_async):
+    mode = 'async' if use_async else 'sync'
+    key = (provider, api_key, base_url, mode)
+    with _clients_lock:
+        entry = _clients.get(key)
+        if entry is None:
+            http_client = _build_http_client(provider, use_async)
+            try:
+                client = _create_client(provider, api_key, base_url, http_client, use_async)
+            except Exception:
+                if not use_async:
+                    http_client.close()
+                raise
+            entry = _ClientEntry(client, http_client)
+            _clients[key] = entry
+            logger.debug(f'创建 {provider} {mode} 客户端连接池，base_url: {base_url or "默认"}')
+        entry.requests += 1
+        entry.last_used = time.time()
+        return entry.client
+
+
+def get_client(provider, api_key, base_url=None):
+    """
+    返回进程内共享的 SDK 客户端
+
+    按 (provider, api_key, base_url) 复用，同一组参数的所有调用共用一个连接池，
+    避免每个分块都重新建立 TLS 连接。SDK 客户端本身是线程安全的。
+    """
+    return _get_client(provider, api_key, base_url, use_async=False)
+
+
+def get_async_client(provider, api_key, base_url=None):
+    """
+    返回共享的异步 SDK 客户端
+
+    异步客户端绑定在 AI 引擎的事件循环上，只能在该循环内使用。
+    """
+    return _get_client(provider, api_key, base_url, use_async=True)
+
+
+def _pool_connections(http_client):
+    """读取 httpx 底层连接池中的连接状态，不同版本结构不同，取不到时返回 None"""
+    pool = getattr(getattr(http_client, '_transport', None), '_pool', None)
+    connections = getattr(pool, 'connections', None)
+    if connections is None:
+        return None
+    active = idle = 0
+    for conn in list(connections):
+        try:
+            if conn.is_idle():
+                idle += 1
+            else:
+                active += 1
+        except Exception:
+            continue
+    return {'active': active, 'idle': idle}
+
+
+def get_client_pool_stats():
+    """返回各客户端连接池的统计信息（API 密钥只保留哈希前缀）"""
+    now = time.time()
+    with _clients_lock:
+        items = list(_clients.items())
+    clients = []
+    for (provider, api_key, base_url, mode), entry in items:
+        clients.append({
+            'provider': provider,
+            'mode': mode,
+            'base_url': base_url,
+            'key_id': hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:8],
+            'requests': entry.requests,
+            'age_seconds': round(now - entry.created, 1),
+            'idle_seconds': round(now - entry.last_used, 1),
+            'connections': _pool_connections(entry.http_client),
+        })
+    return {
+        'limits': {
+            'max_connections': config.AI_HTTP_MAX_CONNECTIONS,
+            'max_keepalive_connections': config.AI_HTTP_MAX_KEEPALIVE,
+            'keepalive_expiry': config.AI_HTTP_KEEPALIVE_EXPIRY,
+            'http2': bool(config.AI_HTTP2),
+        },
+        'clients': clients,
+        'engine': _engine.stats() if _engine is not None else None,
+        'usage': get_usage_stats(),
+        'rate_limits': get_rate_limit_stats(),
+        'hedging': get_hedge_stats(),
+    }
+
+
+def close_clients():
+    """关闭所有共享客户端及其连接"""
+    with _clients_lock:
+        entries = list(_clients.values())
+        _clients.clear()
+    async_clients = []
+    for entry in entries:
+        if isinstance(entry.http_client, httpx.AsyncClient):
+            async_clients.append(entry.http_client)
+            continue
+        try:
+            entry.http_client.close()
+        except Exception:
+            pass
+    if async_clients and _engine is not None:
+        _engine.close(async_clients)
+
+
+atexit.register(close_clients)
+
+
+class ResponseCache:
+    """
+    持久化的 AI 响应缓存（SQLite）
+
+    以完整请求（服务商、模型、温度、最大 token 数、系统提示词、输入文本）的哈希为键。
+    条目超过 ttl 秒视为过期；总大小超过 max_bytes 时按最近访问时间淘汰。
+    """
+
+    def __init__(self, path, ttl=0, max_bytes=0):
+        self.path = path
+        self.ttl = float(ttl)
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'expired': 0, 'evictions': 0, 'bypassed': 0}
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, provider TEXT, model TEXT, response TEXT NOT NULL, '
+                'size INTEGER NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL, '
+                'hits INTEGER NOT NULL DEFAULT 0)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)')
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def make_key(provider, model, temperature, max_tokens, prompt, text):
+        payload = json.dumps({
+            'provider': provider,
+            'model': model,
+            'temperature': temperature,
+            'max_tokens': max_tokens,
+            'system': prompt,
+            'text': text,
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def record_bypass(self):
+        with self._lock:
+            self._stats['bypassed'] += 1
+
+    def get(self, key):
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+                if row and self.ttl > 0 and now - row[1] > self.ttl:
+                    conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    self._stats['expired'] += 1
+                    row = None
+                if row is None:
+                    self._stats['misses'] += 1
+                    return None
+                conn.execute('UPDATE responses SET last_access = ?, hits = hits + 1 WHERE key = ?', (now, key))
+                self._stats['hits'] += 1
+                return row[0]
+        except sqlite3.Error as e:
+            logger.warning(format_message(Codes.FILE_IO, '读取AI响应缓存失败', str(e)))
+            return None
+
+    def put(self, key, response, provider=None, model=None):
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute(
+                    'INSERT OR REPLACE INTO responses (key, provider, model, response, size, created, last_access, hits) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, 0)',
+                    (key, provider, model, response, size, now, now),
+                )
+                self._stats['stores'] += 1
+                self._evict(conn, now)
+        except sqlite3.Error as e:
+            logger.warning(format_message(Codes.FILE_IO, '写入AI响应缓存失败', str(e)))
+
+    def _evict(self, conn, now):
+        if self.ttl > 0:
+            cur = conn.execute('DELETE FROM responses WHERE created < ?', (now - self.ttl,))
+            self._stats['expired'] += max(cur.rowcount, 0)
+        if self.max_bytes <= 0:
+            return
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        rows = conn.execute('SELECT key, size FROM responses ORDER BY last_access').fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+            total -= size
+            evicted += 1
+        self._stats['evictions'] += evicted
+        logger.info(f'AI响应缓存超出上限，已淘汰 {evicted} 条，当前约 {total / 1024 / 1024:.1f} MB')
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            try:
+                count, size = self._connect().execute(
+                    'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+            except sqlite3.Error:
+                count, size = None, None
+        lookups = data['hits'] + data['misses']
+        data['hit_rate'] = round(data['hits'] / lookups, 4) if lookups else 0.0
+        data['entries'] = count
+        data['bytes'] = size
+        return data
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """返回进程内共享的 AI 响应缓存，未启用时返回 None"""
+    global _response_cache
+    if not config.AI_CACHE_ENABLED:
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            path = config.AI_CACHE_PATH or os.path.join(config.TEMP_DIR, 'ai_cache.sqlite3')
+            _response_cache = ResponseCache(
+                path,
+                ttl=config.AI_CACHE_TTL_DAYS * 86400,
+                max_bytes=config.AI_CACHE_MAX_MB * 1024 * 1024,
+            )
+        return _response_cache
+
+
+def _cache_key_for(text, prompt, api_type, layout=LAYOUT_SYSTEM):
+    """
+    返回 (缓存, 键)；缓存未启用，或温度大于 0 且配置了跳过非确定性请求时返回 (None, None)
+    """
+    cache = get_response_cache()
+    if cache is None:
+        return None, None
+    if config.AI_CACHE_SKIP_NONDETERMINISTIC and config.MODEL_TEMPERATURE > 0:
+        cache.record_bypass()
+        return None, None
+    # 旧布局的键保持不变，已有的缓存条目继续有效
+    system = prompt if layout == LAYOUT_SYSTEM else f'[{layout}]{prompt}'
+    key = ResponseCache.make_key(api_type, get_model_name(api_type), config.MODEL_TEMPERATURE,
+                                 config.MODEL_MAX_TOKENS, system, text)
+    return cache, key
+
+
+def _replay_cached(result, on_delta):
+    if on_delta is not None:
+        on_delta(None)
+        on_delta(result)
+    return result
+
+
+USAGE_FIELDS = ('requests', 'input_tokens', 'cached_input_tokens', 'cache_write_tokens', 'output_tokens')
+
+
+class UsageMeter:
+    """
+    累计 AI 请求的 token 用量
+
+    input_tokens 为全部输入 token，其中 cached_input_tokens 命中了服务商的前缀缓存（按折扣计费），
+    cache_write_tokens 为 Claude 写入缓存的 token（按溢价计费），其余按原价计费。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = dict.fromkeys(USAGE_FIELDS, 0)
+        self._providers = {}
+
+    def record(self, provider, usage):
+        with self._lock:
+            by_provider = self._providers.setdefault(provider, dict.fromkeys(USAGE_FIELDS, 0))
+            for totals in (self._totals, by_provider):
+                for field in USAGE_FIELDS:
+                    totals[field] += usage.get(field, 0)
+
+    @staticmethod
+    def _summarize(totals):
+        data = dict(totals)
+        data['uncached_input_tokens'] = totals['input_tokens'] - totals['cached_input_tokens']
+        data['cache_hit_rate'] = (round(totals['cached_input_tokens'] / totals['input_tokens'], 4)
+                                  if totals['input_tokens'] else 0.0)
+        return data
+
+    def stats(self):
+        with self._lock:
+            data = self._summarize(self._totals)
+            data['providers'] = {p: self._summarize(t) for p, t in self._providers.items()}
+        return data
+
+    def summary(self):
+        """一行中文的用量说明，用于日志"""
+        data = self.stats()
+        return (f"AI 请求 {data['requests']} 次，输入 {data['input_tokens']} tokens"
+                f"（缓存命中 {data['cached_input_tokens']}，未命中 {data['uncached_input_tokens']}，"
+                f"命中率 {data['cache_hit_rate']:.1%}），输出 {data['output_tokens']} tokens")
+
+
+_usage_totals = UsageMeter()
+# 当前上下文中正在统计的 UsageMeter，嵌套的 track_usage 会同时计入外层
+_current_usage = contextvars.ContextVar('ai_usage_meters', default=())
+# 当前这次请求尝试的实际 token 用量（输入 + 输出），由 _record_usage 填入，用于修正限流器预扣的额度
+_current_charge = contextvars.ContextVar('ai_request_charge', default=None)
+
+
+@contextlib.contextmanager
+def track_usage(meter=None):
+    """
+    统计 with 块内发出的 AI 请求用量（包括提交给 AI 引擎的批量请求），返回 UsageMeter
+
+    用量只来自服务商实际返回的 usage 字段，命中本地响应缓存的请求不计入。
+    """
+    meter = meter or UsageMeter()
+    token = _current_usage.set(_current_usage.get() + (meter,))
+    try:
+        yield meter
+    finally:
+        _current_usage.reset(token)
+
+
+def _usage_from_response(usage):
+    """把各服务商的 usage 对象统一成 USAGE_FIELDS"""
+    if usage is None:
+        return None
+    if getattr(usage, 'prompt_tokens', None) is not None:
+        # OpenAI 兼容接口：DeepSeek 返回 prompt_cache_hit_tokens，OpenAI 在 prompt_tokens_details.cached_tokens
+        cached = getattr(usage, 'prompt_cache_hit_tokens', None)
+        if cached is None:
+            details = getattr(usage, 'prompt_tokens_details', None)
+            cached = getattr(details, 'cached_tokens', None) if details is not None else None
+        return {
+            'requests': 1,
+            'input_tokens': usage.prompt_tokens,
+            'cached_input_tokens': cached or 0,
+            'cache_write_tokens': 0,
+            'output_tokens': getattr(usage, 'completion_tokens', 0) or 0,
+        }
+    # Anthropic：input_tokens 只包含断点之后未缓存的部分
+    read = getattr(usage, 'cache_read_input_tokens', 0) or 0
+    write = getattr(usage, 'cache_creation_input_tokens', 0) or 0
+    return {
+        'requests': 1,
+        'input_tokens': (getattr(usage, 'input_tokens', 0) or 0) + read + write,
+        'cached_input_tokens': read,
+        'cache_write_tokens': write,
+        'output_tokens': getattr(usage, 'output_tokens', 0) or 0,
+    }
+
+
+def _record_usage(provider, usage):
+    try:
+        data = _usage_from_response(usage)
+    except Exception as e:
+        logger.debug(f'解析 {provider} 用量失败: {e}')
+        return
+    if data is None:
+        return
+    charge = _current_charge.get()
+    if charge is not None:
+        charge['used'] = data['input_tokens'] + data['output_tokens']
+    _usage_totals.record(provider, data)
+    for meter in _current_usage.get():
+        meter.record(provider, data)
+
+
+def get_usage_stats():
+    """返回进程启动以来的 AI 用量统计"""
+    return _usage_totals.stats()
+
+_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+
+
+def _parse_duration(value):
+    """解析 '1s'、'6m0s'、'20ms' 形式的时长或纯秒数，失败返回 None"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        return None
+    scale = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(num) * scale[unit] for num, unit in parts)
+
+
+def _parse_reset(value):
+    """解析限流重置时间：时长（OpenAI/DeepSeek）或 RFC 3339 时间点（Anthropic），返回距现在的秒数"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    if 'T' in value:
+        try:
+            reset_at = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            return max((reset_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        except ValueError:
+            return None
+    return _parse_duration(value)
+
+
+def parse_retry_after(headers):
+    """读取 retry-after-ms / retry-after 响应头，返回需要等待的秒数"""
+    if not headers:
+        return None
+    value = headers.get('retry-after-ms')
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _header_int(headers, *names):
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return int(float(value))
+            except ValueError:
+                continue
+    return None
+
+
+class RateLimiter:
+    """
+    单个服务商的令牌桶限流器
+
+    分别按每分钟请求数（rpm）与每分钟 token 数（tpm）限流，为 0 表示不限制；
+    未配置时会采用响应头中返回的额度。响应头显示额度已用完、或收到 429 时，
+    在重置时间 / Retry-After 之前暂停该服务商的所有请求。
+    tpm 按输入 token 加 max_tokens 预扣，请求完成后按响应中的实际用量修正。
+    """
+
+    def __init__(self, provider, rpm=0, tpm=0):
+        self.provider = provider
+        self.rpm = int(rpm)
+        self.tpm = int(tpm)
+        self._configured = (self.rpm > 0, self.tpm > 0)
+        self._lock = threading.Lock()
+        self._requests = float(self.rpm)
+        self._tokens = float(self.tpm)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._stats = {'waits': 0, 'wait_seconds': 0.0, 'throttled': 0, 'blocks': 0}
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm > 0:
+            self._requests = min(float(self.rpm), self._requests + elapsed * self.rpm / 60)
+        if self.tpm > 0:
+            self._tokens = min(float(self.tpm), self._tokens + elapsed * self.tpm / 60)
+
+    def _reserve(self, tokens):
+        """尝试占用一次请求与 tokens 个 token 的额度，返回还需等待的秒数，0 表示已占用"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = self._blocked_until - now
+            if self.rpm > 0 and self._requests < 1:
+                wait = max(wait, (1 - self._requests) * 60 / self.rpm)
+            if self.tpm > 0:
+                # 单个请求超过桶容量时，等桶满后放行
+                tokens = min(tokens, self.tpm)
+                if self._tokens < tokens:
+                    wait = max(wait, (tokens - self._tokens) * 60 / self.tpm)
+            if wait > 0:
+                return wait
+            if self.rpm > 0:
+                self._requests -= 1
+            if self.tpm > 0:
+                self._tokens -= tokens
+            return 0.0
+
+    def _record_wait(self, waited):
+        with self._lock:
+            self._stats['waits'] += 1
+            self._stats['wait_seconds'] += waited
+
+    @staticmethod
+    def _jitter(delay):
+        # 等待时间加少量随机抖动，避免多个请求在同一时刻一起醒来
+        return delay + random.uniform(0, min(delay, 1.0) * 0.2)
+
+    def wait(self, tokens=0):
+        waited = 0.0
+        while True:
+            delay = self._reserve(tokens)
+            if delay <= 0:
+                break
+            delay = self._jitter(delay)
+            time.sleep(delay)
+            waited += delay
+        if waited:
+            self._record_wait(waited)
+
+    async def wait_async(self, tokens=0):
+        waited = 0.0
+        while True:
+            delay = self._reserve(tokens)
+            if delay <= 0:
+                break
+            delay = self._jitter(delay)
+            await asyncio.sleep(delay)
+            waited += delay
+        if waited:
+            self._record_wait(waited)
+
+    def settle(self, reserved, used):
+        """请求完成后按实际用量修正预扣的 token：多扣的退回桶中，少扣的补扣"""
+        if self.tpm <= 0 or used is None:
+            return
+        with self._lock:
+            self._tokens = min(float(self.tpm), self._tokens + min(reserved, self.tpm) - used)
+
+    def block_for(self, seconds):
+        if not seconds or seconds <= 0:
+            return
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until > self._blocked_until:
+                self._blocked_until = until
+                self._stats['blocks'] += 1
+
+    def on_throttle(self, retry_after=None):
+        """收到 429 等限流错误：清空令牌桶，并按 Retry-After 暂停"""
+        with self._lock:
+            self._stats['throttled'] += 1
+            self._requests = min(self._requests, 0.0)
+            self._tokens = min(self._tokens, 0.0)
+        self.block_for(retry_after)
+
+    def update_from_headers(self, headers, status_code=None):
+        """根据响应头（OpenAI/DeepSeek 的 x-ratelimit-*，Anthropic 的 anthropic-ratelimit-*）更新额度"""
+        try:
+            for kind in ('requests', 'tokens'):
+                limit = _header_int(headers, f'x-ratelimit-limit-{kind}', f'anthropic-ratelimit-{kind}-limit')
+                remaining = _header_int(headers, f'x-ratelimit-remaining-{kind}',
+                                        f'anthropic-ratelimit-{kind}-remaining')
+                reset = _parse_reset(headers.get(f'x-ratelimit-reset-{kind}')
+                                     or headers.get(f'anthropic-ratelimit-{kind}-reset'))
+                if limit:
+                    with self._lock:
+                        if kind == 'requests' and not self._configured[0] and self.rpm != limit:
+                            self.rpm = limit
+                            self._requests = float(limit)
+                        elif kind == 'tokens' and not self._configured[1] and self.tpm != limit:
+                            self.tpm = limit
+                            self._tokens = float(limit)
+                if remaining == 0 and reset:
+                    self.block_for(reset)
+            if status_code == 429:
+                self.block_for(parse_retry_after(headers))
+        except Exception as e:
+            logger.debug(f'解析限流响应头失败: {e}')
+
+    def stats(self):
+        with self._lock:
+            blocked = max(self._blocked_until - time.monotonic(), 0.0)
+            return dict(self._stats, rpm=self.rpm, tpm=self.tpm, blocked_seconds=round(blocked, 2))
+
+
+def get_rate_limiter(provider):
+    """返回服务商对应的限流器，进程内共享"""
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(provider)
+        if limiter is None:
+            rpm, tpm = config.AI_RATE_LIMITS.get(provider, (config.AI_RPM, config.AI_TPM))
+            limiter = RateLimiter(provider, rpm, tpm)
+            _rate_limiters[provider] = limiter
+        return limiter
+
+
+def get_rate_limit_stats():
+    with _rate_limiters_lock:
+        limiters = dict(_rate_limiters)
+    return {provider: limiter.stats() for provider, limiter in limiters.items()}
+
+
+class LatencyHistogram:
+    """
+    单个服务商的请求耗时直方图
+
+    按输入 token 数分档（每档相差 4 倍）分别统计，桶边界按 1.5 倍等比增长；
+    每档样本数达到 decay_every 时计数减半，让分位数跟随服务商近期的表现。
+    """
+
+    BOUNDS = [0.25 * 1.5 ** i for i in range(22)]
+
+    def __init__(self, min_samples=20, decay_every=1000):
+        self.min_samples = min_samples
+        self.decay_every = decay_every
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    @staticmethod
+    def size_class(tokens):
+        if not tokens or tokens <= 256:
+            return 0
+        return min(int(math.log(tokens / 256, 4)) + 1, 6)
+
+    def record(self, seconds, tokens=0):
+        size_class = self.size_class(tokens)
+        with self._lock:
+            counts = self._counts.setdefault(size_class, [0] * (len(self.BOUNDS) + 1))
+            counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+            if sum(counts) >= self.decay_every:
+                self._counts[size_class] = [c // 2 for c in counts]
+
+    def quantile(self, q, tokens=0):
+        """返回该档请求耗时的 q 分位数（桶上界），样本不足时返回 None"""
+        return self._class_quantile(q, self.size_class(tokens))
+
+    def _class_quantile(self, q, size_class):
+        with self._lock:
+            counts = list(self._counts.get(size_class, ()))
+        total = sum(counts)
+        if total < max(self.min_samples, 1):
+            return None
+        target = q * total
+        seen = 0
+        for idx, count in enumerate(counts):
+            seen += count
+            if seen >= target:
+                return self.BOUNDS[idx] if idx < len(self.BOUNDS) else self.BOUNDS[-1] * 1.5
+        return self.BOUNDS[-1] * 1.5
+
+    def stats(self):
+        with self._lock:
+            totals = {size_class: sum(counts) for size_class, counts in self._counts.items()}
+        return {
+            f'class_{size_class}': {
+                'samples': total,
+                'p50': self._class_quantile(0.5, size_class),
+                'p95': self._class_quantile(0.95, size_class),
+            }
+            for size_class, total in sorted(totals.items())
+        }
+
+
+def get_latency_histogram(provider):
+    with _histograms_lock:
+        histogram = _histograms.get(provider)
+        if histogram is None:
+            histogram = LatencyHistogram(min_samples=config.AI_HEDGE_MIN_SAMPLES)
+            _histograms[provider] = histogram
+        return histogram
+
+
+def _count_hedge(name):
+    with _hedge_stats_lock:
+        _hedge_stats[name] += 1
+
+
+def get_hedge_stats():
+    with _hedge_stats_lock:
+        data = dict(_hedge_stats)
+    with _histograms_lock:
+        histograms = dict(_histograms)
+    data['latency'] = {provider: histogram.stats() for provider, histogram in histograms.items()}
+    return data
+
+
+def _provider_chain(api_type, api_key):
+    """
+    返回按顺序尝试的 (服务商, 密钥) 列表：首选服务商在前，其后为 AI_FAILOVER 中配置了密钥的服务商
+    """
+    chain = [(api_type, api_key)]
+    for provider in config.AI_FAILOVER:
+        if provider == api_type or any(provider == p for p, _ in chain):
+            continue
+        key = config.AI_API_KEYS.get(provider)
+        if key:
+            chain.append((provider, key))
+    return chain
+
+
+def _retry_policy(error, attempt):
+    """
+    判断错误是否需要重试
+
+    Returns:
+        tuple: (是否重试, 等待秒数, 是否被限流, Retry-After 秒数)
+    """
+    status = getattr(error, 'status_code', None)
+    response = getattr(error, 'response', None)
+    retry_after = parse_retry_after(getattr(response, 'headers', None))
+    # 429 限流；529 为 Anthropic 的服务过载
+    throttled = status in (429, 529)
+    if status is None:
+        retryable = not isinstance(error, (ValueError, TypeError))
+    else:
+        retryable = throttled or status in (408, 409) or status >= 500
+    if retry_after is not None:
+        delay = min(retry_after, config.AI_RETRY_MAX_BACKOFF_SECONDS)
+    else:
+        # full jitter：在 [0, 指数退避上限] 内随机取值，避免所有请求同时重试
+        cap = min(config.AI_RETRY_BACKOFF_SECONDS * (2 ** attempt), config.AI_RETRY_MAX_BACKOFF_SECONDS)
+        delay = random.uniform(cap / 2, cap) if throttled else random.uniform(0, cap)
+    return retryable, delay, throttled, retry_after
+
+
+def _request_tokens(text, prompt, api_type):
+    return count_tokens(prompt or '', api_type) + count_tokens(text or '', api_type)
+
+
+def _reserved_tokens(tokens):
+    """
+    限流器预扣的 token 数：服务商按输入加 max_tokens 计入 TPM，只扣输入会严重低估用量；
+    请求完成后再按响应中的 usage 修正（RateLimiter.settle）
+    """
+    return tokens + config.MODEL_MAX_TOKENS
+
+
+def _call_with_retries(fn, api_type, tokens=0):
+    limiter = get_rate_limiter(api_type)
+    reserved = _reserved_tokens(tokens)
     last_error = None
     for attempt in range(config.AI_RETRY_MAX + 1):
+        limiter.wait(reserved)
+        start = time.monotonic()
+        charge = {'used': None}
+        charge_token = _current_charge.set(charge)
         try:
-            return fn()
+            result = fn()
+            get_latency_histogram(api_type).record(time.monotonic() - start, tokens)
+            limiter.settle(reserved, charge['used'])
+            return result
         except Exception as e:
             last_error = e
-            if attempt >= config.AI_RETRY_MAX:
+            retryable, delay, throttled, retry_after = _retry_policy(e, attempt)
+            if throttled:
+                limiter.on_throttle(retry_after)
+            if not retryable or attempt >= config.AI_RETRY_MAX:
                 break
-            logger.warning(format_message(Codes.AI_CALL_FAIL, f'调用{api_type}失败，准备重试({attempt + 1}/{config.AI_RETRY_MAX})', str(e)))
-            _sleep_with_backoff(attempt)
+            logger.warning(format_message(Codes.AI_CALL_FAIL, f'调用{api_type}失败，{delay:.1f} 秒后重试({attempt + 1}/{config.AI_RETRY_MAX})', str(e)))
+            time.sleep(delay)
+        finally:
+            _current_charge.reset(charge_token)
     raise last_error
 
-def _call_deepseek_api(text, api_key, prompt):
+def _chat_messages(text, prompt, layout):
+    """OpenAI 兼容接口的消息列表"""
+    if layout == LAYOUT_PREFIX:
+        return [
+            {"role": "system", "content": PREFIX_SYSTEM_PROMPT},
+            {"role": "user", "content": f"{text}\n\n---\n{PREFIX_INSTRUCTION_HEADER}{prompt}"}
+        ]
+    return [
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": text}
+    ]
+
+def _chat_kwargs(model, text, prompt, layout, stream):
+    kwargs = dict(
+        model=model,
+        messages=_chat_messages(text, prompt, layout),
+        max_tokens=config.MODEL_MAX_TOKENS,
+        temperature=config.MODEL_TEMPERATURE,
+        stream=stream
+    )
+    if stream:
+        # 流式响应默认不返回用量，需要显式要求在最后一个分块中附带
+        kwargs['stream_options'] = {"include_usage": True}
+    return kwargs
+
+def _claude_kwargs(text, prompt, layout):
+    """
+    Claude 的请求参数；prefix 布局在文本块末尾加 cache_control 断点，
+    系统消息与文本作为缓存前缀，提示词放在断点之后
+    """
+    if layout == LAYOUT_PREFIX:
+        system = PREFIX_SYSTEM_PROMPT
+        content = [
+            {"type": "text", "text": text, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": f"{PREFIX_INSTRUCTION_HEADER}{prompt}"}
+        ]
+    else:
+        system = prompt
+        content = text
+    return dict(
+        model=config.CLAUDE_MODEL,
+        max_tokens=config.MODEL_MAX_TOKENS,
+        temperature=config.MODEL_TEMPERATURE,
+        system=system,
+        messages=[
+            {"role": "user", "content": content}
+        ]
+    )
+
+def _read_openai_stream(stream, on_delta, provider):
+    parts = []
+    usage = None
+    for chunk in stream:
+        if getattr(chunk, 'usage', None) is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            on_delta(delta)
+    _record_usage(provider, usage)
+    return ''.join(parts)
+
+def _call_deepseek_api(text, api_key, prompt, on_delta=None, layout=LAYOUT_SYSTEM):
     """
     调用DeepSeek API进行文本处理
     
@@ -31,24 +950,22 @@ def _call_deepseek_api(text, api_key, prompt):
         text (str): 要处理的文本
         api_key (str): API密钥
         prompt (str): 提示词
+        on_delta (callable): 传入时以流式方式请求，每收到一段内容调用一次
+        layout (str): 请求布局，LAYOUT_SYSTEM 或 LAYOUT_PREFIX
         
     Returns:
         str: API返回的处理结果
     """
-    client = OpenAI(api_key=api_key, base_url="https://api.deepseek.com")
+    client = get_client('deepseek', api_key, DEEPSEEK_BASE_URL)
     response = client.chat.completions.create(
-        model=config.DEEPSEEK_MODEL,
-        messages=[
-            {"role": "system", "content": prompt},
-            {"role": "user", "content": text}
-        ],
-        max_tokens=config.MODEL_MAX_TOKENS,
-        temperature=config.MODEL_TEMPERATURE,
-        stream=False
+        **_chat_kwargs(config.DEEPSEEK_MODEL, text, prompt, layout, on_delta is not None)
     )
+    if on_delta is not None:
+        return _read_openai_stream(response, on_delta, 'deepseek')
+    _record_usage('deepseek', response.usage)
     return response.choices[0].message.content
 
-def _call_claude_api(text, api_key, prompt):
+def _call_claude_api(text, api_key, prompt, on_delta=None, layout=LAYOUT_SYSTEM):
     """
     调用Claude API进行文本处理
     
@@ -56,28 +973,27 @@ def _call_claude_api(text, api_key, prompt):
         text (str): 要处理的文本
         api_key (str): API密钥
         prompt (str): 提示词
+        on_delta (callable): 传入时以流式方式请求，每收到一段内容调用一次
+        layout (str): 请求布局，LAYOUT_SYSTEM 或 LAYOUT_PREFIX
         
     Returns:
         str: API返回的处理结果
     """
-    try:
-        import anthropic
-    except Exception as e:
-        raise RuntimeError("未安装 anthropic 依赖，无法使用 Claude API") from e
-
-    client = anthropic.Anthropic(api_key=api_key)
-    response = client.messages.create(
-        model=config.CLAUDE_MODEL,
-        max_tokens=config.MODEL_MAX_TOKENS,
-        temperature=config.MODEL_TEMPERATURE,
-        system=prompt,
-        messages=[
-            {"role": "user", "content": text}
-        ]
-    )
+    client = get_client('claude', api_key)
+    kwargs = _claude_kwargs(text, prompt, layout)
+    if on_delta is not None:
+        parts = []
+        with client.messages.stream(**kwargs) as stream:
+            for delta in stream.text_stream:
+                parts.append(delta)
+                on_delta(delta)
+            _record_usage('claude', stream.get_final_message().usage)
+        return ''.join(parts)
+    response = client.messages.create(**kwargs)
+    _record_usage('claude', response.usage)
     return response.content[0].text
 
-def _call_openai_api(text, api_key, prompt):
+def _call_openai_api(text, api_key, prompt, on_delta=None, layout=LAYOUT_SYSTEM):
     """
     调用OpenAI (ChatGPT) API进行文本处理
     
@@ -85,23 +1001,46 @@ def _call_openai_api(text, api_key, prompt):
         text (str): 要处理的文本
         api_key (str): API密钥
         prompt (str): 提示词
+        on_delta (callable): 传入时以流式方式请求，每收到一段内容调用一次
+        layout (str): 请求布局，LAYOUT_SYSTEM 或 LAYOUT_PREFIX
         
     Returns:
         str: API返回的处理结果
     """
-    client = OpenAI(api_key=api_key)
+    client = get_client('openai', api_key)
+    # 默认使用GPT-4o模型，可根据需要调整
     response = client.chat.completions.create(
-        model=config.OPENAI_MODEL,  # 默认使用GPT-4o模型，可根据需要调整
-        messages=[
-            {"role": "system", "content": prompt},
-            {"role": "user", "content": text}
-        ],
-        max_tokens=config.MODEL_MAX_TOKENS,
-        temperature=config.MODEL_TEMPERATURE
+        **_chat_kwargs(config.OPENAI_MODEL, text, prompt, layout, on_delta is not None)
     )
+    if on_delta is not None:
+        return _read_openai_stream(response, on_delta, 'openai')
+    _record_usage('openai', response.usage)
     return response.choices[0].message.content
 
-def call_ai_api(text, api_key, prompt, api_type='deepseek'):
+def get_model_name(api_type):
+    """返回指定API类型实际使用的模型名称"""
+    return {
+        'deepseek': config.DEEPSEEK_MODEL,
+        'claude': config.CLAUDE_MODEL,
+        'openai': config.OPENAI_MODEL,
+    }.get(api_type, api_type)
+
+def _call_provider(text, api_key, prompt, api_type, on_delta=None, layout=LAYOUT_SYSTEM):
+    """调用单个服务商（含限流与重试），失败时抛出异常"""
+    def _call():
+        if on_delta is not None:
+            on_delta(None)
+        if api_type == 'deepseek':
+            return _call_deepseek_api(text, api_key, prompt, on_delta, layout)
+        if api_type == 'claude':
+            return _call_claude_api(text, api_key, prompt, on_delta, layout)
+        if api_type == 'openai':
+            return _call_openai_api(text, api_key, prompt, on_delta, layout)
+        raise ValueError(f'不支持的API类型: {api_type}')
+
+    return _call_with_retries(_call, api_type, _request_tokens(text, prompt, api_type))
+
+def call_ai_api(text, api_key, prompt, api_type='deepseek', on_delta=None, layout=LAYOUT_SYSTEM):
     """
     调用AI API进行文本处理，支持DeepSeek、Claude和OpenAI
     
@@ -110,6 +1049,10 @@ def call_ai_api(text, api_key, prompt, api_type='deepseek'):
         api_key (str): API密钥
         prompt (str): 提示词
         api_type (str): API类型，支持'deepseek'、'claude'和'openai'
+        on_delta (callable): 传入时以流式方式请求，on_delta(delta) 在每收到一段内容时调用；
+            重试前会先调用 on_delta(None)，表示之前收到的内容作废
+        layout (str): 请求布局。LAYOUT_SYSTEM 把提示词放在系统消息；LAYOUT_PREFIX 把文本放在前、
+            提示词放在最后，同一文本配不同提示词的请求共享可缓存的前缀（Claude 会加 cache_control 断点）
     
     Returns:
         str: API返回的处理结果
@@ -121,18 +1064,479 @@ def call_ai_api(text, api_key, prompt, api_type='deepseek'):
             logger.error(format_message(Codes.AI_KEY_MISSING, 'API密钥为空'))
             return None
 
-        def _call():
-            if api_type == 'deepseek':
-                return _call_deepseek_api(text, api_key, prompt)
-            if api_type == 'claude':
-                return _call_claude_api(text, api_key, prompt)
-            if api_type == 'openai':
-                return _call_openai_api(text, api_key, prompt)
-            raise ValueError(f'不支持的API类型: {api_type}')
+        cache, cache_key = _cache_key_for(text, prompt, api_type, layout)
+        if cache is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                logger.debug(f'AI响应缓存命中，类型: {api_type}，返回内容长度: {len(cached)}')
+                return _replay_cached(cached, on_delta)
 
-        result = _call_with_retries(_call, api_type)
+        # 首选服务商重试仍失败时，按 AI_FAILOVER 依次切换
+        chain = _provider_chain(api_type, api_key)
+        last_error = None
+        result = None
+        for idx, (provider, key) in enumerate(chain):
+            try:
+                result = _call_provider(text, key, prompt, provider, on_delta, layout)
+                answered_by = provider
+                break
+            except Exception as e:
+                last_error = e
+                if idx + 1 < len(chain):
+                    _count_hedge('failovers')
+                    logger.warning(format_message(Codes.AI_CALL_FAIL, f'{provider} 调用失败，切换到 {chain[idx + 1][0]}', str(e)))
+        else:
+            raise last_error
         logger.debug(f'API调用成功，返回内容长度: {len(result) if result else 0}')
+        if cache is not None and result:
+            if answered_by != api_type:
+                # 故障转移到其他服务商时，按实际服务商的键缓存
+                cache_key = _cache_key_for(text, prompt, answered_by, layout)[1]
+            cache.put(cache_key, result, provider=answered_by, model=get_model_name(answered_by))
         return result
     except Exception as e:
         logger.error(format_message(Codes.AI_CALL_FAIL, '调用API时出错', str(e)))
         return None
+
+
+async def _acall_with_retries(fn, api_type, tokens=0):
+    """
+    异步重试：每次尝试先经过限流器，再占用引擎的并发槽位；
+    成功时并发上限加性增长，被限流时乘性减小，重试等待期间不占用槽位
+    """
+    limiter = get_rate_limiter(api_type)
+    engine = get_ai_engine()
+    reserved = _reserved_tokens(tokens)
+    last_error = None
+    for attempt in range(config.AI_RETRY_MAX + 1):
+        await limiter.wait_async(reserved)
+        async with engine.slot(api_type) as limit:
+            start = time.monotonic()
+            charge = {'used': None}
+            charge_token = _current_charge.set(charge)
+            try:
+                result = await fn()
+            except Exception as e:
+                last_error = e
+                retryable, delay, throttled, retry_after = _retry_policy(e, attempt)
+                if throttled:
+                    limiter.on_throttle(retry_after)
+                    limit.on_throttle()
+            else:
+                limit.on_success()
+                get_latency_histogram(api_type).record(time.monotonic() - start, tokens)
+                limiter.settle(reserved, charge['used'])
+                return result
+            finally:
+                _current_charge.reset(charge_token)
+        if not retryable or attempt >= config.AI_RETRY_MAX:
+            break
+        logger.warning(format_message(Codes.AI_CALL_FAIL, f'调用{api_type}失败，{delay:.1f} 秒后重试({attempt + 1}/{config.AI_RETRY_MAX})', str(last_error)))
+        await asyncio.sleep(delay)
+    raise last_error
+
+async def _aread_openai_stream(stream, on_delta, provider):
+    parts = []
+    usage = None
+    async for chunk in stream:
+        if getattr(chunk, 'usage', None) is not None:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            on_delta(delta)
+    _record_usage(provider, usage)
+    return ''.join(parts)
+
+async def _acall_deepseek_api(text, api_key, prompt, on_delta=None, layout=LAYOUT_SYSTEM):
+    """_call_deepseek_api 的异步版本"""
+    client = get_async_client('deepseek', api_key, DEEPSEEK_BASE_URL)
+    response = await client.chat.completions.create(
+        **_chat_kwargs(config.DEEPSEEK_MODEL, text, prompt, layout, on_delta is not None)
+    )
+    if on_delta is not None:
+        return await _aread_openai_stream(response, on_delta, 'deepseek')
+    _record_usage('deepseek', response.usage)
+    return response.choices[0].message.content
+
+async def _acall_claude_api(text, api_key, prompt, on_delta=None, layout=LAYOUT_SYSTEM):
+    """_call_claude_api 的异步版本"""
+    client = get_async_client('claude', api_key)
+    kwargs = _claude_kwargs(text, prompt, layout)
+    if on_delta is not None:
+        parts = []
+        async with client.messages.stream(**kwargs) as stream:
+            async for delta in stream.text_stream:
+                parts.append(delta)
+                on_delta(delta)
+            _record_usage('claude', (await stream.get_final_message()).usage)
+        return ''.join(parts)
+    response = await client.messages.create(**kwargs)
+    _record_usage('claude', response.usage)
+    return response.content[0].text
+
+async def _acall_openai_api(text, api_key, prompt, on_delta=None, layout=LAYOUT_SYSTEM):
+    """_call_openai_api 的异步版本"""
+    client = get_async_client('openai', api_key)
+    response = await client.chat.completions.create(
+        **_chat_kwargs(config.OPENAI_MODEL, text, prompt, layout, on_delta is not None)
+    )
+    if on_delta is not None:
+        return await _aread_openai_stream(response, on_delta, 'openai')
+    _record_usage('openai', response.usage)
+    return response.choices[0].message.content
+
+async def _acall_provider(text, api_key, prompt, api_type, on_delta=None, layout=LAYOUT_SYSTEM):
+    """异步调用单个服务商（含限流、并发控制与重试），失败时抛出异常"""
+    def _call():
+        if on_delta is not None:
+            on_delta(None)
+        if api_type == 'deepseek':
+            return _acall_deepseek_api(text, api_key, prompt, on_delta, layout)
+        if api_type == 'claude':
+            return _acall_claude_api(text, api_key, prompt, on_delta, layout)
+        if api_type == 'openai':
+            return _acall_openai_api(text, api_key, prompt, on_delta, layout)
+        raise ValueError(f'不支持的API类型: {api_type}')
+
+    return await _acall_with_retries(_call, api_type, _request_tokens(text, prompt, api_type))
+
+def _hedge_delay(api_type, tokens):
+    """对冲等待时间：该服务商同档请求耗时的 AI_HEDGE_QUANTILE 分位数，样本不足时用固定值，None 表示不对冲"""
+    if not config.AI_HEDGE_ENABLED:
+        return None
+    delay = get_latency_histogram(api_type).quantile(config.AI_HEDGE_QUANTILE, tokens)
+    if delay is None:
+        delay = config.AI_HEDGE_DELAY_SECONDS or None
+    return delay
+
+def _hedge_allowed():
+    # 对冲请求数不超过总请求数的 AI_HEDGE_MAX_RATIO，避免服务商整体变慢时请求量翻倍
+    with _hedge_stats_lock:
+        return _hedge_stats['hedged'] < config.AI_HEDGE_MAX_RATIO * max(_hedge_stats['requests'], 1)
+
+async def _acall_hedged(text, api_key, prompt, api_type, alternates, on_delta=None, layout=LAYOUT_SYSTEM):
+    """
+    对冲请求：首个请求超过 p95 仍未返回时，向同一服务商（或 AI_HEDGE_TARGET=alternate 时的下一个备选服务商）
+    再发一个请求，取先成功的结果并取消另一个。对冲请求不流式输出，胜出时整体回放给 on_delta。
+
+    Returns:
+        tuple: (结果, 实际给出结果的服务商)
+    """
+    delay = _hedge_delay(api_type, _request_tokens(text, prompt, api_type))
+    if delay is None:
+        return await _acall_provider(text, api_key, prompt, api_type, on_delta, layout), api_type
+
+    primary = asyncio.ensure_future(_acall_provider(text, api_key, prompt, api_type, on_delta, layout))
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done or not _hedge_allowed():
+        return await primary, api_type
+
+    target, target_key = api_type, api_key
+    if config.AI_HEDGE_TARGET == 'alternate' and alternates:
+        target, target_key = alternates[0]
+    _count_hedge('hedged')
+    logger.info(f'{api_type} 请求超过 {delay:.1f} 秒未返回，向 {target} 发出对冲请求')
+    hedge = asyncio.ensure_future(_acall_provider(text, target_key, prompt, target, layout=layout))
+
+    pending = {primary, hedge}
+    errors = []
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is not None:
+                errors.append(task.exception())
+                continue
+            for other in pending:
+                other.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            result = task.result()
+            if task is hedge:
+                _count_hedge('hedge_wins')
+                _replay_cached(result, on_delta)
+                return result, target
+            return result, api_type
+    raise errors[0]
+
+async def acall_ai_api(text, api_key, prompt, api_type='deepseek', on_delta=None, layout=LAYOUT_SYSTEM):
+    """
+    call_ai_api 的异步版本，必须在 AI 引擎的事件循环内运行
+
+    同一服务商的在途请求数受引擎的自适应并发上限限制，失败时返回 None。
+    on_delta、layout 的含义与 call_ai_api 相同，on_delta 在事件循环线程内同步调用，不应阻塞。
+    """
+    engine = get_ai_engine()
+    try:
+        logger.debug(f'开始调用AI API（异步），类型: {api_type}，输入文本长度: {len(text)}')
+
+        if not api_key:
+            logger.error(format_message(Codes.AI_KEY_MISSING, 'API密钥为空'))
+            return None
+
+        # 缓存命中不占用并发槽位；SQLite 读写放到线程中执行，不阻塞事件循环上的其他请求
+        cache, cache_key = _cache_key_for(text, prompt, api_type, layout)
+        if cache is not None:
+            cached = await asyncio.to_thread(cache.get, cache_key)
+            if cached is not None:
+                logger.debug(f'AI响应缓存命中，类型: {api_type}，返回内容长度: {len(cached)}')
+                return _replay_cached(cached, on_delta)
+
+        _count_hedge('requests')
+        chain = _provider_chain(api_type, api_key)
+        last_error = None
+        result = None
+        for idx, (provider, key) in enumerate(chain):
+            try:
+                result, answered_by = await _acall_hedged(text, key, prompt, provider, chain[idx + 1:],
+                                                          on_delta, layout)
+                break
+            except Exception as e:
+                last_error = e
+                if idx + 1 < len(chain):
+                    _count_hedge('failovers')
+                    logger.warning(format_message(Codes.AI_CALL_FAIL, f'{provider} 调用失败，切换到 {chain[idx + 1][0]}', str(e)))
+        else:
+            raise last_error
+        logger.debug(f'API调用成功，返回内容长度: {len(result) if result else 0}')
+        if cache is not None and result:
+            if answered_by != api_type:
+                # 故障转移或对冲到其他服务商时，按实际服务商的键缓存，避免之后的首选服务商请求命中别家的结果
+                cache_key = _cache_key_for(text, prompt, answered_by, layout)[1]
+            await asyncio.to_thread(cache.put, cache_key, result, provider=answered_by,
+                                    model=get_model_name(answered_by))
+        return result
+    except Exception as e:
+        engine.record_failure()
+        logger.error(format_message(Codes.AI_CALL_FAIL, '调用API时出错', str(e)))
+        return None
+
+
+class AdaptiveLimit:
+    """
+    AIMD 自适应并发上限，只能在引擎事件循环内使用
+
+    每次成功上限加 1/limit（大约每完成一轮请求加 1），被限流时减半；
+    减半后 cooldown 秒内不再重复减半，避免同一波 429 把上限一路压到最小值。
+    """
+
+    def __init__(self, initial, minimum=1, maximum=None, adaptive=True, cooldown=5.0):
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum or initial))
+        self.limit = float(min(max(int(initial), self.minimum), self.maximum))
+        self.adaptive = adaptive
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.increases = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._cond = None
+
+    def _condition(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def acquire(self):
+        cond = self._condition()
+        async with cond:
+            await cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        cond = self._condition()
+        async with cond:
+            self.in_flight -= 1
+            cond.notify_all()
+
+    def on_success(self):
+        if not self.adaptive or self.limit >= self.maximum:
+            return
+        before = int(self.limit)
+        self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+        if int(self.limit) > before:
+            self.increases += 1
+
+    def on_throttle(self):
+        if not self.adaptive:
+            return
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.minimum), self.limit / 2)
+        self.decreases += 1
+        logger.info(f'服务商限流，并发上限降为 {int(self.limit)}')
+
+    def stats(self):
+        return {
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'increases': self.increases,
+            'decreases': self.decreases,
+        }
+
+
+class _Slot:
+    """占用一个自适应并发槽位并计入引擎统计"""
+
+    def __init__(self, engine, limit):
+        self.engine = engine
+        self.limit = limit
+
+    async def __aenter__(self):
+        await self.limit.acquire()
+        self.engine._enter()
+        return self.limit
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.engine._exit()
+        await self.limit.release()
+        return False
+
+
+class AIEngine:
+    """
+    基于 asyncio 的 AI 调用引擎
+
+    后台线程中常驻一个事件循环，所有批量请求都作为协程在这个循环里并发执行，
+    单个线程即可驱动成百上千个在途请求。每个服务商一个 AIMD 自适应并发上限，
+    从 concurrency 起步，服务商健康时逐步增长到 max_concurrency，被限流时减半。
+    同步代码通过 run() / map() 提交并等待结果。
+    """
+
+    def __init__(self, concurrency, min_concurrency=1, max_concurrency=None, adaptive=True):
+        self.concurrency = max(1, int(concurrency))
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency or self.concurrency
+        self.adaptive = adaptive
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._limits = {}
+        self._stats = {'started': 0, 'completed': 0, 'failed': 0, 'in_flight': 0, 'peak_in_flight': 0}
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self._run_loop, args=(loop,), name='ai-engine', daemon=True)
+                thread.start()
+                self._loop = loop
+                self._thread = thread
+            return self._loop
+
+    @staticmethod
+    def _run_loop(loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def slot(self, api_type):
+        """返回服务商对应的并发槽位，只能在引擎事件循环内使用"""
+        limit = self._limits.get(api_type)
+        if limit is None:
+            limit = AdaptiveLimit(self.concurrency, self.min_concurrency, self.max_concurrency, self.adaptive)
+            self._limits[api_type] = limit
+        return _Slot(self, limit)
+
+    def _enter(self):
+        with self._lock:
+            self._stats['started'] += 1
+            self._stats['in_flight'] += 1
+            self._stats['peak_in_flight'] = max(self._stats['peak_in_flight'], self._stats['in_flight'])
+
+    def _exit(self):
+        with self._lock:
+            self._stats['in_flight'] -= 1
+            self._stats['completed'] += 1
+
+    def record_failure(self):
+        with self._lock:
+            self._stats['failed'] += 1
+
+    def run(self, coro):
+        """在引擎事件循环中执行协程并阻塞等待结果"""
+        loop = self._ensure_loop()
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError('不能在 AI 引擎的事件循环线程内同步等待')
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    def map(self, requests, api_key, api_type='deepseek', on_result=None, on_delta=None, layout=LAYOUT_SYSTEM):
+        """
+        并发执行一批请求
+
+        Args:
+            requests (list): [(text, prompt), ...]
+            on_result (callable): on_result(idx, result)，每个请求完成时在线程池中调用，
+                可用于及时落盘
+            on_delta (callable): 传入时以流式方式请求，on_delta(idx, delta) 在事件循环线程内调用
+            layout (str): 请求布局，见 call_ai_api
+
+        Returns:
+            list: 与 requests 顺序一致的结果，失败的请求为 None
+        """
+        async def _one(idx, text, prompt):
+            delta_cb = (lambda delta: on_delta(idx, delta)) if on_delta is not None else None
+            result = await acall_ai_api(text, api_key, prompt, api_type, on_delta=delta_cb, layout=layout)
+            if on_result is not None:
+                try:
+                    await asyncio.to_thread(on_result, idx, result)
+                except Exception as e:
+                    logger.error(format_message(Codes.INTERNAL, f'处理第 {idx} 个请求结果时出错', str(e)))
+            return result
+
+        # 用量计入调用方所在任务的 UsageMeter
+        meters = _current_usage.get()
+
+        async def _all():
+            _current_usage.set(meters)
+            return await asyncio.gather(*(_one(idx, text, prompt) for idx, (text, prompt) in enumerate(requests)))
+
+        return self.run(_all())
+
+    def close(self, http_clients):
+        """关闭绑定在事件循环上的异步 httpx 客户端"""
+        loop = self._loop
+        if loop is None or not loop.is_running():
+            return
+
+        async def _close():
+            await asyncio.gather(*(c.aclose() for c in http_clients), return_exceptions=True)
+
+        try:
+            asyncio.run_coroutine_threadsafe(_close(), loop).result(timeout=5)
+        except Exception:
+            pass
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats, concurrency=self.concurrency)
+        data['limits'] = {api_type: limit.stats() for api_type, limit in list(self._limits.items())}
+        return data
+
+
+def get_ai_engine():
+    """返回进程内共享的 AI 引擎"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AIEngine(
+                config.AI_CONCURRENCY,
+                min_concurrency=config.AI_CONCURRENCY_MIN,
+                max_concurrency=config.AI_CONCURRENCY_MAX,
+                adaptive=config.AI_ADAPTIVE_CONCURRENCY,
+            )
+        return _engine
+
+def call_ai_batch(requests, api_key, api_type='deepseek', on_result=None, on_delta=None, layout=LAYOUT_SYSTEM):
+    """
+    并发调用AI API处理一批 (text, prompt) 请求的同步入口，参数见 AIEngine.map
+
+    Returns:
+        list: 与 requests 顺序一致的结果，失败的请求为 None
+    """
+    if not requests:
+        return []
+    return get_ai_engine().map(requests, api_key, api_type, on_result=on_result, on_delta=on_delta, layout=layout)
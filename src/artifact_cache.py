@@ -0,0 +1,199 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import config
+from .errors import Codes, format_message
+
+logger = logging.getLogger(__name__)
+
+META_FILE = 'meta.json'
+
+_file_hash_memo = {}
+_file_hash_lock = threading.Lock()
+
+
+def hash_file(path, block_size=1024 * 1024):
+    """
+    计算文件内容的 sha256，按 (路径, 大小, 修改时间) 记忆，同一文件不会重复计算
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    memo_key = (path, st.st_size, st.st_mtime_ns)
+    with _file_hash_lock:
+        cached = _file_hash_memo.get(memo_key)
+    if cached:
+        return cached
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+    value = digest.hexdigest()
+    with _file_hash_lock:
+        _file_hash_memo[memo_key] = value
+    return value
+
+
+def make_key(step, input_hash, params):
+    """由步骤名、输入内容哈希与步骤参数生成缓存键"""
+    payload = json.dumps({'step': step, 'input': input_hash, 'params': params},
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ArtifactCache:
+    """
+    按内容寻址的步骤产物缓存
+
+    每个条目是 root/<key[:2]>/<key>/ 目录，内含若干产物文件与 meta.json。
+    总大小超过上限时按最近使用时间淘汰。
+    """
+
+    def __init__(self, root, max_bytes=0):
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'saved_seconds': 0.0}
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key, label=''):
+        """
+        查找缓存条目
+
+        Returns:
+            dict or None: {'files': {名称: 路径}, 'meta': dict}
+        """
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, META_FILE)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            files = {name: os.path.join(entry_dir, fname) for name, fname in meta.get('files', {}).items()}
+            if not all(os.path.exists(p) for p in files.values()):
+                raise FileNotFoundError(entry_dir)
+        except (OSError, ValueError):
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+
+        # 更新访问时间，用于 LRU 淘汰
+        try:
+            os.utime(meta_path, None)
+        except OSError:
+            pass
+        saved = float(meta.get('elapsed') or 0.0)
+        with self._lock:
+            self._stats['hits'] += 1
+            self._stats['saved_seconds'] += saved
+        logger.info(f'产物缓存命中{("（" + label + "）") if label else ""}，节省约 {saved:.2f} 秒')
+        return {'files': files, 'meta': meta}
+
+    def path(self, key, name):
+        """条目中某个产物文件的路径，条目或文件不存在时返回 None；不计入命中统计"""
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, META_FILE), 'r', encoding='utf-8') as f:
+                fname = json.load(f).get('files', {}).get(name)
+        except (OSError, ValueError):
+            return None
+        if not fname:
+            return None
+        path = os.path.join(entry_dir, fname)
+        return path if os.path.exists(path) else None
+
+    def put(self, key, files, elapsed=0.0, **meta):
+        """
+        写入缓存条目
+
+        Args:
+            key (str): 缓存键
+            files (dict): {名称: 源文件路径}，文件会被复制进缓存
+            elapsed (float): 生成该产物花费的时间，命中时用于统计节省的时间
+        """
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f'{entry_dir}.tmp-{os.getpid()}-{threading.get_ident()}'
+        try:
+            os.makedirs(tmp_dir, exist_ok=True)
+            stored = {}
+            for name, src in files.items():
+                fname = f'{name}{os.path.splitext(src)[1]}'
+                shutil.copy2(src, os.path.join(tmp_dir, fname))
+                stored[name] = fname
+            meta = dict(meta, files=stored, elapsed=elapsed, created=time.time())
+            with open(os.path.join(tmp_dir, META_FILE), 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+        except Exception as e:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            logger.warning(format_message(Codes.FILE_IO, '写入产物缓存失败', str(e)))
+            return False
+        with self._lock:
+            self._stats['stores'] += 1
+        self.evict()
+        return True
+
+    def evict(self):
+        if self.max_bytes <= 0 or not os.path.exists(self.root):
+            return
+        entries = []
+        total = 0
+        for shard in os.listdir(self.root):
+            shard_dir = os.path.join(self.root, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for key in os.listdir(shard_dir):
+                entry_dir = os.path.join(shard_dir, key)
+                meta_path = os.path.join(entry_dir, META_FILE)
+                if not os.path.exists(meta_path):
+                    continue
+                size = sum(
+                    os.path.getsize(os.path.join(entry_dir, f))
+                    for f in os.listdir(entry_dir)
+                    if os.path.isfile(os.path.join(entry_dir, f))
+                )
+                entries.append((os.path.getmtime(meta_path), size, entry_dir))
+                total += size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        evicted = 0
+        for _, size, entry_dir in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._stats['evictions'] += evicted
+        logger.info(f'产物缓存超出上限，已淘汰 {evicted} 个条目，当前约 {total / 1024 / 1024:.0f} MB')
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_artifact_cache():
+    """返回进程内共享的产物缓存，未启用时返回 None"""
+    global _cache
+    if not config.ARTIFACT_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            root = config.ARTIFACT_CACHE_DIR or os.path.join(config.TEMP_DIR, 'cache')
+            _cache = ArtifactCache(root, max_bytes=config.ARTIFACT_CACHE_MAX_MB * 1024 * 1024)
+        return _cache
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+from .errors import Codes, format_message
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = 'state.json'
+LOCK_SUFFIX = '.lock'
+
+
+def _write_atomic(path, text):
+    """先写临时文件再改名，进程中途退出不会留下写了一半的分块"""
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _lock_exclusive(f, blocking=True):
+    """对打开的文件加独占锁，各进程、同一进程的各线程之间互斥；blocking=False 时拿不到锁返回 False"""
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        except OSError:
+            if blocking:
+                raise
+            return False
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def _read(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class ChunkCheckpoint:
+    """
+    文本修正润色的分块检查点
+
+    每个任务一个目录 root/<key>，key 由文本、提示词与影响分块和结果的参数计算，
+    内含 chunk_{idx}_original.txt、chunk_{idx}_processed.txt 与记录分块总数和失败分块的 state.json。
+    重新执行时已有处理结果（且原始分块一致）的分块直接读取，只请求缺失或失败的分块；
+    全部成功后目录被删除。
+
+    同一文本可能被多个任务同时处理，目录在 locked() 期间由 root/<key>.lock 独占，
+    后到的任务等待前一个结束后再读取检查点，不会删掉别人正在写的分块。
+    """
+
+    def __init__(self, root, key):
+        self.key = key
+        self.dir = os.path.join(root, key)
+        self.lock_path = f'{self.dir}{LOCK_SUFFIX}'
+
+    @contextmanager
+    def locked(self):
+        """在 with 块内独占检查点目录"""
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        with open(self.lock_path, 'a+') as f:
+            if not _lock_exclusive(f, blocking=False):
+                logger.info('另一个任务正在处理相同的文本，等待其完成后再读取分块检查点')
+                _lock_exclusive(f)
+            # 更新锁文件的修改时间，prune_checkpoints 只删除长期未使用的锁文件
+            os.utime(self.lock_path, None)
+            # 文件关闭时锁随之释放
+            yield self
+
+    @staticmethod
+    def make_key(text, prompt, **params):
+        payload = json.dumps({'text': text, 'prompt': prompt, 'params': params},
+                             sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+    def _path(self, idx, kind):
+        return os.path.join(self.dir, f'chunk_{idx}_{kind}.txt')
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.dir, STATE_FILE))
+
+    def state(self):
+        try:
+            with open(os.path.join(self.dir, STATE_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_state(self, total, failed):
+        state = {'total': total, 'failed': sorted(failed), 'updated': time.time()}
+        _write_atomic(os.path.join(self.dir, STATE_FILE), json.dumps(state, ensure_ascii=False))
+
+    def prepare(self, chunks):
+        """
+        写入原始分块并读取已完成的结果
+
+        Returns:
+            dict: {idx: 已处理的文本}
+        """
+        os.makedirs(self.dir, exist_ok=True)
+        previous = self.state() or {}
+        done = {}
+        for idx, chunk in enumerate(chunks):
+            original_path = self._path(idx, 'original')
+            if _read(original_path) == chunk:
+                processed = _read(self._path(idx, 'processed'))
+                if processed:
+                    done[idx] = processed
+                    continue
+            else:
+                _write_atomic(original_path, chunk)
+        if previous.get('total') is None:
+            self._save_state(len(chunks), [])
+        return done
+
+    def save(self, idx, processed_text):
+        _write_atomic(self._path(idx, 'processed'), processed_text)
+
+    def finish(self, total, failed):
+        """记录本次的失败分块；全部成功时删除检查点目录"""
+        if failed:
+            self._save_state(total, failed)
+            return
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def prune_checkpoints(root, ttl):
+    """删除超过 ttl 秒未更新的检查点（被放弃的任务）及其锁文件"""
+    if ttl <= 0 or not os.path.isdir(root):
+        return
+    cutoff = time.time() - ttl
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        state_path = os.path.join(path, STATE_FILE)
+        try:
+            if name.endswith(LOCK_SUFFIX):
+                if os.path.getmtime(path) < cutoff and not os.path.isdir(path[:-len(LOCK_SUFFIX)]):
+                    os.remove(path)
+                continue
+            if os.path.isdir(path) and os.path.getmtime(state_path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+                logger.debug(f'删除过期的分块检查点: {path}')
+        except OSError:
+            continue
+
+
+def get_checkpoint(text, prompt, **params):
+    """返回 text/prompt/params 对应的检查点，顺便清理过期的检查点"""
+    root = config.FIX_CHECKPOINT_DIR or os.path.join(config.TEMP_DIR, 'split')
+    try:
+        prune_checkpoints(root, config.FIX_CHECKPOINT_TTL_DAYS * 86400)
+    except Exception as e:
+        logger.warning(format_message(Codes.FILE_IO, '清理分块检查点失败', str(e)))
+    return ChunkCheckpoint(root, ChunkCheckpoint.make_key(text, prompt, **params))
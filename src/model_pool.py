@@ -0,0 +1,276 @@
+import gc
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import config
+from .errors import Codes, format_message
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_model_bytes(model):
+    """
+    估算模型占用的内存（字节），仅统计 torch 参数与 buffer
+
+    whisper 模型本身就是 nn.Module；funasr 的 AutoModel 把主模型和 vad/punc 模型
+    分别挂在 model / vad_model / punc_model 属性上，这里一并统计。无法识别时返回 0。
+    """
+    modules = []
+    if hasattr(model, "parameters"):
+        modules.append(model)
+    else:
+        for attr in ("model", "vad_model", "punc_model", "spk_model"):
+            sub = getattr(model, attr, None)
+            if sub is not None and hasattr(sub, "parameters"):
+                modules.append(sub)
+
+    total = 0
+    for module in modules:
+        try:
+            for p in module.parameters():
+                total += p.numel() * p.element_size()
+            for b in module.buffers():
+                total += b.numel() * b.element_size()
+        except Exception:
+            continue
+    return total
+
+
+class _PoolEntry:
+    def __init__(self, model, size_bytes, load_time):
+        self.model = model
+        self.size_bytes = size_bytes
+        self.load_time = load_time
+        self.last_used = time.time()
+        self.hits = 0
+        # 同一个模型实例不保证线程安全（whisper 会在推理时挂 kv-cache hook），
+        # 因此同一时刻只允许一个调用方使用，同一模型的并发转写各自使用一个实例
+        self.in_use = 0
+
+
+class ModelPool:
+    """
+    常驻的语音转写模型池
+
+    以 (model_type, model_size, device, ...) 为键缓存已加载的模型，按 LRU 与空闲超时淘汰，
+    并受内存预算与模型数量上限约束。CLI 与 Web 任务在同一进程内共享同一个池。
+
+    每个实例同一时刻只交给一个调用方；同一个键最多加载 max_instances 个实例（与调度器的转写槽位数一致），
+    实例都在使用中且已达上限时等待空闲实例。
+    """
+
+    def __init__(self, memory_budget_mb=0, idle_ttl=0, max_models=0, max_instances=1):
+        self.memory_budget = int(memory_budget_mb) * 1024 * 1024
+        self.idle_ttl = float(idle_ttl)
+        self.max_models = int(max_models)
+        self.max_instances = max(1, int(max_instances))
+        # 键为 (模型键, 实例序号)，按最近使用顺序排列
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
+        self._loading = {}
+        self._next_index = 0
+        self._reaper = None
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "waits": 0,
+            "evictions": 0,
+            "load_seconds": 0.0,
+        }
+
+    @contextmanager
+    def use(self, key, loader):
+        """
+        获取一个空闲的模型实例并在 with 块内独占使用，没有空闲实例时调用 loader() 加载
+
+        Args:
+            key (tuple): 模型键
+            loader (callable): 无参函数，返回已加载的模型
+        """
+        entry = self._acquire(key, loader)
+        try:
+            yield entry.model
+        finally:
+            with self._cond:
+                entry.in_use -= 1
+                entry.last_used = time.time()
+                self._cond.notify_all()
+            self._evict()
+
+    def _acquire(self, key, loader):
+        waited = False
+        with self._cond:
+            while True:
+                for instance_key, entry in self._entries.items():
+                    if instance_key[0] == key and entry.in_use == 0:
+                        self._entries.move_to_end(instance_key)
+                        entry.hits += 1
+                        entry.in_use += 1
+                        self._stats["hits"] += 1
+                        logger.info(f"模型池命中: {self._format_key(instance_key)}")
+                        return entry
+                instances = sum(1 for k in self._entries if k[0] == key) + self._loading.get(key, 0)
+                if instances < self.max_instances:
+                    self._loading[key] = self._loading.get(key, 0) + 1
+                    break
+                # 已达实例上限，等待其他调用方归还实例
+                if not waited:
+                    waited = True
+                    self._stats["waits"] += 1
+                self._cond.wait()
+
+        load_start = time.time()
+        try:
+            model = loader()
+        except BaseException:
+            with self._cond:
+                self._loading[key] -= 1
+                self._cond.notify_all()
+            raise
+        load_time = time.time() - load_start
+        size_bytes = estimate_model_bytes(model)
+
+        with self._cond:
+            self._loading[key] -= 1
+            entry = _PoolEntry(model, size_bytes, load_time)
+            entry.in_use += 1
+            instance_key = (key, self._next_index)
+            self._next_index += 1
+            self._entries[instance_key] = entry
+            self._stats["misses"] += 1
+            self._stats["load_seconds"] += load_time
+        logger.info(
+            f"模型池未命中，已加载: {self._format_key(instance_key)}，耗时: {load_time:.2f} 秒，"
+            f"占用约 {size_bytes / 1024 / 1024:.0f} MB"
+        )
+
+        self._evict()
+        self._ensure_reaper()
+        return entry
+
+    def _evict(self):
+        evicted = []
+        with self._lock:
+            now = time.time()
+            if self.idle_ttl > 0:
+                for instance_key, entry in list(self._entries.items()):
+                    if entry.in_use == 0 and now - entry.last_used > self.idle_ttl:
+                        evicted.append((instance_key, self._entries.pop(instance_key), "空闲超时"))
+
+            def over_memory():
+                if self.memory_budget > 0:
+                    used = sum(e.size_bytes for e in self._entries.values())
+                    return used > self.memory_budget
+                return False
+
+            # 模型数量上限按不同的模型键计算，超出时淘汰最久未用的模型键的全部空闲实例
+            recent_keys = []
+            for instance_key in reversed(self._entries):
+                if instance_key[0] not in recent_keys:
+                    recent_keys.append(instance_key[0])
+            keep_keys = set(recent_keys[:self.max_models]) if self.max_models > 0 else set(recent_keys)
+
+            def over_models():
+                return self.max_models > 0 and len({k[0] for k in self._entries}) > self.max_models
+
+            # 按 LRU 顺序淘汰，正在使用中的模型不淘汰
+            for instance_key in list(self._entries.keys()):
+                memory = over_memory()
+                if not memory and not over_models():
+                    break
+                entry = self._entries[instance_key]
+                if entry.in_use > 0:
+                    continue
+                if not memory and instance_key[0] in keep_keys:
+                    continue
+                evicted.append((instance_key, self._entries.pop(instance_key), "超出预算"))
+            self._stats["evictions"] += len(evicted)
+
+        for instance_key, entry, reason in evicted:
+            logger.info(f"模型池淘汰({reason}): {self._format_key(instance_key)}")
+            entry.model = None
+        if evicted:
+            gc.collect()
+
+    def _ensure_reaper(self):
+        if self.idle_ttl <= 0:
+            return
+        with self._lock:
+            if self._reaper is not None and self._reaper.is_alive():
+                return
+            self._reaper = threading.Thread(target=self._reap_loop, daemon=True)
+            self._reaper.start()
+
+    def _reap_loop(self):
+        interval = max(self.idle_ttl / 2, 1.0)
+        while True:
+            time.sleep(interval)
+            try:
+                self._evict()
+            except Exception as e:
+                logger.warning(format_message(Codes.INTERNAL, "模型池清理失败", str(e)))
+            with self._lock:
+                if not self._entries:
+                    self._reaper = None
+                    return
+
+    def clear(self):
+        with self._lock:
+            keys = [k for k, e in self._entries.items() if e.in_use == 0]
+            for instance_key in keys:
+                self._entries.pop(instance_key).model = None
+            self._stats["evictions"] += len(keys)
+        gc.collect()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                "hits": self._stats["hits"],
+                "misses": self._stats["misses"],
+                "hit_rate": (self._stats["hits"] / lookups) if lookups else 0.0,
+                "waits": self._stats["waits"],
+                "evictions": self._stats["evictions"],
+                "load_seconds": round(self._stats["load_seconds"], 2),
+                "resident_bytes": sum(e.size_bytes for e in self._entries.values()),
+                "models": [
+                    {
+                        "key": self._format_key(instance_key),
+                        "size_bytes": e.size_bytes,
+                        "load_seconds": round(e.load_time, 2),
+                        "hits": e.hits,
+                        "idle_seconds": round(time.time() - e.last_used, 1),
+                        "in_use": e.in_use > 0,
+                    }
+                    for instance_key, e in self._entries.items()
+                ],
+            }
+
+    @staticmethod
+    def _format_key(instance_key):
+        key, index = instance_key
+        return "/".join(str(k) for k in key if k not in (None, "")) + f"#{index}"
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_model_pool():
+    """返回进程内共享的模型池，每个模型的实例数与调度器的转写槽位数一致"""
+    global _pool
+    from .scheduler import get_scheduler
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ModelPool(
+                memory_budget_mb=config.TRANS_POOL_MEMORY_MB,
+                idle_ttl=config.TRANS_POOL_IDLE_TTL,
+                max_models=config.TRANS_POOL_MAX_MODELS,
+                max_instances=get_scheduler().pool('transcribe').capacity,
+            )
+        return _pool
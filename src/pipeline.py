@@ -0,0 +1,739 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import config
+from .errors import Codes, format_message
+from .video_processor import preprocess_video, AUDIO_FILTERS, PCM_EXT
+from .transcription import transcribe_audio, resolve_model_settings
+from .text_processor import (add_punctuation, process_with_prompts, list_prompt_files, load_reduce_prompt,
+                             map_reduce_plan)
+from .ai_service import UsageMeter, get_model_name, track_usage
+from .tokenizer import chunk_token_budget, get_tokenizer
+from .utils import save_text_to_file, copy_file
+from .model_pool import get_model_pool
+from .artifact_cache import get_artifact_cache, hash_file, make_key
+from .workspace import open_workspace
+from .scheduler import STEP_RESOURCES, get_scheduler
+
+logger = logging.getLogger(__name__)
+
+VIDEO_EXTS = {'.mp4', '.avi', '.mkv', '.mov', '.flv', '.webm', '.m4v'}
+AUDIO_EXTS = {'.mp3', '.wav', '.m4a', '.aac', '.flac', '.ogg'}
+TEXT_EXTS = {'.txt'}
+
+STEP_NAMES = {
+    1: '音频预处理',
+    2: '语音转写',
+    3: 'AI文本修正润色',
+    4: 'AI总结',
+}
+
+TRANSCRIBE_PROMPT = '将以下音频转写成中文文本,确保使用正确的标点符号。'
+
+FIX_PROMPT = '''
+            我通过语音转写，把一篇文本转换为了文字稿，然后分成了一些小部分。请你帮我添文本修正润色，并且改正语句中的偶尔转换错误。
+            你可以适当的给文本分段处理。
+            注意！必须忠实于文本，语句可能是被截取的、不完整的，禁止自己发挥，续写额外内容。
+            只需要回复我最终结果即可。
+            '''
+
+# 每个输出目录下记录各产物的输入哈希与参数，用于增量执行
+MANIFEST_NAME = '.summify_manifest.json'
+
+# --target 可选的目标产物及其对应的最后一个步骤
+TARGETS = {'audio': 1, 'transcript': 2, 'fixed': 3, 'summaries': 4}
+ARTIFACT_NAMES = {1: 'audio', 2: 'transcript', 3: 'fixed'}
+
+# 持久化 worker 进程通过 stdout 输出事件，带此前缀的行才是事件，其余行视为普通输出
+EVENT_PREFIX = '@@SUMMIFY_EVENT '
+
+
+class PipelineError(Exception):
+    def __init__(self, code, message, details=None):
+        super().__init__(format_message(code, message, details))
+        self.code = code
+        self.message = message
+        self.details = details
+
+
+def detect_input_kind(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in TEXT_EXTS:
+        return 'text'
+    if ext in AUDIO_EXTS:
+        return 'audio'
+    if ext in VIDEO_EXTS:
+        return 'video'
+    return 'unknown'
+
+
+def parse_steps(steps_str):
+    """
+    解析用户输入的步骤字符串
+
+    Args:
+        steps_str (str): 用户输入的步骤字符串，如 '01234'
+
+    Returns:
+        list: 要执行的步骤列表
+    """
+    valid_steps = set('1234')
+    if not steps_str:
+        raise ValueError('steps 不能为空')
+    if any(s not in valid_steps for s in steps_str):
+        raise ValueError('steps 只支持 1-4 的组合，例如 "12"、"234"')
+    steps = []
+    for s in steps_str:
+        step = int(s)
+        if step not in steps:
+            steps.append(step)
+    if steps != sorted(steps):
+        raise ValueError('steps 必须按顺序执行，例如 "12"、"234"')
+    return steps
+
+
+def plan_target_steps(input_file, target):
+    """
+    根据目标产物推导需要的步骤链：音视频从步骤1开始，文本从步骤3开始
+
+    Args:
+        target (str): audio / transcript / fixed / summaries
+    """
+    if target not in TARGETS:
+        raise ValueError(f'target 只支持: {", ".join(TARGETS)}')
+    first = 3 if detect_input_kind(input_file) == 'text' else 1
+    last = TARGETS[target]
+    if last < first:
+        raise ValueError('文本输入只能以 fixed 或 summaries 为目标')
+    return list(range(first, last + 1))
+
+
+def load_manifest(output_dir):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if isinstance(data, dict) and isinstance(data.get('artifacts'), dict):
+            return data
+    except (OSError, ValueError):
+        pass
+    return {'version': 1, 'artifacts': {}}
+
+
+def save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(format_message(Codes.FILE_IO, '保存产物清单失败', str(e)))
+
+
+class Pipeline:
+    """
+    在当前进程内执行步骤 1-4，并通过 on_event 回调发送结构化进度事件
+
+    事件为 dict，包含 event（job_start / step_start / step_done / step_skipped /
+    step_queued / step_failed / job_done / job_failed）、step、message 等字段。
+
+    每个产物的输入哈希与参数都记录在输出目录的产物清单中；incremental=True 时，
+    输入与参数都未变化且产物仍存在的步骤（以及步骤4中未变化的提示词）会被跳过，
+    其余步骤也会先查找产物缓存；非增量执行时所有步骤都重新生成，结果仍写入缓存。
+    retry_failed=True 时步骤3只重试上次失败的分块（见 add_punctuation）。
+
+    中间文件写在每次执行独立的工作目录中（见 Workspace），最终结果原子地复制到输出目录，
+    多个 Pipeline 可以在同一台机器上并发执行。每个步骤执行期间占用调度器中对应资源池的一个槽位，
+    槽位已满时发送 step_queued 事件并等待。
+    """
+
+    def __init__(self, input_file, output_dir, steps, prompts_dir='prompts',
+                 model_type=None, model_size=None, on_event=None, incremental=False, retry_failed=False):
+        self.input_file = input_file
+        self.output_dir = output_dir
+        self.steps = parse_steps(steps) if isinstance(steps, str) else list(steps)
+        self.prompts_dir = prompts_dir
+        self.model_type = model_type
+        self.model_size = model_size
+        self.on_event = on_event
+        self.current_file = input_file
+        self.base_name = os.path.splitext(os.path.basename(input_file))[0]
+        self.input_kind = detect_input_kind(input_file)
+        self.outputs = {}
+        self.incremental = incremental
+        self.retry_failed = retry_failed
+        self.manifest = load_manifest(output_dir)
+        self.usage = UsageMeter()
+        self.workspace = None
+
+    def emit(self, event, message=None, **payload):
+        if message:
+            if event in ('step_failed', 'job_failed'):
+                logger.error(message)
+            else:
+                logger.info(message)
+        if not self.on_event:
+            return
+        data = {'event': event, 'time': time.time()}
+        if message:
+            data['message'] = message
+        data.update(payload)
+        try:
+            self.on_event(data)
+        except Exception as e:
+            logger.debug(f'发送进度事件失败: {e}')
+
+    def validate(self):
+        """校验输入文件与步骤的匹配关系，不合法时抛出 PipelineError"""
+        steps = self.steps
+        input_kind = self.input_kind
+        if not os.path.exists(self.input_file):
+            raise PipelineError(Codes.INPUT_NOT_FOUND, f'输入文件不存在: {self.input_file}')
+        if input_kind == 'unknown':
+            raise PipelineError(Codes.UNSUPPORTED_INPUT, '无法识别的输入文件类型')
+        if 1 in steps and input_kind == 'text':
+            raise PipelineError(Codes.STEP_MISMATCH, '步骤1不支持文本输入，请提供音频或视频文件')
+        if 2 in steps and input_kind == 'text':
+            raise PipelineError(Codes.STEP_MISMATCH, '步骤2需要音频输入，请先执行步骤1或提供音频文件')
+        if 2 in steps and input_kind == 'video' and 1 not in steps:
+            raise PipelineError(Codes.STEP_MISMATCH, '输入为视频时需要先执行步骤1')
+        if any(s in steps for s in [3, 4]) and 2 not in steps and input_kind != 'text':
+            raise PipelineError(Codes.STEP_MISMATCH, '步骤3/4需要文本输入，请先执行步骤2或提供txt文件')
+
+    def run(self):
+        """
+        依次执行所有步骤
+
+        Returns:
+            dict: {'ok': bool, 'code': str, 'message': str, 'outputs': dict, 'elapsed': float,
+                   'usage': dict}，usage 为本任务 AI 请求的 token 用量（含缓存命中与未命中的输入 token）
+        """
+        self.workspace = open_workspace()
+        result = None
+        try:
+            with track_usage(self.usage):
+                result = self._run()
+            return result
+        finally:
+            self.workspace.close(ok=bool(result and result['ok']))
+
+    def _run(self):
+        start_time = time.time()
+        try:
+            self.validate()
+            os.makedirs(self.output_dir, exist_ok=True)
+            self.emit('job_start', f'将执行以下步骤: {self.steps}', steps=self.steps,
+                      workspace=self.workspace.path)
+            for step in self.steps:
+                self.run_step(step)
+        except PipelineError as e:
+            self.emit('job_failed', str(e), code=e.code)
+            return self._result(False, e.code, e.message, start_time)
+        except Exception as e:
+            message = format_message(Codes.INTERNAL, '处理过程出错', str(e))
+            self.emit('job_failed', message, code=Codes.INTERNAL)
+            return self._result(False, Codes.INTERNAL, str(e), start_time)
+        usage = self.usage.stats()
+        if usage['requests']:
+            logger.info(f'本任务{self.usage.summary()}')
+        self.emit('job_done', '所有步骤处理完成', outputs=self.outputs, usage=usage)
+        return self._result(True, Codes.SUCCESS, '所有步骤处理完成', start_time)
+
+    def _result(self, ok, code, message, start_time):
+        return {
+            'ok': ok,
+            'code': code,
+            'message': message,
+            'outputs': dict(self.outputs),
+            'elapsed': time.time() - start_time,
+            'usage': self.usage.stats(),
+        }
+
+    def run_step(self, step):
+        handler = {
+            1: self._step_preprocess,
+            2: self._step_transcribe,
+            3: self._step_fix,
+            4: self._step_summarize,
+        }[step]
+        signature = self._signature(step) if step in ARTIFACT_NAMES else None
+        if self.incremental and signature:
+            entry = self._fresh_artifact(ARTIFACT_NAMES[step], signature)
+            if entry:
+                self.current_file = self._restore_artifact(step, entry)
+                self.outputs[step] = self.current_file
+                if step == 1 and self.steps[-1] == 1:
+                    self._copy_to_output(self.current_file, '复制预处理结果到output目录失败')
+                self.emit('step_skipped', f'步骤{step}：{STEP_NAMES[step]}产物已是最新，跳过', step=step,
+                          output=entry['path'])
+                return
+
+        resource = STEP_RESOURCES[step]
+
+        def on_wait(ahead):
+            self.emit('step_queued', f'步骤{step}：等待{resource}资源，前面还有 {ahead} 个任务', step=step,
+                      resource=resource, ahead=ahead)
+
+        with get_scheduler().slot(resource, owner=f'{self.base_name} 步骤{step}', on_wait=on_wait):
+            step_start = time.time()
+            self.emit('step_start', f'步骤{step}：开始{STEP_NAMES[step]}', step=step)
+            try:
+                handler(signature)
+            except PipelineError as e:
+                self.emit('step_failed', str(e), step=step, code=e.code)
+                raise
+        self.emit(
+            'step_done',
+            f'步骤{step}：{STEP_NAMES[step]}完成，耗时: {time.time() - step_start:.2f} 秒',
+            step=step,
+            output=self.outputs.get(step),
+        )
+
+    def _signature(self, step):
+        """
+        计算步骤的输入哈希与参数，返回 (缓存键/签名, 输入哈希, 参数)；无法确定参数时返回 None
+        """
+        if step == 1:
+            params = {'filters': AUDIO_FILTERS, 'format': (config.PREPROCESS_FORMAT or 'm4a').lower()}
+        elif step == 2:
+            params = self._transcribe_params()
+        elif step == 3:
+            params = dict(self._ai_params(FIX_PROMPT), **self._chunk_params())
+        else:
+            return None
+        if params is None or not os.path.exists(self.current_file):
+            return None
+        input_hash = hash_file(self.current_file)
+        return make_key(ARTIFACT_NAMES[step], input_hash, params), input_hash, params
+
+    def _fresh_artifact(self, name, signature):
+        """产物清单中签名一致且文件仍存在时返回该条目"""
+        entry = self.manifest['artifacts'].get(name)
+        if not entry or entry.get('signature') != signature[0]:
+            return None
+        if not entry.get('path') or not os.path.exists(entry['path']):
+            return None
+        return entry
+
+    def _record_artifact(self, name, signature, path, **extra):
+        if signature is None:
+            return
+        key, input_hash, params = signature
+        self.manifest['artifacts'][name] = dict(
+            extra,
+            signature=key,
+            input_hash=input_hash,
+            params=params,
+            path=os.path.abspath(path),
+            updated=time.strftime('%Y-%m-%d %H:%M:%S'),
+        )
+        save_manifest(self.output_dir, self.manifest)
+
+    def _artifact_cache(self, ai=False):
+        """
+        返回产物缓存；AI 步骤的结果在温度大于 0 时每次不同，
+        配置了 AI_CACHE_SKIP_NONDETERMINISTIC 时与 AI 响应缓存一样不读写
+        """
+        if ai and config.AI_CACHE_SKIP_NONDETERMINISTIC and config.MODEL_TEMPERATURE > 0:
+            return None
+        return get_artifact_cache()
+
+    def _cache_lookup(self, name, signature, ai=False):
+        """返回命中的缓存条目；非增量执行表示要求重新生成，不读取缓存"""
+        cache = self._artifact_cache(ai)
+        if cache is None or signature is None or not self.incremental:
+            return None
+        return cache.get(signature[0], label=f'{name} {self.base_name}')
+
+    def _cache_store(self, signature, name, path, elapsed, ai=False, **meta):
+        cache = self._artifact_cache(ai)
+        if cache is None or signature is None:
+            return
+        cache.put(signature[0], {name: path}, elapsed=elapsed, **meta)
+
+    def _restore_artifact(self, step, entry):
+        """
+        返回跳过的步骤的产物路径；清单记录的是缓存中的副本时，按原文件名复制回工作目录，
+        后续步骤的输出文件名由它推导
+        """
+        path = entry['path']
+        file_name = entry.get('file_name')
+        if not file_name or os.path.basename(path) == file_name:
+            return path
+        restored = os.path.join(self.workspace.dir(str(step)), file_name)
+        if not copy_file(path, restored):
+            raise PipelineError(Codes.FILE_IO, '读取已有产物失败')
+        return restored
+
+    def _persistent_copy(self, signature, name, path, error_message):
+        """返回产物在工作目录之外的副本：优先使用缓存中的文件，未启用缓存时复制到 output 目录"""
+        cache = get_artifact_cache()
+        if cache is not None:
+            cached = cache.path(signature[0], name)
+            if cached:
+                return cached
+        return self._copy_to_output(path, error_message)
+
+    def _copy_to_output(self, path, error_message):
+        output_file = os.path.join(self.output_dir, os.path.basename(path))
+        if os.path.abspath(output_file) == os.path.abspath(path):
+            return output_file
+        if not copy_file(path, output_file):
+            raise PipelineError(Codes.FILE_IO, error_message)
+        return output_file
+
+    def _ai_params(self, prompt):
+        return {
+            'prompt': prompt,
+            'api_type': config.API_TYPE,
+            'model': get_model_name(config.API_TYPE),
+            'temperature': config.MODEL_TEMPERATURE,
+            'max_tokens': config.MODEL_MAX_TOKENS,
+        }
+
+    def _chunk_params(self):
+        chunk_tokens = self._chunk_tokens()
+        if chunk_tokens:
+            return {'chunk_tokens': chunk_tokens, 'tokenizer': get_tokenizer(config.API_TYPE).name}
+        return {'chunk_size': config.CHUNK_SIZE}
+
+    def _chunk_tokens(self):
+        if (config.CHUNK_MODE or 'tokens').lower() != 'tokens':
+            return None
+        return chunk_token_budget()
+
+    def _transcribe_params(self):
+        try:
+            settings = resolve_model_settings(self.model_type, self.model_size)
+        except ValueError:
+            return None
+        return {
+            'settings': settings,
+            'prompt': TRANSCRIBE_PROMPT,
+            'parallel_segment': config.TRANS_PARALLEL_SEGMENT_SECONDS if config.TRANS_PARALLEL_WORKERS > 1 else None,
+        }
+
+    def _step_preprocess(self, signature):
+        step_start = time.time()
+        output_dir = self.workspace.dir('1')
+        output_format = (config.PREPROCESS_FORMAT or 'm4a').lower()
+        source_base = os.path.splitext(os.path.basename(self.current_file))[0]
+        ext = PCM_EXT if output_format == 'pcm' else '.m4a'
+        hit = self._cache_lookup('preprocess', signature)
+        if hit:
+            processed_audio = os.path.join(output_dir, f'{source_base}_音频{ext}')
+            if not copy_file(hit['files']['audio'], processed_audio):
+                raise PipelineError(Codes.FILE_IO, '读取预处理缓存失败')
+        else:
+            processed_audio = preprocess_video(self.current_file, output_dir=output_dir, output_format=output_format)
+            if not processed_audio:
+                raise PipelineError(Codes.PREPROCESS_FAIL, '音频预处理失败')
+        self.current_file = processed_audio
+        if not hit:
+            self._cache_store(signature, 'audio', self.current_file, time.time() - step_start)
+        if signature is not None:
+            # 工作目录在任务结束后会被删除，清单中记录缓存内或 output 目录中的副本，下次执行才能跳过本步骤
+            self._record_artifact('audio', signature,
+                                  self._persistent_copy(signature, 'audio', self.current_file,
+                                                        '复制预处理结果到output目录失败'),
+                                  file_name=os.path.basename(self.current_file))
+
+        # 如果步骤1是最后一步，将结果复制到output目录
+        if self.steps[-1] == 1:
+            self._copy_to_output(self.current_file, '复制预处理结果到output目录失败')
+        self.outputs[1] = self.current_file
+
+    def _step_transcribe(self, signature):
+        step_start = time.time()
+        hit = self._cache_lookup('transcribe', signature)
+        output_dir = self.workspace.dir('2')
+        if hit:
+            audio_base = os.path.splitext(os.path.basename(self.current_file))[0]
+            self.current_file = os.path.join(output_dir, f'{audio_base}_转写.md')
+            if not copy_file(hit['files']['transcript'], self.current_file):
+                raise PipelineError(Codes.FILE_IO, '读取转写缓存失败')
+        else:
+            transcribed_file = transcribe_audio(
+                self.current_file,
+                TRANSCRIBE_PROMPT,
+                model_type=self.model_type,
+                model_size=self.model_size,
+                output_dir=output_dir,
+            )
+            if not transcribed_file:
+                raise PipelineError(Codes.TRANSCRIBE_FAIL, '语音转写失败')
+
+            if config.TRANS_POOL_ENABLED:
+                pool_stats = get_model_pool().stats()
+                logger.info(
+                    f"模型池统计: 命中 {pool_stats['hits']} 次，未命中 {pool_stats['misses']} 次，"
+                    f"累计加载耗时 {pool_stats['load_seconds']:.2f} 秒"
+                )
+            self.current_file = transcribed_file
+            self._cache_store(signature, 'transcript', self.current_file, time.time() - step_start)
+
+        # 始终将转写结果复制到output目录，方便Web端预览
+        output_file = self._copy_to_output(self.current_file, '复制转写结果到output目录失败')
+        # 清单记录output目录中的副本，用户在Web端编辑后，后续步骤会以编辑后的文本为输入
+        self._record_artifact('transcript', signature, output_file)
+        self.outputs[2] = output_file
+
+    def _step_fix(self, signature):
+        step_start = time.time()
+        api_key = config.API_KEY
+        if not api_key:
+            raise PipelineError(Codes.AI_KEY_MISSING, '未配置API密钥')
+
+        with open(self.current_file, 'r', encoding='utf-8') as f:
+            text = f.read()
+
+        hit = self._cache_lookup('fix', signature, ai=True)
+        if hit:
+            with open(hit['files']['fixed'], 'r', encoding='utf-8') as f:
+                punctuated_text = f.read()
+        else:
+            punctuated_text = add_punctuation(
+                text,
+                api_key,
+                FIX_PROMPT,
+                config.CHUNK_SIZE,
+                config.API_TYPE,
+                chunk_tokens=self._chunk_tokens(),
+                retry_failed=self.retry_failed,
+            )
+        if not punctuated_text:
+            raise PipelineError(Codes.AI_CALL_FAIL, 'AI文本修正润色失败')
+
+        # 先写入工作目录，再原子地复制到output目录
+        data_file = os.path.join(self.workspace.dir('3'), f'{self.base_name}_fixed.md')
+        if not save_text_to_file(punctuated_text, data_file):
+            raise PipelineError(Codes.FILE_IO, '保存文本修正润色文本失败')
+        punctuated_file = self._copy_to_output(data_file, '保存文本修正润色结果失败')
+        if not hit:
+            self._cache_store(signature, 'fixed', punctuated_file, time.time() - step_start, ai=True)
+        self._record_artifact('fixed', signature, punctuated_file)
+        self.current_file = punctuated_file
+        self.outputs[3] = punctuated_file
+
+    def _step_summarize(self, signature=None):
+        step_start = time.time()
+        api_key = config.API_KEY
+        if not api_key:
+            raise PipelineError(Codes.AI_KEY_MISSING, '未配置API密钥')
+
+        with open(self.current_file, 'r', encoding='utf-8') as f:
+            text = f.read()
+
+        # 每个提示词单独记录与缓存，修改某个提示词只会重新生成对应的总结
+        input_hash = hash_file(self.current_file)
+        plan = map_reduce_plan(text, config.API_TYPE)
+        pending = {}
+        done = 0
+        for prompt_file in list_prompt_files(self.prompts_dir):
+            with open(os.path.join(self.prompts_dir, prompt_file), 'r', encoding='utf-8') as f:
+                prompt = f.read().strip()
+            params = dict(self._ai_params(prompt), layout=config.AI_SUMMARY_LAYOUT)
+            if plan is not None:
+                params = dict(params, map_reduce=plan,
+                              reduce_prompt=load_reduce_prompt(self.prompts_dir, prompt_file, prompt))
+            prompt_signature = (make_key('summary', input_hash, params), input_hash, params)
+            name = f'summary:{prompt_file}'
+            output_path = os.path.join(self.output_dir, f'{os.path.splitext(prompt_file)[0]}.md')
+
+            if self.incremental and self._fresh_artifact(name, prompt_signature):
+                logger.info(f'提示词 {prompt_file} 的总结已是最新，跳过')
+                done += 1
+                continue
+            hit = self._cache_lookup('summary', prompt_signature, ai=True)
+            if hit and copy_file(hit['files']['summary'], output_path):
+                self._record_artifact(name, prompt_signature, output_path, prompt_file=prompt_file)
+                done += 1
+                continue
+            before = os.path.getmtime(output_path) if os.path.exists(output_path) else None
+            pending[prompt_file] = (prompt_signature, output_path, before)
+
+        if pending or not done:
+            def on_delta(prompt_file, delta):
+                self.emit('summary_delta', prompt_file=prompt_file, delta=delta)
+
+            ok = process_with_prompts(text, api_key, config.API_TYPE, self.prompts_dir, self.output_dir,
+                                      prompt_files=list(pending), on_delta=on_delta)
+            elapsed = (time.time() - step_start) / max(len(pending), 1)
+            for prompt_file, (prompt_signature, output_path, before) in pending.items():
+                # 只缓存与记录本次新生成的结果
+                if os.path.exists(output_path) and os.path.getmtime(output_path) != before:
+                    self._cache_store(prompt_signature, 'summary', output_path, elapsed, ai=True,
+                                      prompt_file=prompt_file)
+                    self._record_artifact(f'summary:{prompt_file}', prompt_signature, output_path,
+                                          prompt_file=prompt_file)
+            if not ok and not done:
+                raise PipelineError(Codes.AI_CALL_FAIL, 'AI总结失败')
+        self.outputs[4] = self.output_dir
+
+
+def run_pipeline(input_file, output_dir, steps, prompts_dir='prompts',
+                 model_type=None, model_size=None, on_event=None, incremental=False, retry_failed=False):
+    """
+    在当前进程内执行流水线，参数含义与 cli.py 一致
+
+    Returns:
+        dict: 执行结果，见 Pipeline.run
+    """
+    pipeline = Pipeline(
+        input_file,
+        output_dir,
+        steps,
+        prompts_dir=prompts_dir,
+        model_type=model_type,
+        model_size=model_size,
+        on_event=on_event,
+        incremental=incremental,
+        retry_failed=retry_failed,
+    )
+    return pipeline.run()
+
+
+class PipelineWorkerClient:
+    """
+    持久化 worker 进程的客户端：首次提交任务时启动 `python -m src.pipeline --serve`，
+    之后的任务复用同一个进程（torch 导入与模型池只付出一次代价），进程退出后自动重启。
+    任务串行执行，调用方需自行保证同一时刻只提交一个任务。
+    """
+
+    def __init__(self, root_dir, cwd=None):
+        self.root_dir = str(root_dir)
+        self.cwd = cwd
+        self.process = None
+        self._job_counter = 0
+
+    def _ensure_process(self):
+        if self.process is not None and self.process.poll() is None:
+            return self.process
+        import subprocess
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [self.root_dir, env.get('PYTHONPATH')]))
+        env['PYTHONUNBUFFERED'] = '1'
+        self.process = subprocess.Popen(
+            [sys.executable or 'python', '-u', '-m', 'src.pipeline', '--serve'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            encoding='utf-8',
+            bufsize=1,
+            cwd=self.cwd,
+            env=env,
+        )
+        logger.info(f'已启动流水线 worker 进程，pid={self.process.pid}')
+        return self.process
+
+    def run(self, on_event=None, on_output=None, **job):
+        """
+        提交任务并阻塞等待完成
+
+        Args:
+            on_event (callable): 结构化事件回调
+            on_output (callable): worker 输出的非事件行回调
+            **job: 传给 run_pipeline 的参数
+
+        Returns:
+            dict: 执行结果，见 Pipeline.run
+        """
+        process = self._ensure_process()
+        self._job_counter += 1
+        job_id = f'{process.pid}-{self._job_counter}'
+        job['job_id'] = job_id
+        process.stdin.write(json.dumps(job, ensure_ascii=False) + '\n')
+        process.stdin.flush()
+
+        for line in process.stdout:
+            line = line.rstrip('\n')
+            if not line.startswith(EVENT_PREFIX):
+                if on_output and line.strip():
+                    on_output(line)
+                continue
+            try:
+                data = json.loads(line[len(EVENT_PREFIX):])
+            except ValueError:
+                continue
+            if data.get('job_id') != job_id:
+                continue
+            if data.get('event') == 'job_result':
+                return data.get('result') or {'ok': False, 'code': Codes.INTERNAL, 'message': '结果为空'}
+            if on_event:
+                on_event(data)
+
+        code = process.wait()
+        self.process = None
+        return {'ok': False, 'code': Codes.TASK_FAIL, 'message': f'worker 进程异常退出，返回码: {code}', 'outputs': {}}
+
+    def close(self):
+        if self.process is not None and self.process.poll() is None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=10)
+            except Exception:
+                self.process.kill()
+        self.process = None
+
+
+def serve():
+    """
+    持久化 worker 进程入口：从 stdin 逐行读取 JSON 任务，事件以 EVENT_PREFIX 开头写到 stdout
+
+    进程常驻，torch 的导入与模型池在多个任务之间复用。
+    """
+    stdout = sys.stdout
+    # 第三方库的 print 输出改写到 stderr，避免与事件流混在一起
+    sys.stdout = sys.stderr
+
+    def write_event(data):
+        stdout.write(EVENT_PREFIX + json.dumps(data, ensure_ascii=False, default=str) + '\n')
+        stdout.flush()
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            write_event({'event': 'job_failed', 'code': Codes.INVALID_ARGS, 'message': str(e)})
+            continue
+        job_id = job.pop('job_id', None)
+
+        def on_event(data):
+            data['job_id'] = job_id
+            write_event(data)
+
+        try:
+            result = run_pipeline(on_event=on_event, **job)
+        except Exception as e:
+            result = {'ok': False, 'code': Codes.INTERNAL, 'message': str(e), 'outputs': {}}
+        write_event({'event': 'job_result', 'job_id': job_id, 'result': result})
+
+
+if __name__ == '__main__':
+    from .logging_config import setup_logging
+
+    parser = argparse.ArgumentParser(description='SummifyAI 流水线 worker 进程')
+    parser.add_argument('--serve', action='store_true', help='常驻运行，从 stdin 读取任务')
+    args = parser.parse_args()
+
+    setup_logging(
+        app_name='pipeline-worker',
+        log_dir=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), config.LOG_DIR),
+        level=config.LOG_LEVEL,
+        max_bytes=config.LOG_MAX_BYTES,
+        backup_count=config.LOG_BACKUP_COUNT,
+    )
+    if args.serve:
+        serve()
+    else:
+        parser.print_help()
@@ -0,0 +1,181 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# 各步骤占用的资源类别：预处理是 ffmpeg 子进程，转写占 CPU/GPU 与模型内存，修正与总结只等待网络
+STEP_RESOURCES = {1: 'ffmpeg', 2: 'transcribe', 3: 'ai', 4: 'ai'}
+
+# 转写时的大致内存占用（MB），模型权重加一次推理的激活，用于按内存计算转写并发数
+TRANSCRIBE_MEMORY_MB = {
+    'tiny': 300,
+    'base': 500,
+    'small': 1200,
+    'medium': 3000,
+    'large-v3-turbo': 3200,
+    'large-v3': 6000,
+    'large': 6000,
+}
+DEFAULT_TRANSCRIBE_MEMORY_MB = 3000
+
+
+class ResourcePool:
+    """
+    固定容量的资源槽位，按到达顺序分配
+
+    与 threading.Semaphore 不同，等待者严格先来先得，长任务不会被后来的短任务反复插队饿死。
+    """
+
+    def __init__(self, name, capacity):
+        self.name = name
+        self.capacity = max(1, int(capacity))
+        self._cond = threading.Condition()
+        self._waiters = deque()
+        self._holders = {}
+        self._stats = {'acquired': 0, 'peak_in_use': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+
+    def _can_acquire(self, ticket):
+        return len(self._holders) < self.capacity and self._waiters[0] is ticket
+
+    def acquire(self, owner=None, on_wait=None):
+        """
+        占用一个槽位，槽位已满时阻塞等待
+
+        Args:
+            owner (str): 持有者说明，出现在 stats() 中
+            on_wait (callable): 需要等待时调用一次 on_wait(前面排队的数量)
+
+        Returns:
+            object: 槽位凭据，传给 release()
+        """
+        ticket = object()
+        start = time.monotonic()
+        with self._cond:
+            self._waiters.append(ticket)
+            if not self._can_acquire(ticket) and on_wait is not None:
+                try:
+                    on_wait(len(self._waiters) - 1)
+                except Exception as e:
+                    logger.debug(f'发送排队事件失败: {e}')
+            while not self._can_acquire(ticket):
+                self._cond.wait()
+            self._waiters.popleft()
+            waited = time.monotonic() - start
+            self._holders[ticket] = {'owner': owner, 'since': time.time()}
+            self._stats['acquired'] += 1
+            self._stats['peak_in_use'] = max(self._stats['peak_in_use'], len(self._holders))
+            self._stats['wait_seconds'] += waited
+            self._stats['max_wait_seconds'] = max(self._stats['max_wait_seconds'], waited)
+            # 还有空位时唤醒下一个等待者
+            self._cond.notify_all()
+        return ticket
+
+    def release(self, ticket):
+        with self._cond:
+            self._holders.pop(ticket, None)
+            self._cond.notify_all()
+
+    def stats(self):
+        now = time.time()
+        with self._cond:
+            acquired = self._stats['acquired']
+            return {
+                'capacity': self.capacity,
+                'in_use': len(self._holders),
+                'waiting': len(self._waiters),
+                'peak_in_use': self._stats['peak_in_use'],
+                'acquired': acquired,
+                'avg_wait_seconds': round(self._stats['wait_seconds'] / acquired, 3) if acquired else 0.0,
+                'max_wait_seconds': round(self._stats['max_wait_seconds'], 3),
+                'holders': [
+                    {'owner': h['owner'], 'seconds': round(now - h['since'], 1)}
+                    for h in self._holders.values()
+                ],
+            }
+
+
+def _physical_memory_mb():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return 0
+
+
+def default_transcribe_slots():
+    """
+    转写槽位数：取按 CPU 核数与按内存计算的较小值
+
+    每个转写占用的核数为并行转写的 worker 数（未开启时为 faster-whisper 线程数，默认按 4 核计）；
+    内存预算为 TRANS_POOL_MEMORY_MB，未设置时取物理内存的一半。GPU 模式固定为 1。
+    每个槽位对应模型池中同一模型的一个实例（ModelPool.max_instances），占用槽位的任务不会再等待模型。
+    """
+    if (config.TRANS_DEVICE or 'cpu').lower() == 'gpu':
+        return 1
+    cores = os.cpu_count() or 1
+    per_job_cores = config.TRANS_PARALLEL_WORKERS if config.TRANS_PARALLEL_WORKERS > 1 else (
+        config.TRANS_FW_CPU_THREADS or 4)
+    by_cpu = max(1, cores // max(1, per_job_cores))
+    budget_mb = config.TRANS_POOL_MEMORY_MB or _physical_memory_mb() // 2
+    if budget_mb <= 0:
+        return by_cpu
+    per_job_mb = TRANSCRIBE_MEMORY_MB.get(config.TRANS_MODEL_SIZE, DEFAULT_TRANSCRIBE_MEMORY_MB)
+    by_memory = max(1, budget_mb // per_job_mb)
+    return max(1, min(by_cpu, by_memory))
+
+
+class ResourceScheduler:
+    """
+    按资源类别限制并发的步骤调度器
+
+    一个任务的各个步骤依次占用不同资源池的槽位（见 STEP_RESOURCES），步骤结束即释放，
+    转写占满 CPU 时，只需要等待网络的修正/总结步骤仍可以在 ai 池中继续执行。
+    """
+
+    def __init__(self, capacities):
+        self.pools = {name: ResourcePool(name, capacity) for name, capacity in capacities.items()}
+
+    def pool(self, resource):
+        pool = self.pools.get(resource)
+        if pool is None:
+            raise ValueError(f'未知的资源类别: {resource}')
+        return pool
+
+    @contextmanager
+    def slot(self, resource, owner=None, on_wait=None):
+        pool = self.pool(resource)
+        ticket = pool.acquire(owner=owner, on_wait=on_wait)
+        try:
+            yield
+        finally:
+            pool.release(ticket)
+
+    def capacity(self):
+        return sum(pool.capacity for pool in self.pools.values())
+
+    def stats(self):
+        return {name: pool.stats() for name, pool in self.pools.items()}
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """返回进程内共享的调度器，槽位数由 SCHED_*_SLOTS 配置，0 表示自动"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = ResourceScheduler({
+                'ffmpeg': config.SCHED_FFMPEG_SLOTS or max(1, (os.cpu_count() or 1) // 4),
+                'transcribe': config.SCHED_TRANSCRIBE_SLOTS or default_transcribe_slots(),
+                'ai': config.SCHED_AI_SLOTS,
+            })
+            capacities = ', '.join(f'{name}={pool.capacity}' for name, pool in _scheduler.pools.items())
+            logger.info(f'步骤调度器槽位: {capacities}')
+        return _scheduler
@@ -1,17 +1,28 @@
 import logging
 import os
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 import config
-from .ai_service import call_ai_api
+from .ai_service import call_ai_batch, get_model_name, track_usage
+from .checkpoint import get_checkpoint
 from .utils import save_text_to_file,split_text_into_chunks
+from .tokenizer import get_tokenizer
 from .errors import Codes, format_message
 
 logger = logging.getLogger(__name__)
 
-def add_punctuation(text, api_key, prompt, chunk_size=2000, api_type='deepseek'):
+# 每个提示词的合并（reduce）模板放在 prompts/reduce/<同名文件>.txt，{prompt} 会被替换为原提示词
+REDUCE_DIR = 'reduce'
+DEFAULT_REDUCE_PROMPT = (
+    '下面是一份长文稿按顺序分成若干部分后，分别按照同一要求得到的处理结果。'
+    '请把这些部分结果合并为一份完整、连贯的最终结果：去除各部分之间的重复内容，'
+    '保持原文的先后顺序与整体结构，不要提及"第几部分"。原始要求如下：\n\n{prompt}'
+)
+MAX_REDUCE_ROUNDS = 5
+
+def add_punctuation(text, api_key, prompt, chunk_size=2000, api_type='deepseek', chunk_tokens=None,
+                    retry_failed=False):
     """
     对文本进行分块并调用AI API添文本修正润色
     
@@ -19,22 +30,36 @@ def add_punctuation(text, api_key, prompt, chunk_size=2000, api_type='deepseek')
         text (str): 原始文本
         api_key (str): API密钥
         prompt (str): 提示词
-        chunk_size (int): 分块大小
+        chunk_size (int): 分块大小（字符数）
         api_type (str): API类型，支持'deepseek'和'claude'
+        chunk_tokens (int): 传入时按该服务商分词器的 token 数分块，忽略 chunk_size
+        retry_failed (bool): 只重试上次失败的分块，没有对应的检查点时直接返回 None
     
     Returns:
-        str: 带有标点的完整文本
+        str: 带有标点的完整文本；有分块失败时返回 None，已完成的分块保留在检查点中，下次执行只请求其余分块
     """
     
     logger.debug(f'开始添文本修正润色，输入文本长度: {len(text)}，分块大小: {chunk_size}')
-    
-    # 确保temp目录存在
-    temp_dir =  os.path.join(config.TEMP_DIR, 'split')
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
 
+    checkpoint = get_checkpoint(
+        text, prompt,
+        api_type=api_type,
+        model=get_model_name(api_type),
+        temperature=config.MODEL_TEMPERATURE,
+        max_tokens=config.MODEL_MAX_TOKENS,
+        chunk_tokens=chunk_tokens,
+        chunk_size=None if chunk_tokens else chunk_size,
+    )
 
-    chunks = split_text_into_chunks(text, chunk_size)
+    if chunk_tokens:
+        tokenizer = get_tokenizer(api_type)
+        chunks = split_text_into_chunks(text, chunk_tokens, tokenizer.count)
+        if chunks:
+            sizes = [tokenizer.count(chunk) for chunk in chunks]
+            logger.info(f'按 token 分块（{tokenizer.name}，上限 {chunk_tokens}）：共 {len(chunks)} 块，'
+                        f'平均 {sum(sizes) / len(sizes):.0f} tokens，最大 {max(sizes)}')
+    else:
+        chunks = split_text_into_chunks(text, chunk_size)
     if not chunks:
         logger.warning(format_message(Codes.AI_CALL_FAIL, '文本为空或无法分块，跳过处理'))
         return ""
@@ -53,46 +78,54 @@ def add_punctuation(text, api_key, prompt, chunk_size=2000, api_type='deepseek')
     # if current_chunk:
     #     chunks.append(current_chunk)
     
-    # 保存原始分块
-    for idx, chunk in enumerate(chunks):
-        chunk_file = os.path.join(temp_dir, f'chunk_{idx}_original.txt')
-        save_text_to_file(chunk, chunk_file)
-        logger.debug(f'保存原始分块 {idx} 到文件: {chunk_file}')
-    
-    # 使用线程池并行处理每个分块，使用字典保存顺序
-    results_dict = {}
-    errors = []
-    with ThreadPoolExecutor(max_workers=config.AI_THREADS) as executor:
-        # 为每个分块创建带索引的future
-        future_dict = {
-            executor.submit(call_ai_api, chunk, api_key, prompt, api_type): idx
-            for idx, chunk in enumerate(chunks)
-        }
-        
-        # 等待所有future完成并按索引保存结果
-        for future in as_completed(future_dict):
-            idx = future_dict[future]
-            try:
-                processed_text = future.result()
-            except Exception as e:
-                errors.append((idx, str(e)))
-                logger.error(format_message(Codes.AI_CALL_FAIL, f'分块 {idx} 处理失败', str(e)))
-                continue
+    # 同一文本可能被多个任务同时处理，从读取到更新检查点的整个过程独占检查点目录
+    with checkpoint.locked():
+        if retry_failed and not checkpoint.exists():
+            logger.error(format_message(Codes.AI_CALL_FAIL, '没有找到可重试的分块检查点',
+                                        '文本、提示词或分块参数与上次执行不一致，或上次已全部成功'))
+            return None
+
+        # 保存原始分块，读取上次已完成的分块
+        try:
+            results_dict = checkpoint.prepare(chunks)
+        except OSError as e:
+            logger.error(format_message(Codes.FILE_IO, '写入分块检查点失败', str(e)))
+            return None
+        pending = [idx for idx in range(len(chunks)) if idx not in results_dict]
+        if results_dict:
+            logger.info(f'从检查点恢复 {len(results_dict)}/{len(chunks)} 个分块，需要处理 {len(pending)} 个')
+        logger.debug(f'分块检查点目录: {checkpoint.dir}')
+
+        # 剩余分块交给AI引擎并发处理，每个分块完成时立即保存
+        errors = []
+
+        def on_chunk_done(i, processed_text):
+            idx = pending[i]
             if not processed_text:
                 errors.append((idx, 'empty result'))
                 logger.error(format_message(Codes.AI_CALL_FAIL, f'分块 {idx} 处理失败', '返回为空'))
-                continue
+                return
             results_dict[idx] = processed_text
             # 保存处理后的分块
-            processed_file = os.path.join(temp_dir, f'chunk_{idx}_processed.txt')
-            save_text_to_file(processed_text, processed_file)
-            logger.debug(f'保存处理后分块 {idx} 到文件: {processed_file}')
-    
+            try:
+                checkpoint.save(idx, processed_text)
+            except OSError as e:
+                logger.warning(format_message(Codes.FILE_IO, f'保存分块 {idx} 检查点失败', str(e)))
+
+        call_ai_batch([(chunks[idx], prompt) for idx in pending], api_key, api_type, on_result=on_chunk_done)
+
+        failed = [idx for idx in range(len(chunks)) if idx not in results_dict]
+        try:
+            checkpoint.finish(len(chunks), failed)
+        except OSError as e:
+            logger.warning(format_message(Codes.FILE_IO, '更新分块检查点失败', str(e)))
+
     # 按照原始顺序拼接结果
-    if errors or len(results_dict) != len(chunks):
+    if failed:
         logger.error(format_message(
             Codes.AI_CALL_FAIL,
-            f'文本修正润色失败，成功 {len(results_dict)}/{len(chunks)}，错误数: {len(errors)}'
+            f'文本修正润色失败，成功 {len(results_dict)}/{len(chunks)}，失败分块: {failed}',
+            '已完成的分块已保存，可使用 --retry-failed 只重试失败的分块'
         ))
         return None
 
@@ -100,7 +133,182 @@ def add_punctuation(text, api_key, prompt, chunk_size=2000, api_type='deepseek')
     return "".join(ordered_results)
 
 
-def process_with_prompts(text, api_key, api_type='deepseek',prompts_dir='prompts',output_dir='output'):
+class StreamingOutput:
+    """
+    把流式返回的内容边收边追加写入输出文件
+
+    已存在的旧文件先改名为隐藏的备份，成功后删除备份，失败时恢复，
+    不会因为一次失败的重新生成丢掉原来的结果。
+    on_text(delta) 用于把内容转发给前端，按 flush_interval 合并后再调用，delta 为 None 表示重新开始。
+    """
+
+    def __init__(self, path, on_text=None, flush_interval=0.2):
+        self.path = path
+        self.on_text = on_text
+        self.flush_interval = flush_interval
+        directory, name = os.path.split(path)
+        self.backup_path = os.path.join(directory, f'.{name}.bak')
+        self._file = None
+        self._pending = []
+        self._last_flush = 0.0
+        self.first_delta_at = None
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        if os.path.exists(self.path) and not os.path.exists(self.backup_path):
+            os.replace(self.path, self.backup_path)
+        self._file = open(self.path, 'w', encoding='utf-8')
+
+    def _flush_text(self):
+        if self.on_text and self._pending:
+            self.on_text(''.join(self._pending))
+        self._pending = []
+        self._last_flush = time.time()
+
+    def write(self, delta):
+        if delta is None:
+            # 重试：丢弃已写入的内容
+            if self._file is not None:
+                self._file.seek(0)
+                self._file.truncate()
+            self._pending = []
+            if self.on_text:
+                self.on_text(None)
+            return
+        if self._file is None:
+            self._open()
+        if self.first_delta_at is None:
+            self.first_delta_at = time.time()
+        self._file.write(delta)
+        self._file.flush()
+        self._pending.append(delta)
+        if time.time() - self._last_flush >= self.flush_interval:
+            self._flush_text()
+
+    def finish(self, result):
+        """结束写入：result 为完整结果，为空表示失败"""
+        self._flush_text()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if result:
+            # 以完整结果为准再写一次，保证文件内容与返回值一致
+            ok = save_text_to_file(result, self.path)
+            if ok and os.path.exists(self.backup_path):
+                os.remove(self.backup_path)
+            return ok
+        if os.path.exists(self.backup_path):
+            os.replace(self.backup_path, self.path)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+        return None
+
+
+def load_reduce_prompt(prompts_dir, prompt_file, prompt):
+    """读取提示词对应的合并模板，没有时使用默认模板"""
+    template = DEFAULT_REDUCE_PROMPT
+    path = os.path.join(prompts_dir, REDUCE_DIR, prompt_file)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            template = f.read().strip() or DEFAULT_REDUCE_PROMPT
+    return template.replace('{prompt}', prompt)
+
+
+def map_reduce_plan(text, api_type):
+    """
+    文本超过 SUMMARY_MAP_REDUCE_TOKENS 时返回分层总结的参数，否则返回 None
+    """
+    threshold = config.SUMMARY_MAP_REDUCE_TOKENS
+    if threshold <= 0:
+        return None
+    if get_tokenizer(api_type).count(text) <= threshold:
+        return None
+    return {'threshold': threshold, 'chunk_tokens': config.SUMMARY_CHUNK_TOKENS}
+
+
+def _join_partials(partials):
+    return '\n\n'.join(f'## 第 {idx} 部分\n\n{partial.strip()}' for idx, partial in enumerate(partials, 1))
+
+
+def _map_reduce_inputs(text, prompts, prompts_dir, api_key, api_type, plan, layout=None):
+    """
+    分层总结的 map 与中间 reduce 阶段
+
+    文本按 token 分块后，每个提示词对每个分块分别处理（所有请求一起交给AI引擎并发执行）；
+    部分结果拼接后仍超过分块上限时，分组合并，直到能放进一次请求。
+    按提示词顺序提交，同一分块的不同提示词相隔较远发出，后发的请求更容易命中前缀缓存。
+
+    Returns:
+        list: 每个提示词最终合并请求的 (输入文本, 合并提示词)，失败的提示词为 None
+    """
+    tokenizer = get_tokenizer(api_type)
+    chunk_tokens = plan['chunk_tokens']
+    chunks = split_text_into_chunks(text, chunk_tokens, tokenizer.count)
+    logger.info(f'文本超过 {plan["threshold"]} tokens，分为 {len(chunks)} 块进行分层总结')
+
+    requests = [(chunk, prompt) for _, prompt in prompts for chunk in chunks]
+    results = call_ai_batch(requests, api_key, api_type, layout=layout)
+    partials = [results[i * len(chunks):(i + 1) * len(chunks)] for i in range(len(prompts))]
+    reduce_prompts = [load_reduce_prompt(prompts_dir, prompt_file, prompt) for prompt_file, prompt in prompts]
+
+    for round_idx in range(MAX_REDUCE_ROUNDS):
+        groups = []
+        for idx, parts in enumerate(partials):
+            if parts is None or not all(parts):
+                partials[idx] = None
+                continue
+            joined = _join_partials(parts)
+            if len(parts) == 1 or tokenizer.count(joined) <= chunk_tokens:
+                continue
+            # 部分结果按 token 装组，每组合并成一个结果
+            group_list = []
+            current = []
+            current_len = 0
+            for part in parts:
+                part_len = tokenizer.count(part)
+                if current and current_len + part_len > chunk_tokens:
+                    group_list.append(current)
+                    current, current_len = [], 0
+                current.append(part)
+                current_len += part_len
+            if current:
+                group_list.append(current)
+            if len(group_list) >= len(parts):
+                # 每个部分结果都已接近上限，再分组也无法缩小，直接进入最终合并
+                continue
+            groups.append((idx, group_list))
+        if not groups:
+            break
+        logger.info(f'第 {round_idx + 1} 轮中间合并，共 {sum(len(g) for _, g in groups)} 组')
+        round_requests = [(_join_partials(group), reduce_prompts[idx]) for idx, group_list in groups
+                          for group in group_list]
+        round_results = call_ai_batch(round_requests, api_key, api_type, layout=layout)
+        offset = 0
+        for idx, group_list in groups:
+            partials[idx] = round_results[offset:offset + len(group_list)]
+            offset += len(group_list)
+
+    inputs = []
+    for idx, parts in enumerate(partials):
+        if parts is None or not all(parts):
+            logger.error(format_message(Codes.AI_CALL_FAIL, f'分层总结失败: {prompts[idx][0]}'))
+            inputs.append(None)
+        elif len(parts) == 1:
+            inputs.append((parts[0], None))
+        else:
+            inputs.append((_join_partials(parts), reduce_prompts[idx]))
+    return inputs
+
+
+def list_prompt_files(prompts_dir):
+    """返回prompts目录下的所有txt提示词文件名"""
+    if not os.path.exists(prompts_dir):
+        return []
+    return sorted(f for f in os.listdir(prompts_dir) if f.endswith('.txt'))
+
+
+def process_with_prompts(text, api_key, api_type='deepseek',prompts_dir='prompts',output_dir='output',
+                         prompt_files=None, on_delta=None, layout=None):
     """
     读取prompts文件夹中的提示词文件并调用AI处理
     
@@ -108,15 +316,27 @@ def process_with_prompts(text, api_key, api_type='deepseek',prompts_dir='prompts
         text (str): 要处理的文本
         api_key (str): API密钥
         api_type (str): API类型，支持'deepseek'和'claude'
+        prompt_files (list): 只处理这些提示词文件，为空则处理目录下全部txt文件
+        on_delta (callable): 流式输出时 on_delta(prompt_file, delta) 转发收到的内容，
+            delta 为 None 表示该提示词的输出重新开始
+        layout (str): 请求布局，默认取 AI_SUMMARY_LAYOUT；prefix 布局下所有提示词共享以转写文本开头的前缀，
+            只有第一次请求按原价计费输入，其余命中服务商的前缀缓存
     
     Returns:
         bool: 处理是否成功
     """
-    max_workers = config.AI_THREADS
+    layout = layout or config.AI_SUMMARY_LAYOUT
+    with track_usage() as usage:
+        ok = _process_with_prompts(text, api_key, api_type, prompts_dir, output_dir, prompt_files, on_delta, layout)
+    if usage.stats()['requests']:
+        logger.info(f'总结步骤（{layout} 布局）用量: {usage.summary()}')
+    return ok
 
+
+def _process_with_prompts(text, api_key, api_type, prompts_dir, output_dir, prompt_files, on_delta, layout):
     try:
         start_time = time.time()
-        logger.info(f'开始处理提示词文件，使用{max_workers}个线程')
+        logger.info(f'开始处理提示词文件，最大并发请求数: {config.AI_CONCURRENCY}')
         
         # 确保prompts和output目录存在
         #prompts_dir = 'prompts'
@@ -127,55 +347,89 @@ def process_with_prompts(text, api_key, api_type='deepseek',prompts_dir='prompts
                 logger.debug(f'创建目录: {dir_path}')
         
         # 获取prompts目录下的所有txt文件
-        prompt_files = [f for f in os.listdir(prompts_dir) if f.endswith('.txt')]
+        if prompt_files is None:
+            prompt_files = list_prompt_files(prompts_dir)
         if not prompt_files:
             logger.warning(format_message(Codes.PROMPT_MISSING, 'prompts目录中没有找到txt文件'))
             return None
         
-        def process_single_prompt(prompt_file):
+        # 读取提示词文件内容
+        prompts = []
+        for prompt_file in prompt_files:
+            prompt_path = os.path.join(prompts_dir, prompt_file)
             try:
-                # 读取提示词文件内容
-                prompt_path = os.path.join(prompts_dir, prompt_file)
                 with open(prompt_path, 'r', encoding='utf-8') as f:
-                    prompt = f.read().strip()
-                
-                # 调用AI处理
-                logger.debug(f'线程开始处理提示词文件: {prompt_file}')
-                result = call_ai_api(text, api_key, prompt, api_type)
-                
-                if result:
-                    # 保存处理结果
-                    base_name = os.path.splitext(prompt_file)[0]
-                    output_path = os.path.join(output_dir, f"{base_name}.md")
-                    if save_text_to_file(result, output_path):
-                        logger.debug(f'线程已保存处理结果到: {output_path}')
-                        return True
-                    else:
-                        logger.error(format_message(Codes.FILE_IO, f'线程保存处理结果失败: {output_path}'))
-                        return None
-                else:
-                    logger.error(format_message(Codes.AI_CALL_FAIL, f'线程处理文件失败: {prompt_file}'))
+                    prompts.append((prompt_file, f.read().strip()))
+            except Exception as e:
+                logger.error(format_message(Codes.FILE_IO, f'读取提示词文件失败 {prompt_file}', str(e)))
+
+        # 超长文本先分块总结再合并，最终合并请求与普通请求一样流式写入
+        requests = [(text, prompt) for _, prompt in prompts]
+        plan = map_reduce_plan(text, api_type)
+        if plan is not None:
+            final_inputs = _map_reduce_inputs(text, prompts, prompts_dir, api_key, api_type, plan, layout)
+            kept = [i for i, item in enumerate(final_inputs) if item is not None]
+            prompts = [prompts[i] for i in kept]
+            requests = [final_inputs[i] for i in kept]
+
+        success = []
+        output_paths = [
+            os.path.join(output_dir, f"{os.path.splitext(prompt_file)[0]}.md")
+            for prompt_file, _ in prompts
+        ]
+
+        # 流式输出：内容边收边追加写入对应的 .md，并转发给调用方
+        writers = None
+        if config.AI_STREAM:
+            def forwarder(prompt_file):
+                if on_delta is None:
                     return None
-            
+                return lambda delta: on_delta(prompt_file, delta)
+
+            writers = [
+                StreamingOutput(path, on_text=forwarder(prompt_file))
+                for (prompt_file, _), path in zip(prompts, output_paths)
+            ]
+
+        def on_prompt_done(idx, result):
+            prompt_file = prompts[idx][0]
+            output_path = output_paths[idx]
+            if writers is not None:
+                writer = writers[idx]
+                saved = writer.finish(result)
+                if result and writer.first_delta_at is not None:
+                    logger.info(f'{prompt_file} 首段内容在 {writer.first_delta_at - start_time:.2f} 秒后到达')
+            else:
+                saved = save_text_to_file(result, output_path) if result else None
+            if not result:
+                logger.error(format_message(Codes.AI_CALL_FAIL, f'处理文件失败: {prompt_file}'))
+                return
+            # 保存处理结果
+            if saved:
+                logger.debug(f'已保存处理结果到: {output_path}')
+                success.append(prompt_file)
+            else:
+                logger.error(format_message(Codes.FILE_IO, f'保存处理结果失败: {output_path}'))
+
+        def on_stream_delta(idx, delta):
+            try:
+                writers[idx].write(delta)
             except Exception as e:
-                logger.error(format_message(Codes.AI_CALL_FAIL, f'线程处理提示词文件时出错 {prompt_file}', str(e)))
-                return None
-        
-        # 使用线程池并行处理提示词文件
-        success_count = 0
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # 提交所有任务并获取future对象
-            future_dict = {executor.submit(process_single_prompt, prompt_file): prompt_file 
-                         for prompt_file in prompt_files}
-            
-            # 等待所有任务完成并收集结果
-            for future in as_completed(future_dict):
-                prompt_file = future_dict[future]
-                try:
-                    if future.result():
-                        success_count += 1
-                except Exception as e:
-                    logger.error(format_message(Codes.AI_CALL_FAIL, f'获取任务结果时出错 {prompt_file}', str(e)))
+                logger.warning(format_message(Codes.FILE_IO, f'写入流式输出失败: {output_paths[idx]}', str(e)))
+
+        # 分层总结中已经合并成单个结果的提示词直接保存，其余交给AI引擎并发处理
+        pending = []
+        for idx, (request_text, request_prompt) in enumerate(requests):
+            if request_prompt is None:
+                on_prompt_done(idx, request_text)
+            else:
+                pending.append(idx)
+
+        call_ai_batch([requests[idx] for idx in pending], api_key, api_type,
+                      on_result=lambda i, result: on_prompt_done(pending[i], result),
+                      on_delta=(lambda i, delta: on_stream_delta(pending[i], delta)) if writers is not None else None,
+                      layout=layout)
+        success_count = len(success)
         
         end_time = time.time()
         elapsed_time = end_time - start_time
@@ -0,0 +1,116 @@
+import logging
+import re
+import threading
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# 中日韩文字与全角标点，按单字计数
+CJK_RE = re.compile(r'[　-〿぀-ヿ㐀-䶿一-鿿가-힯豈-﫿＀-￯]')
+
+# 各服务商的估算系数：每个中日韩字符 / 每个其他非空白字符对应的 token 数
+# DeepSeek 取官方文档给出的经验值，其余为对常见中英文文本的粗略测量
+ESTIMATE_RATIOS = {
+    'deepseek': (0.6, 0.3),
+    'openai': (0.8, 0.25),
+    'claude': (1.1, 0.3),
+}
+DEFAULT_RATIOS = (1.0, 0.3)
+
+
+class EstimateTokenizer:
+    """按字符类别估算 token 数，不依赖词表，速度快"""
+
+    def __init__(self, cjk_ratio, other_ratio, name='estimate'):
+        self.cjk_ratio = cjk_ratio
+        self.other_ratio = other_ratio
+        self.name = name
+
+    def count(self, text):
+        if not text:
+            return 0
+        cjk = len(CJK_RE.findall(text))
+        other = len(text) - cjk - sum(1 for c in text if c.isspace())
+        return int(round(cjk * self.cjk_ratio + max(other, 0) * self.other_ratio)) or 1
+
+
+class TiktokenTokenizer:
+    """使用 tiktoken 的 BPE 词表精确计数"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.name = f'tiktoken:{encoding.name}'
+
+    def count(self, text):
+        if not text:
+            return 0
+        return len(self.encoding.encode_ordinary(text))
+
+
+def _load_tiktoken(api_type):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        if api_type == 'openai':
+            try:
+                return TiktokenTokenizer(tiktoken.encoding_for_model(config.OPENAI_MODEL))
+            except KeyError:
+                return TiktokenTokenizer(tiktoken.get_encoding('o200k_base'))
+        return TiktokenTokenizer(tiktoken.get_encoding(config.TOKENIZER_ENCODING or 'cl100k_base'))
+    except Exception as e:
+        # 词表文件需要联网下载，失败时回退到估算
+        logger.warning(f'加载 tiktoken 词表失败，改用估算: {e}')
+        return None
+
+
+_tokenizers = {}
+_tokenizers_lock = threading.Lock()
+
+
+def register_tokenizer(api_type, tokenizer):
+    """为指定服务商注册分词器，tokenizer 需提供 count(text) 方法与 name 属性"""
+    with _tokenizers_lock:
+        _tokenizers[api_type] = tokenizer
+
+
+def get_tokenizer(api_type):
+    """
+    返回指定服务商的分词器
+
+    TOKENIZER_MODE 为 auto 时，OpenAI 使用 tiktoken（已安装时），其他服务商的词表不公开，
+    使用按字符类别的估算；estimate 时一律估算；tiktoken 时一律使用 tiktoken（未安装则回退估算）。
+    """
+    with _tokenizers_lock:
+        tokenizer = _tokenizers.get(api_type)
+        if tokenizer is not None:
+            return tokenizer
+        mode = (config.TOKENIZER_MODE or 'auto').lower()
+        if mode == 'tiktoken' or (mode == 'auto' and api_type == 'openai'):
+            tokenizer = _load_tiktoken(api_type)
+        if tokenizer is None:
+            cjk_ratio, other_ratio = ESTIMATE_RATIOS.get(api_type, DEFAULT_RATIOS)
+            tokenizer = EstimateTokenizer(cjk_ratio, other_ratio, name=f'estimate:{api_type}')
+        _tokenizers[api_type] = tokenizer
+        return tokenizer
+
+
+def count_tokens(text, api_type):
+    return get_tokenizer(api_type).count(text)
+
+
+def chunk_token_budget(output_ratio=None, max_output_tokens=None):
+    """
+    每个分块的输入 token 上限
+
+    取 CHUNK_TOKENS 与输出预算换算值中的较小者：修正润色的输出长度约为输入的 output_ratio 倍，
+    输入过长会让输出超出 MODEL_MAX_TOKENS 被截断。
+    """
+    output_ratio = output_ratio or config.CHUNK_OUTPUT_RATIO
+    max_output_tokens = max_output_tokens or config.MODEL_MAX_TOKENS
+    budget = config.CHUNK_TOKENS
+    if output_ratio > 0:
+        budget = min(budget, int(max_output_tokens / output_ratio))
+    return max(budget, 1)
@@ -1,12 +1,18 @@
 import os
 import time
 import logging
+import threading
+from contextlib import contextmanager
 import torch
 import config
 from .errors import Codes, format_message
+from .model_pool import get_model_pool
+from .video_processor import is_pcm_file, load_pcm
 
 logger = logging.getLogger(__name__)
 
+SAMPLE_RATE = 16000
+
 def get_device(mode):
     """
     根据 mode 选择设备，支持 "cpu" 或 "gpu"
@@ -23,12 +29,16 @@ def get_device(mode):
     else:
         raise ValueError("mode must be 'cpu' or 'gpu'")
 
+FASTER_WHISPER_COMPUTE_TYPES = ("int8", "int8_float32", "float32", "int8_float16", "float16")
+
 def normalize_model_type(value):
     if not value:
         return None
     value = str(value).strip().lower()
     if value in ("whisper", "paraformer"):
         return value
+    if value in ("faster-whisper", "faster_whisper", "fasterwhisper"):
+        return "faster-whisper"
     return None
 
 def normalize_optional(value):
@@ -38,19 +48,393 @@ def normalize_optional(value):
         return None
     return value
 
-def transcribe_audio(audio_path, prompt, model_type=None, model_size=None, device_mode=None):
+@contextmanager
+def model_context(key, loader):
+    """
+    获取转写模型：启用模型池时从常驻池中复用，否则每次重新加载
+    """
+    if config.TRANS_POOL_ENABLED:
+        with get_model_pool().use(key, loader) as model:
+            yield model
+        return
+    model_load_start = time.time()
+    model = loader()
+    logger.info(f"模型加载完成，耗时: {time.time() - model_load_start:.2f} 秒")
+    yield model
+
+def resolve_model_settings(model_type=None, model_size=None, device_mode=None):
+    """
+    合并调用参数与 config，得到实际使用的模型类型、规格与设备
+
+    返回:
+        dict: model_type / model_size / device（torch 设备名）/ device_str（funasr 设备名）
+    """
+    # 获取模型名称、类型和设备（可在 config 中配置，否则使用默认值）
+    config_model_type = normalize_model_type(getattr(config, "TRANS_MODEL_TYPE", "whisper"))
+    effective_model_type = normalize_model_type(model_type) or config_model_type or "whisper"
+    effective_model_size = model_size or getattr(config, "TRANS_MODEL_SIZE", "medium")
+    if effective_model_type == "paraformer" and not model_size and config_model_type != "paraformer":
+        effective_model_size = "paraformer-zh"
+    elif effective_model_type != "paraformer" and not model_size and config_model_type == "paraformer":
+        effective_model_size = "large-v3-turbo"
+    effective_device_mode = device_mode or getattr(config, "TRANS_DEVICE", "cpu")
+
+    device = get_device(effective_device_mode)
+    device_str = "cpu"
+    if device.type == "cuda":
+        device_str = str(device)
+
+    settings = {
+        "model_type": effective_model_type,
+        "model_size": effective_model_size,
+        "device": str(device),
+        "device_str": device_str,
+    }
+    if effective_model_type == "whisper":
+        quantize = normalize_optional(str(getattr(config, "TRANS_QUANTIZE", "") or "").strip().lower())
+        if quantize not in (None, "none", "dynamic"):
+            raise ValueError(f"不支持的量化方式: {quantize}")
+        if quantize == "dynamic" and device.type != "cpu":
+            logger.info("动态 int8 量化仅支持 CPU，当前设备不做量化")
+            quantize = None
+        settings["quantize"] = None if quantize == "none" else quantize
+    if effective_model_type == "faster-whisper":
+        compute_type = str(getattr(config, "TRANS_FW_COMPUTE_TYPE", "int8")).strip().lower()
+        if compute_type not in FASTER_WHISPER_COMPUTE_TYPES:
+            raise ValueError(f"不支持的 faster-whisper compute_type: {compute_type}")
+        settings["compute_type"] = compute_type
+        settings["cpu_threads"] = int(getattr(config, "TRANS_FW_CPU_THREADS", 0))
+        settings["num_workers"] = int(getattr(config, "TRANS_FW_NUM_WORKERS", 1))
+    return settings
+
+def quantize_whisper_dynamic(model):
+    """
+    对 whisper 模型的编码器/解码器 Linear 层做 torch 动态 int8 量化（仅 CPU）
+
+    whisper 自带的 Linear 是 nn.Linear 的子类，quantize_dynamic 只按精确类型匹配，
+    因此先替换为等价的 nn.Linear 再量化。
+    """
+    from torch import nn
+
+    start = time.time()
+
+    def to_plain_linear(module):
+        for name, child in module.named_children():
+            if isinstance(child, nn.Linear) and type(child) is not nn.Linear:
+                plain = nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+                plain.weight = child.weight
+                if child.bias is not None:
+                    plain.bias = child.bias
+                setattr(module, name, plain)
+            else:
+                to_plain_linear(child)
+
+    model = model.float().eval()
+    to_plain_linear(model)
+    model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    logger.info(f"whisper 动态 int8 量化完成，耗时: {time.time() - start:.2f} 秒")
+    return model
+
+def get_model_loader(settings):
+    """
+    根据模型配置返回 (模型池键, 加载函数)
+    """
+    model_type = settings["model_type"]
+    model_size = settings["model_size"]
+
+    if model_type == "whisper":
+        quantize = settings.get("quantize")
+
+        def load_whisper():
+            try:
+                import whisper
+            except Exception as e:
+                raise RuntimeError(f"openai-whisper 未安装或不可用: {e}") from e
+            logger.info(f"加载模型: whisper-{model_size}，使用设备: {settings['device']}")
+            model = whisper.load_model(model_size).to(torch.device(settings["device"]))
+            if quantize == "dynamic":
+                model = quantize_whisper_dynamic(model)
+            return model
+
+        return ("whisper", model_size, settings["device"], quantize), load_whisper
+
+    if model_type == "paraformer":
+        vad_model = normalize_optional(getattr(config, "TRANS_PARA_VAD_MODEL", "fsmn-vad"))
+        punc_model = normalize_optional(getattr(config, "TRANS_PARA_PUNC_MODEL", "ct-punc"))
+
+        def load_paraformer():
+            try:
+                from funasr import AutoModel
+            except Exception as e:
+                raise RuntimeError(f"FunASR 未安装或不可用: {e}") from e
+            logger.info(
+                f"加载模型: paraformer({model_size})，使用设备: {settings['device_str']}，vad={vad_model or 'off'}，punc={punc_model or 'off'}"
+            )
+            return AutoModel(
+                model=model_size,
+                vad_model=vad_model,
+                punc_model=punc_model,
+                device=settings["device_str"],
+                disable_update=True,
+            )
+
+        return ("paraformer", model_size, settings["device_str"], vad_model, punc_model), load_paraformer
+
+    if model_type == "faster-whisper":
+        # CTranslate2 只区分 cpu / cuda，mps 退回 cpu
+        fw_device = "cuda" if settings["device_str"].startswith("cuda") else "cpu"
+        compute_type = settings["compute_type"]
+        cpu_threads = settings["cpu_threads"]
+        num_workers = settings["num_workers"]
+
+        def load_faster_whisper():
+            try:
+                from faster_whisper import WhisperModel
+            except Exception as e:
+                raise RuntimeError(f"faster-whisper 未安装或不可用: {e}") from e
+            logger.info(
+                f"加载模型: faster-whisper-{model_size}，使用设备: {fw_device}，compute_type={compute_type}，"
+                f"cpu_threads={cpu_threads or 'auto'}，num_workers={num_workers}"
+            )
+            return WhisperModel(
+                model_size,
+                device=fw_device,
+                compute_type=compute_type,
+                cpu_threads=cpu_threads,
+                num_workers=num_workers,
+            )
+
+        key = ("faster-whisper", model_size, fw_device, compute_type, cpu_threads, num_workers)
+        return key, load_faster_whisper
+
+    raise ValueError(f"不支持的模型类型: {model_type}")
+
+def run_model(settings, model, audio, prompt):
+    """
+    使用已加载的模型转写一段音频
+
+    参数:
+        audio (str or numpy.ndarray): 音频文件路径，或 16 kHz 单声道 float32 数组
+
+    返回:
+        dict: {"text": 转写文本, "segments": [{"start", "end", "text"}, ...]}，时间单位为秒
+    """
+    model_type = settings["model_type"]
+    if model_type == "whisper":
+        # 调用模型进行转写，传入初始提示词（如果模型支持该参数）
+        result = model.transcribe(audio, initial_prompt=prompt)
+        segments = [
+            {"start": seg.get("start", 0.0), "end": seg.get("end", 0.0), "text": seg.get("text", "")}
+            for seg in result.get("segments", [])
+        ]
+        return {"text": result.get("text", "").strip(), "segments": segments}
+
+    if model_type == "paraformer":
+        batch_size_s = int(getattr(config, "TRANS_PARA_BATCH_SIZE_S", 300))
+        result = model.generate(input=audio, batch_size_s=batch_size_s)
+        if isinstance(result, list) and result and isinstance(result[0], dict):
+            text = result[0].get("text", "").strip()
+        else:
+            text = str(result).strip()
+        return {"text": text, "segments": []}
+
+    if model_type == "faster-whisper":
+        beam_size = int(getattr(config, "TRANS_FW_BEAM_SIZE", 5))
+        # transcribe 返回生成器，遍历时才真正解码
+        fw_segments, _ = model.transcribe(audio, initial_prompt=prompt, beam_size=beam_size)
+        segments = [{"start": seg.start, "end": seg.end, "text": seg.text} for seg in fw_segments]
+        return {"text": join_texts(seg["text"] for seg in segments), "segments": segments}
+
+    raise ValueError(f"不支持的模型类型: {model_type}")
+
+def find_split_points(audio, segment_seconds, search_seconds=30.0, frame_seconds=0.03):
+    """
+    在静音处切分长音频：在每个目标切点附近 ±search_seconds 内选能量最低的帧作为切点
+
+    返回:
+        list: [(start_sample, end_sample), ...]
+    """
+    import numpy as np
+
+    total = len(audio)
+    segment_len = int(segment_seconds * SAMPLE_RATE)
+    if total <= segment_len:
+        return [(0, total)]
+
+    frame_len = max(int(frame_seconds * SAMPLE_RATE), 1)
+    frame_count = total // frame_len
+    frames = np.asarray(audio[:frame_count * frame_len], dtype=np.float32).reshape(frame_count, frame_len)
+    energy = np.sqrt(np.mean(frames * frames, axis=1))
+    # 平滑能量曲线，避免切在两个音节之间的短暂停顿
+    smooth = max(int(0.3 / frame_seconds), 1)
+    energy = np.convolve(energy, np.ones(smooth) / smooth, mode="same")
+
+    search_frames = int(search_seconds / frame_seconds)
+    bounds = []
+    start = 0
+    while total - start > segment_len:
+        target = (start + segment_len) // frame_len
+        lo = max(target - search_frames, start // frame_len + 1)
+        hi = min(target + search_frames, frame_count - 1)
+        if hi <= lo:
+            cut = start + segment_len
+        else:
+            cut = (lo + int(np.argmin(energy[lo:hi]))) * frame_len
+        bounds.append((start, cut))
+        start = cut
+    bounds.append((start, total))
+    return bounds
+
+def join_texts(texts):
+    """拼接各段文本，英文单词之间补空格，中文直接相连"""
+    merged = ""
+    for text in texts:
+        text = text.strip()
+        if not text:
+            continue
+        if merged and merged[-1].isascii() and merged[-1].isalnum() and text[0].isascii() and text[0].isalnum():
+            merged += " "
+        merged += text
+    return merged
+
+_worker_state = {}
+
+def _init_parallel_worker(settings, num_threads):
+    # 每个 worker 进程只加载一次模型，并限制 torch 线程数避免进程间争抢 CPU
+    torch.set_num_threads(num_threads)
+    if settings["model_type"] == "faster-whisper":
+        settings = dict(settings, cpu_threads=num_threads)
+    _, loader = get_model_loader(settings)
+    _worker_state["settings"] = settings
+    _worker_state["model"] = loader()
+
+def _transcribe_segment(index, samples, offset_seconds, prompt):
+    start = time.time()
+    result = run_model(_worker_state["settings"], _worker_state["model"], samples, prompt)
+    for seg in result["segments"]:
+        seg["start"] += offset_seconds
+        seg["end"] += offset_seconds
+    if not result["segments"] and result["text"]:
+        duration = len(samples) / SAMPLE_RATE
+        result["segments"] = [{"start": offset_seconds, "end": offset_seconds + duration, "text": result["text"]}]
+    return index, result, time.time() - start
+
+_parallel_executors = {}
+_parallel_executors_lock = threading.Lock()
+
+@contextmanager
+def parallel_executor(settings, workers, num_threads):
+    """
+    按配置取得常驻的 worker 进程池，同一配置的多次转写（包括同时进行的任务）共用一个池
+
+    新建进程池时只关闭其他配置中空闲的池，正在被其他任务使用的池不受影响
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+
+    key = (tuple(sorted(settings.items())), workers, num_threads)
+    with _parallel_executors_lock:
+        entry = _parallel_executors.get(key)
+        if entry is None:
+            for other_key, other in list(_parallel_executors.items()):
+                if other["users"] == 0:
+                    other["executor"].shutdown(wait=False)
+                    del _parallel_executors[other_key]
+            entry = {
+                "executor": ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_parallel_worker,
+                    initargs=(settings, num_threads),
+                ),
+                "users": 0,
+            }
+            _parallel_executors[key] = entry
+        entry["users"] += 1
+    try:
+        yield entry["executor"]
+    except BrokenProcessPool:
+        # 进程池已损坏，丢弃后下次重新创建
+        with _parallel_executors_lock:
+            if _parallel_executors.get(key) is entry:
+                del _parallel_executors[key]
+        raise
+    finally:
+        with _parallel_executors_lock:
+            entry["users"] -= 1
+
+def transcribe_parallel(audio_path, prompt, settings, workers):
     """
-    使用 whisper 或 paraformer 进行音频转写，并将结果保存到文本文件中
+    按静音切分音频，并在多个 worker 进程中并行转写，最后按顺序拼接文本与时间戳
+
+    返回:
+        dict: {"text", "segments", "wall_time", "segment_time"}，segment_time 为各段在 worker 内的解码耗时之和
+    """
+    from concurrent.futures import as_completed
+    from .video_processor import load_audio_samples
+
+    wall_start = time.time()
+    audio = load_audio_samples(audio_path, SAMPLE_RATE)
+    bounds = find_split_points(audio, config.TRANS_PARALLEL_SEGMENT_SECONDS)
+    num_threads = config.TRANS_PARALLEL_THREADS or max((os.cpu_count() or 1) // workers, 1)
+    logger.info(
+        f"并行转写：音频时长 {len(audio) / SAMPLE_RATE:.0f} 秒，切分为 {len(bounds)} 段，"
+        f"{workers} 个 worker 进程，每个进程 {num_threads} 个线程"
+    )
+
+    results = {}
+    segment_time = 0.0
+    with parallel_executor(settings, workers, num_threads) as executor:
+        futures = [
+            executor.submit(_transcribe_segment, idx, audio[start:end], start / SAMPLE_RATE, prompt)
+            for idx, (start, end) in enumerate(bounds)
+        ]
+        for future in as_completed(futures):
+            idx, result, elapsed = future.result()
+            results[idx] = result
+            segment_time += elapsed
+            logger.info(f"分段 {idx + 1}/{len(bounds)} 转写完成，耗时: {elapsed:.2f} 秒")
+
+    ordered = [results[i] for i in range(len(bounds))]
+    segments = [seg for r in ordered for seg in r["segments"]]
+    return {
+        "text": join_texts(r["text"] for r in ordered),
+        "segments": segments,
+        "wall_time": time.time() - wall_start,
+        "segment_time": segment_time,
+    }
+
+def should_transcribe_parallel(audio_path, settings):
+    workers = config.TRANS_PARALLEL_WORKERS
+    if workers <= 1:
+        return False
+    if settings["device"] != "cpu":
+        logger.info("并行转写仅支持 CPU，当前使用 GPU，改为串行转写")
+        return False
+    try:
+        from .video_processor import probe_duration
+        duration = probe_duration(audio_path)
+    except Exception:
+        duration = None
+    if duration is not None and duration < config.TRANS_PARALLEL_MIN_SECONDS:
+        return False
+    return True
+
+def transcribe_audio(audio_path, prompt, model_type=None, model_size=None, device_mode=None, output_dir=None):
+    """
+    使用 whisper、faster-whisper 或 paraformer 进行音频转写，并将结果保存到文本文件中
 
     参数:
-        audio_path (str): 音频文件路径
+        audio_path (str): 音频文件路径，支持预处理生成的 .pcm（16 kHz 单声道 float32）
         prompt (str): 转写提示词，将作为初始提示传入模型
-        model_type (str): 模型类型（whisper / paraformer），为空则使用 config
+        model_type (str): 模型类型（whisper / faster-whisper / paraformer），为空则使用 config
         model_size (str): 模型大小或模型名称（不同模型类型含义不同）
         device_mode (str): cpu / gpu，为空则使用 config
-    
+        output_dir (str): 转写结果的保存目录，为空则与输入文件同目录
+
     返回:
-        str or None: 转写成功时返回保存转写结果的文件名，失败时返回 None
+        str or None: 转写成功时返回保存转写结果的文件路径，失败时返回 None
     """
     try:
         # 将相对路径转换为绝对路径，并检查文件是否存在
@@ -62,79 +446,38 @@ def transcribe_audio(audio_path, prompt, model_type=None, model_size=None, devic
         logger.info(f"开始音频转写，输入文件路径: {audio_path}")
         start_time = time.time()
 
-        # 获取模型名称、类型和设备（可在 config 中配置，否则使用默认值）
-        config_model_type = normalize_model_type(getattr(config, "TRANS_MODEL_TYPE", "whisper"))
-        effective_model_type = normalize_model_type(model_type) or config_model_type or "whisper"
-        effective_model_size = model_size or getattr(config, "TRANS_MODEL_SIZE", "medium")
-        if effective_model_type == "paraformer" and not model_size and config_model_type != "paraformer":
-            effective_model_size = "paraformer-zh"
-        effective_device_mode = device_mode or getattr(config, "TRANS_DEVICE", "cpu")
-
-        device = get_device(effective_device_mode)
-        device_str = "cpu"
-        if device.type == "cuda":
-            device_str = str(device)
-
-        if effective_model_type == "whisper":
-            import whisper
-
-            logger.info(f"加载模型: whisper-{effective_model_size}，使用设备: {device}")
-            model_load_start = time.time()
-            model = whisper.load_model(effective_model_size).to(device)
-            model_load_time = time.time() - model_load_start
-            logger.info(f"模型加载完成，耗时: {model_load_time:.2f} 秒")
-
-            # 调用模型进行转写，传入初始提示词（如果模型支持该参数）
-            transcribe_start = time.time()
-            logger.debug(f"转写的音频路径：{audio_path}")
-            result = model.transcribe(audio_path, initial_prompt=prompt)
-
-            transcribe_time = time.time() - transcribe_start
-            transcription_text = result.get("text", "").strip()
-        elif effective_model_type == "paraformer":
-            try:
-                from funasr import AutoModel
-            except Exception as e:
-                logger.error(format_message(Codes.TRANSCRIBE_FAIL, "FunASR 未安装或不可用", str(e)))
-                return None
-
-            vad_model = normalize_optional(getattr(config, "TRANS_PARA_VAD_MODEL", "fsmn-vad"))
-            punc_model = normalize_optional(getattr(config, "TRANS_PARA_PUNC_MODEL", "ct-punc"))
-            batch_size_s = int(getattr(config, "TRANS_PARA_BATCH_SIZE_S", 300))
+        try:
+            settings = resolve_model_settings(model_type, model_size, device_mode)
+            pool_key, loader = get_model_loader(settings)
+        except ValueError as e:
+            logger.error(format_message(Codes.INVALID_ARGS, str(e)))
+            return None
 
-            if prompt:
-                logger.info("Paraformer 不支持 initial_prompt，已忽略该提示词。")
+        if settings["model_type"] == "paraformer" and prompt:
+            logger.info("Paraformer 不支持 initial_prompt，已忽略该提示词。")
 
+        if should_transcribe_parallel(audio_path, settings):
+            result = transcribe_parallel(audio_path, prompt, settings, config.TRANS_PARALLEL_WORKERS)
+            transcribe_time = result["wall_time"]
+            # 各段耗时是在互相争抢 CPU 的 worker 内测得的，不能代替串行转写的耗时；实际加速比用 benchmarks/parallel_transcribe.py 测量
             logger.info(
-                f"加载模型: paraformer({effective_model_size})，使用设备: {device_str}，vad={vad_model or 'off'}，punc={punc_model or 'off'}"
+                f"并行转写完成，墙钟耗时: {transcribe_time:.2f} 秒，各段在 worker 内的解码耗时合计: {result['segment_time']:.2f} 秒"
             )
-            model_load_start = time.time()
-            model = AutoModel(
-                model=effective_model_size,
-                vad_model=vad_model,
-                punc_model=punc_model,
-                device=device_str,
-                disable_update=True,
-            )
-            model_load_time = time.time() - model_load_start
-            logger.info(f"模型加载完成，耗时: {model_load_time:.2f} 秒")
-
-            transcribe_start = time.time()
-            logger.debug(f"转写的音频路径：{audio_path}")
-            result = model.generate(input=audio_path, batch_size_s=batch_size_s)
-            transcribe_time = time.time() - transcribe_start
-
-            if isinstance(result, list) and result and isinstance(result[0], dict):
-                transcription_text = result[0].get("text", "").strip()
-            else:
-                transcription_text = str(result).strip()
         else:
-            logger.error(format_message(Codes.INVALID_ARGS, f"不支持的模型类型: {effective_model_type}"))
-            return None
+            # 预处理输出的 .pcm 已是 16 kHz 单声道采样，内存映射后直接交给模型，不再二次解码
+            audio = load_pcm(audio_path) if is_pcm_file(audio_path) else audio_path
+            with model_context(pool_key, loader) as model:
+                transcribe_start = time.time()
+                logger.debug(f"转写的音频路径：{audio_path}")
+                result = run_model(settings, model, audio, prompt)
+                transcribe_time = time.time() - transcribe_start
+        transcription_text = result["text"]
 
-        # 构造输出文件名（与输入文件同目录，文件名添加 _transcribed 后缀）
+        # 构造输出文件名（默认与输入文件同目录，文件名添加 _转写 后缀）
         base_name = os.path.splitext(os.path.basename(audio_path))[0]
-        output_file = os.path.join(os.path.dirname(audio_path), f"{base_name}_转写.md")
+        output_dir = output_dir or os.path.dirname(audio_path)
+        os.makedirs(output_dir, exist_ok=True)
+        output_file = os.path.join(output_dir, f"{base_name}_转写.md")
         with open(output_file, "w", encoding="utf-8") as f:
             f.write(transcription_text)
 
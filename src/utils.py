@@ -2,10 +2,16 @@ import os
 import logging
 import shutil
 import re
+import threading
 from .errors import Codes, format_message
 
 logger = logging.getLogger(__name__)
 
+def _temp_path(path):
+    """与目标文件同目录的临时文件路径，写完后 os.replace 原子替换，读取方不会看到写了一半的文件"""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f'.{name}.{os.getpid()}.{threading.get_ident()}.tmp')
+
 def save_text_to_file(text, output_path):
     """
     将处理好的文本保存到指定文件
@@ -21,8 +27,10 @@ def save_text_to_file(text, output_path):
         logger.debug(f'开始保存文本到文件，输出路径: {output_path}')
         # 确保目标目录存在
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        with open(output_path, 'w', encoding='utf-8') as f:
+        tmp_path = _temp_path(output_path)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             f.write(text)
+        os.replace(tmp_path, output_path)
         logger.debug(f'文本保存完成，文件路径: {output_path}')
         return True
     except Exception as e:
@@ -44,7 +52,9 @@ def copy_file(src_path, dst_path):
         logger.debug(f'开始复制文件，源文件: {src_path}, 目标路径: {dst_path}')
         # 确保目标目录存在
         os.makedirs(os.path.dirname(dst_path), exist_ok=True)
-        shutil.copy2(src_path, dst_path)
+        tmp_path = _temp_path(dst_path)
+        shutil.copy2(src_path, tmp_path)
+        os.replace(tmp_path, dst_path)
         logger.debug(f'文件复制完成，目标路径: {dst_path}')
         return True
     except Exception as e:
@@ -76,7 +86,21 @@ def move_file(src_path, dst_path):
 
 
 
-def split_text_into_chunks(text, chunk_size):
+def _split_oversized(sentence, sentence_len, chunk_size):
+    """单句超过分块上限时按字符均分成若干段"""
+    parts = -(-sentence_len // chunk_size)
+    step = -(-len(sentence) // parts)
+    return [sentence[i:i + step] for i in range(0, len(sentence), step)]
+
+def split_text_into_chunks(text, chunk_size, length_fn=len):
+    """
+    按句子边界把文本装入不超过 chunk_size 的分块
+
+    Args:
+        text (str): 原始文本
+        chunk_size (int): 每个分块的长度上限
+        length_fn (callable): 长度计算方法，默认按字符数；传入分词器的 count 即按 token 数分块
+    """
     # 统一的正则表达式：
     # .+? —— 非贪婪匹配任意字符
     # (?:\s*[，。！？；：,.!?;:]+\s*|\s+|$)
@@ -91,15 +115,23 @@ def split_text_into_chunks(text, chunk_size):
     
     chunks = []
     current_chunk = ""
+    current_len = 0
     for sentence in sentences:
         #print("[" + sentence + "]")
-        candidate = (current_chunk  + sentence) if current_chunk else sentence
-        if len(candidate) <= chunk_size:
-            current_chunk = candidate
-        else:
-            if current_chunk:
-                chunks.append(current_chunk)
-            current_chunk = sentence
+        sentence_len = length_fn(sentence)
+        pieces = [sentence]
+        if sentence_len > chunk_size:
+            pieces = _split_oversized(sentence, sentence_len, chunk_size)
+        for piece in pieces:
+            piece_len = sentence_len if len(pieces) == 1 else length_fn(piece)
+            if current_chunk and current_len + piece_len <= chunk_size:
+                current_chunk += piece
+                current_len += piece_len
+            else:
+                if current_chunk:
+                    chunks.append(current_chunk)
+                current_chunk = piece
+                current_len = piece_len
     if current_chunk:
         chunks.append(current_chunk)
     return chunks
@@ -1,18 +1,34 @@
 import os
+import re
 import logging
+import subprocess
 import ffmpeg
 import imageio_ffmpeg
+import config
 from .errors import Codes, format_message
 
 logger = logging.getLogger(__name__)
 
-def preprocess_video(video_path, output_dir=None):
+PCM_EXT = '.pcm'
+PCM_SAMPLE_RATE = 16000
+
+AUDIO_FILTERS = 'highpass=f=200,lowpass=f=3000,afftdn=nf=-25,loudnorm=I=-16:LRA=11:TP=-1.5'
+
+
+def is_pcm_file(path):
+    return isinstance(path, str) and path.lower().endswith(PCM_EXT)
+
+
+def preprocess_video(video_path, output_dir=None, output_format=None):
     """
     视频预处理，将视频转换为音频
 
     Args:
         video_path (str): 视频文件路径
         output_dir (str): 输出目录（可选）
+        output_format (str): m4a 或 pcm，为空则使用 config.PREPROCESS_FORMAT。
+            pcm 直接输出转写模型需要的 16 kHz 单声道 float32 原始采样（.pcm），
+            转写时内存映射读取，省去一次 AAC 编码和一次解码
 
     Returns:
         str: 生成的音频文件路径，如果处理失败则返回 None
@@ -24,30 +40,49 @@ def preprocess_video(video_path, output_dir=None):
             logger.error(format_message(Codes.INPUT_NOT_FOUND, f'输入文件不存在: {video_path}'))
             return None
 
-        # 构建输出文件路径，使用 m4a 容器
+        output_format = (output_format or config.PREPROCESS_FORMAT or 'm4a').lower()
+        if output_format not in ('m4a', 'pcm'):
+            logger.error(format_message(Codes.INVALID_ARGS, f'不支持的预处理输出格式: {output_format}'))
+            return None
+        ext = PCM_EXT if output_format == 'pcm' else '.m4a'
+
+        # 构建输出文件路径
         base_name = os.path.splitext(os.path.basename(video_path))[0]
         if output_dir:
             os.makedirs(output_dir, exist_ok=True)
-            output_path = os.path.join(output_dir, f"{base_name}_音频.m4a")
+            output_path = os.path.join(output_dir, f"{base_name}_音频{ext}")
         else:
             base, _ = os.path.splitext(video_path)
-            output_path = f"{base}_音频.m4a"
+            output_path = f"{base}_音频{ext}"
 
         # 构造 ffmpeg 处理链
         # 使用 stream.audio 来仅保留音频流，并禁用视频（vn）
         # 合并音频滤镜：高通、低通、降噪、音量正规化
         stream = ffmpeg.input(video_path)
-        stream = ffmpeg.output(
-            stream.audio,
-            output_path,
-            vn=None,                     # 禁用视频
-            acodec='aac',                # 使用 AAC 编码器
-            ac=2,                        # 双声道
-            ar=44100,                    # 采样率 44.1 kHz
-            audio_bitrate='128k',        # 音频比特率 128 kbps
-            af='highpass=f=200,lowpass=f=3000,afftdn=nf=-25,loudnorm=I=-16:LRA=11:TP=-1.5',
-            y=None                      # 覆盖已存在的文件
-        )
+        if output_format == 'pcm':
+            stream = ffmpeg.output(
+                stream.audio,
+                output_path,
+                vn=None,                     # 禁用视频
+                format='f32le',              # 无容器的 float32 小端原始采样
+                acodec='pcm_f32le',
+                ac=1,                        # 单声道
+                ar=PCM_SAMPLE_RATE,          # 采样率 16 kHz，与转写模型一致
+                af=AUDIO_FILTERS,
+                y=None                      # 覆盖已存在的文件
+            )
+        else:
+            stream = ffmpeg.output(
+                stream.audio,
+                output_path,
+                vn=None,                     # 禁用视频
+                acodec='aac',                # 使用 AAC 编码器
+                ac=2,                        # 双声道
+                ar=44100,                    # 采样率 44.1 kHz
+                audio_bitrate='128k',        # 音频比特率 128 kbps
+                af=AUDIO_FILTERS,
+                y=None                      # 覆盖已存在的文件
+            )
 
         # 获取 ffmpeg 可执行文件的路径，imageio_ffmpeg 会自动下载所需的二进制文件
         ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
@@ -63,3 +98,56 @@ def preprocess_video(video_path, output_dir=None):
     except Exception as e:
         logger.error(format_message(Codes.PREPROCESS_FAIL, '视频预处理过程出错', str(e)))
         return None
+
+
+def load_pcm(pcm_path):
+    """
+    以内存映射方式读取预处理生成的 .pcm 文件（16 kHz 单声道 float32）
+
+    使用写时复制模式，模型可以直接当作普通数组使用，不会改动文件。
+    """
+    import numpy as np
+
+    return np.memmap(pcm_path, dtype='<f4', mode='c')
+
+
+def load_audio_samples(audio_path, sample_rate=PCM_SAMPLE_RATE):
+    """读取 16 kHz 单声道采样：.pcm 直接内存映射，其他格式用 ffmpeg 解码"""
+    if is_pcm_file(audio_path):
+        return load_pcm(audio_path)
+    return decode_audio_pcm(audio_path, sample_rate)
+
+
+def decode_audio_pcm(audio_path, sample_rate=16000):
+    """
+    将音视频解码为单声道 float32 PCM（numpy 数组），供转写模型直接使用
+
+    Args:
+        audio_path (str): 音视频文件路径
+        sample_rate (int): 目标采样率，whisper / paraformer 均为 16 kHz
+
+    Returns:
+        numpy.ndarray: 取值范围 [-1, 1] 的 float32 数组
+    """
+    import numpy as np
+
+    stream = ffmpeg.input(audio_path)
+    stream = ffmpeg.output(stream.audio, 'pipe:', format='f32le', acodec='pcm_f32le', ac=1, ar=sample_rate)
+    ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
+    out, _ = ffmpeg.run(stream, cmd=ffmpeg_exe, capture_stdout=True, capture_stderr=True)
+    return np.frombuffer(out, dtype=np.float32)
+
+
+def probe_duration(media_path):
+    """
+    读取音视频时长（秒），解析 ffmpeg -i 的输出，无法获取时返回 None
+    """
+    if is_pcm_file(media_path):
+        return os.path.getsize(media_path) / 4 / PCM_SAMPLE_RATE
+    ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
+    proc = subprocess.run([ffmpeg_exe, '-hide_banner', '-i', media_path], capture_output=True, text=True, errors='ignore')
+    match = re.search(r'Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)', proc.stderr or '')
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
@@ -0,0 +1,132 @@
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+import config
+from .errors import Codes, format_message
+
+logger = logging.getLogger(__name__)
+
+OWNER_FILE = 'owner.json'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+def workspace_root():
+    return config.WORKSPACE_DIR or os.path.join(config.TEMP_DIR, 'jobs')
+
+
+def prune_workspaces(root=None):
+    """
+    删除已退出进程遗留的工作目录，以及保留时间超过 WORKSPACE_KEEP_TTL_DAYS 的工作目录
+
+    只处理本机创建的目录；进程仍在运行的目录，以及无法确认归属且不足一天的目录会保留。
+    按 WORKSPACE_KEEP 保留的目录所属任务已经结束，到期即删除，不论创建它的进程是否仍在运行（如 Web 服务）。
+    """
+    root = root or workspace_root()
+    if not os.path.isdir(root):
+        return 0
+    host = socket.gethostname()
+    keep_ttl = config.WORKSPACE_KEEP_TTL_DAYS * 86400
+    removed = 0
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not os.path.isdir(path):
+            continue
+        try:
+            with open(os.path.join(path, OWNER_FILE), 'r', encoding='utf-8') as f:
+                owner = json.load(f)
+        except (OSError, ValueError):
+            owner = None
+        if owner is None:
+            stale = time.time() - os.path.getmtime(path) > 86400
+        elif owner.get('host') != host:
+            continue
+        elif owner.get('keep') is None:
+            stale = not _pid_alive(owner.get('pid', 0))
+        else:
+            kept_at = owner.get('kept') or os.path.getmtime(path)
+            stale = keep_ttl > 0 and time.time() - kept_at > keep_ttl
+        if stale:
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    if removed:
+        logger.info(f'已清理 {removed} 个遗留的任务工作目录')
+    return removed
+
+
+class Workspace:
+    """
+    单次任务的独立工作目录 <WORKSPACE_DIR>/<job_id>/
+
+    各步骤的中间文件写在这里（1/ 预处理音频、2/ 转写、3/ 修正润色），并发执行的多个任务互不干扰；
+    最终结果通过 promote() 原子地复制到输出目录。任务结束后按 WORKSPACE_KEEP 决定是否删除：
+    never 一律删除、failed 只保留失败任务的目录（默认，便于排查）、always 全部保留。
+    """
+
+    def __init__(self, job_id=None, root=None, keep=None):
+        self.job_id = job_id or f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.root = root or workspace_root()
+        self.path = os.path.join(self.root, self.job_id)
+        self.keep = (keep or config.WORKSPACE_KEEP or 'failed').lower()
+        self._closed = False
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._write_owner(None)
+        return self
+
+    def _write_owner(self, keep):
+        owner = {'pid': os.getpid(), 'thread': threading.get_ident(), 'host': socket.gethostname(),
+                 'created': time.time(), 'keep': keep, 'kept': time.time() if keep else None}
+        with open(os.path.join(self.path, OWNER_FILE), 'w', encoding='utf-8') as f:
+            json.dump(owner, f)
+
+    def dir(self, name):
+        """返回工作目录下的子目录（不存在时创建）"""
+        path = os.path.join(self.path, str(name))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def close(self, ok=True):
+        if self._closed:
+            return
+        self._closed = True
+        if self.keep == 'always' or (self.keep == 'failed' and not ok):
+            try:
+                # 标记为保留，避免被 prune_workspaces 当作遗留目录删除，超过 WORKSPACE_KEEP_TTL_DAYS 后再清理
+                self._write_owner('failed' if not ok else 'always')
+            except OSError:
+                pass
+            logger.info(f'保留任务工作目录: {self.path}')
+            return
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(ok=exc_type is None)
+        return False
+
+
+def open_workspace(job_id=None):
+    """创建任务工作目录，顺便清理已退出进程遗留的目录"""
+    try:
+        prune_workspaces()
+    except Exception as e:
+        logger.warning(format_message(Codes.FILE_IO, '清理遗留工作目录失败', str(e)))
+    return Workspace(job_id).open()
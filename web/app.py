@@ -1,5 +1,5 @@
 from flask import Flask, render_template, request, jsonify, send_file
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, join_room, leave_room
 import os
 import time
 import logging
@@ -7,9 +7,10 @@ import subprocess
 import sys
 import re
 import shutil
+import json
+import base64
 from pathlib import Path
-from threading import Thread, Lock
-from queue import Queue
+from threading import Thread, Lock, Event, local
 
 IS_WINDOWS = os.name == "nt"
 
@@ -25,6 +26,7 @@ import config
 from src.errors import Codes, format_message
 from src.logging_config import setup_logging
 import storage
+from job_queue import JobQueue, worker_id
 
 # 配置文件存储路径
 UPLOAD_FOLDER = 'data/upload'
@@ -51,11 +53,30 @@ ALLOWED_EXTS = {
     ".txt",
 }
 
+# 旧版 JSON 记录文件，首次启动时导入到 SQLite 后不再使用
 RECORDS_PATH = os.path.join(app.root_path, 'data', 'transcription_records.json')
-
-task_queue = Queue()
+record_store = storage.RecordStore(config.WEB_RECORDS_DB or os.path.join(app.root_path, 'data', 'records.sqlite3'))
+# 请求只读内存索引，写入同时落库；上传目录的对账在后台线程中进行
+record_index = storage.RecordIndex(record_store, os.path.join(app.root_path, UPLOAD_FOLDER), ALLOWED_EXTS)
+
+# 任务队列持久化在 SQLite 中，重启后未完成的任务继续执行；同一文件的任务由队列保证串行
+task_queue = JobQueue(
+    config.WEB_TASK_DB or os.path.join(app.root_path, 'data', 'tasks.sqlite3'),
+    lease_seconds=config.WEB_TASK_LEASE_SECONDS,
+    max_attempts=config.WEB_TASK_MAX_ATTEMPTS,
+)
+TASK_POLL_SECONDS = 5
 worker_lock = Lock()
-worker_thread = None
+worker_threads = []
+
+# 进度只推送给订阅了对应房间的客户端：job:<任务ID>、file:<文件ID>；列表页订阅 queue 频道接收汇总状态
+QUEUE_ROOM = 'queue'
+MAX_SUBSCRIBE_ROOMS = 100
+running_jobs = {}
+running_jobs_lock = Lock()
+queue_status_dirty = Event()
+queue_status_lock = Lock()
+queue_status_thread = None
 
 
 def sanitize_filename(filename):
@@ -80,6 +101,13 @@ def is_valid_steps(steps):
     return ordered == sorted(ordered)
 
 
+def parse_priority(value):
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
 def parse_bool(value, default=False):
     if value is None:
         return default
@@ -120,14 +148,65 @@ def is_valid_text_steps(steps):
     return steps in {'34', '4'}
 
 
-def load_records():
-    data = storage.load_records(RECORDS_PATH)
-    data, changed = storage.migrate_records(data, os.path.join(app.root_path, UPLOAD_FOLDER),
-                                            os.path.join(app.root_path, OUTPUT_FOLDER), ALLOWED_EXTS)
-    data, sync_changed = storage.sync_with_upload(data, os.path.join(app.root_path, UPLOAD_FOLDER), ALLOWED_EXTS)
-    if changed or sync_changed:
-        storage.save_records(RECORDS_PATH, data)
-    return data
+_records_ready = False
+_records_init_lock = Lock()
+records_startup = {}
+
+
+def init_records():
+    """
+    启动时执行一次：导入并迁移旧版 JSON 记录、加载内存索引、与上传目录对账，并启动后台对账线程
+    """
+    global _records_ready
+    if _records_ready:
+        return
+    with _records_init_lock:
+        if _records_ready:
+            return
+        start = time.perf_counter()
+        imported = 0
+        try:
+            imported = record_store.import_json(RECORDS_PATH, os.path.join(app.root_path, UPLOAD_FOLDER),
+                                                os.path.join(app.root_path, OUTPUT_FOLDER), ALLOWED_EXTS)
+        except Exception as e:
+            logger.error(format_message(Codes.FILE_IO, '导入旧版转写记录失败', str(e)))
+        import_ms = (time.perf_counter() - start) * 1000
+        count = record_index.load()
+        added = record_index.sync(force=True)
+        records_startup.update({
+            'imported': imported,
+            'records': count + added,
+            'import_ms': round(import_ms, 2),
+            'load_ms': record_index.stats()['load_ms'],
+            'sync_ms': record_index.stats()['sync_last_ms'],
+            'total_ms': round((time.perf_counter() - start) * 1000, 2),
+        })
+        logger.info(
+            f"转写记录已加载: {records_startup['records']} 条（导入 {imported} 条，补登 {added} 条），"
+            f"耗时 {records_startup['total_ms']}ms（导入 {records_startup['import_ms']}ms，"
+            f"加载 {records_startup['load_ms']}ms，对账 {records_startup['sync_ms']}ms）"
+        )
+        if config.WEB_RECORDS_SYNC_SECONDS > 0:
+            Thread(target=records_sync_loop, daemon=True, name='records-sync').start()
+        _records_ready = True
+
+
+def records_sync_loop():
+    # 上传目录修改时间未变化时 sync() 只做一次 stat
+    while True:
+        time.sleep(config.WEB_RECORDS_SYNC_SECONDS)
+        try:
+            added = record_index.sync()
+            if added:
+                logger.info(f'上传目录中新增 {added} 个文件，已补建转写记录')
+        except Exception as e:
+            logger.warning(format_message(Codes.FILE_IO, '上传目录对账失败', str(e)))
+
+
+def find_record(file_ref):
+    """按 file_id 或文件名查找记录"""
+    init_records()
+    return record_index.get(file_id=file_ref, filename=file_ref)
 
 
 def clean_output_line(line):
@@ -182,7 +261,8 @@ def normalize_output_filenames(output_dir, stored_name, display_name):
                 pass
 
 
-def save_text_input_record(filename, content, steps='34', auto_start=True, model_type=None, model_size=None):
+def save_text_input_record(filename, content, steps='34', auto_start=True, model_type=None, model_size=None,
+                           priority=0):
     safe_name = normalize_text_filename(filename)
     if not safe_name:
         return None, (Codes.INVALID_ARGS, '文件名无效')
@@ -217,11 +297,13 @@ def save_text_input_record(filename, content, steps='34', auto_start=True, model
         create_if_missing=True
     )
 
+    job_id = None
     if auto_start:
-        enqueue_task(file_id, steps, model_type, model_size)
+        job_id = enqueue_task(file_id, steps, model_type, model_size, priority)
 
     return {
         'id': file_id,
+        'job_id': job_id,
         'name': safe_name,
         'stored_name': stored_name,
         'queued': auto_start,
@@ -229,48 +311,251 @@ def save_text_input_record(filename, content, steps='34', auto_start=True, model
     }, None
 
 
+def heartbeat_loop(job_id, worker, stop):
+    # 每隔租约的三分之一续期一次，进程崩溃后租约过期，任务会被重新排队
+    while not stop.wait(config.WEB_TASK_LEASE_SECONDS / 3):
+        try:
+            alive = task_queue.heartbeat(job_id, worker)
+        except Exception as e:
+            # 数据库暂时被锁等错误不能让续期线程退出，否则租约过期后任务会被重复执行；下一轮重试
+            logger.warning(format_message(Codes.INTERNAL, '任务租约续期失败', f'job={job_id} err={e}'))
+            continue
+        if not alive:
+            logger.warning(format_message(Codes.TASK_FAIL, '任务租约已失效', f'job={job_id}'))
+            return
+
+
 def task_worker():
+    worker = worker_id()
     while True:
-        filename, steps, model_type, model_size = task_queue.get()
         try:
-            transcribe_task(filename, steps, model_type, model_size)
+            job = task_queue.claim(worker)
+        except Exception as e:
+            logger.error(format_message(Codes.INTERNAL, '领取任务失败', str(e)))
+            time.sleep(TASK_POLL_SECONDS)
+            continue
+        if job is None:
+            task_queue.wait_for_job(TASK_POLL_SECONDS)
+            continue
+        stop = Event()
+        Thread(target=heartbeat_loop, args=(job['id'], worker, stop), daemon=True).start()
+        ok, error = False, None
+        try:
+            ok, error = transcribe_task(job['file_ref'], job['steps'], job['model_type'], job['model_size'],
+                                        job_id=job['id'])
+        except Exception as e:
+            error = str(e)
         finally:
-            task_queue.task_done()
+            stop.set()
+            try:
+                task_queue.finish(job['id'], worker, ok, error)
+            except Exception as e:
+                logger.error(format_message(Codes.INTERNAL, '更新任务状态失败', f'job={job["id"]} err={e}'))
+            with running_jobs_lock:
+                running_jobs.pop(job['id'], None)
+            notify_queue_status()
+
+def task_worker_count():
+    if config.WEB_TASK_WORKERS > 0:
+        return config.WEB_TASK_WORKERS
+    if config.TASK_EXEC_MODE == 'inprocess':
+        # 各步骤的实际并发由调度器的资源池限制，任务线程数只需要能占满所有槽位
+        from src.scheduler import get_scheduler
+        return get_scheduler().capacity()
+    # worker / subprocess 模式下每个进程各有一套资源池，无法统一限制，默认串行
+    return 1
+
+def enqueue_task(filename, steps, model_type=None, model_size=None, priority=0):
+    job_id = task_queue.enqueue(filename, steps, model_type, model_size, priority)
+    start_task_workers()
+    notify_queue_status()
+    return job_id
+
+
+def job_rooms(job_id=None, file_id=None):
+    rooms = []
+    if job_id is not None:
+        rooms.append(f'job:{job_id}')
+    if file_id:
+        rooms.append(f'file:{file_id}')
+    return rooms
+
+
+def make_job_emitter(job_id=None, file_id=None):
+    """返回只向该任务与该文件的订阅者推送事件的 emit(event, data)"""
+    rooms = job_rooms(job_id, file_id)
+
+    def emit_to_job(event, data):
+        if rooms:
+            socketio.emit(event, dict(data, job_id=job_id, file_id=file_id), to=rooms)
+    return emit_to_job
+
+
+def queue_status_snapshot():
+    with running_jobs_lock:
+        running = [dict(info, job_id=job_id) for job_id, info in running_jobs.items()]
+    return {
+        'queue_depth': task_queue.pending_count(),
+        'jobs': task_queue.stats(),
+        'running': running,
+        'time': time.time(),
+    }
+
+
+def queue_status_loop():
+    # 合并短时间内的多次变化，每个间隔最多推送一次
+    while True:
+        queue_status_dirty.wait()
+        queue_status_dirty.clear()
+        try:
+            socketio.emit('queue_status', queue_status_snapshot(), to=QUEUE_ROOM)
+        except Exception as e:
+            logger.debug(f'推送队列状态失败: {e}')
+        time.sleep(config.WEB_QUEUE_STATUS_INTERVAL)
+
+
+def notify_queue_status():
+    """标记队列状态已变化，由后台线程推送给 queue 频道"""
+    global queue_status_thread
+    queue_status_dirty.set()
+    with queue_status_lock:
+        if queue_status_thread is None or not queue_status_thread.is_alive():
+            queue_status_thread = Thread(target=queue_status_loop, daemon=True, name='queue-status')
+            queue_status_thread.start()
+
+
+def set_running_job(job_id, **info):
+    if job_id is None:
+        return
+    with running_jobs_lock:
+        running_jobs.setdefault(job_id, {}).update(info)
+    notify_queue_status()
 
-def enqueue_task(filename, steps, model_type=None, model_size=None):
-    global worker_thread
-    task_queue.put((filename, steps, model_type, model_size))
+def start_task_workers():
     with worker_lock:
-        if worker_thread is None or not worker_thread.is_alive():
-            worker_thread = Thread(target=task_worker, daemon=True)
-            worker_thread.start()
+        worker_threads[:] = [t for t in worker_threads if t.is_alive()]
+        while len(worker_threads) < task_worker_count():
+            thread = Thread(target=task_worker, daemon=True, name=f'task-worker-{len(worker_threads)}')
+            thread.start()
+            worker_threads.append(thread)
+
+
+# 文件状态：接口参数中的取值 -> 页面显示的文字
+FILE_STATUSES = {
+    'pending': '未转写',
+    'transcribed': '已转写',
+    'fixed': '已修补',
+    'summarized': '已总结',
+}
+FILE_SORT_FIELDS = {'created_time', 'name', 'last_time'}
+FILES_PAGE_SIZE = 50
+FILES_MAX_PAGE_SIZE = 200
+DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+def file_status(item):
+    if item.get('summarized'):
+        return 'summarized'
+    if item.get('fixed'):
+        return 'fixed'
+    if item.get('transcribed'):
+        return 'transcribed'
+    return 'pending'
+
+
+def file_info(item):
+    created_time = item.get('created_time') or time.strftime('%Y-%m-%d %H:%M:%S')
+    display_time = item.get('last_summary_time') or item.get('last_fix_time') or item.get('last_time') or '未转写'
+    return {
+        'id': item.get('id'),
+        'name': item.get('file_name'),
+        'status': FILE_STATUSES[file_status(item)],
+        'transcribed': item.get('transcribed', False),
+        'last_time': display_time,
+        'created_time': created_time
+    }
 
 
 def get_files_info():
-    upload_dir = os.path.join(app.root_path, UPLOAD_FOLDER)
-    records = load_records()
-    items = storage.list_records(records, upload_dir, ALLOWED_EXTS)
-    files_info = []
-    for item in items:
-        created_time = item.get('created_time') or time.strftime('%Y-%m-%d %H:%M:%S')
-        display_time = item.get('last_summary_time') or item.get('last_fix_time') or item.get('last_time') or '未转写'
-        status = '未转写'
-        if item.get('summarized'):
-            status = '已总结'
-        elif item.get('fixed'):
-            status = '已修补'
-        elif item.get('transcribed'):
-            status = '已转写'
-        files_info.append({
-            'id': item.get('id'),
-            'name': item.get('file_name'),
-            'status': status,
-            'transcribed': item.get('transcribed', False),
-            'last_time': display_time,
-            'created_time': created_time
-        })
-    files_info.sort(key=lambda x: x['created_time'] or '', reverse=True)
-    return files_info
+    init_records()
+    # 索引中的列表已按创建时间倒序
+    return [file_info(item) for item in record_index.items()]
+
+
+def file_sort_key(item, sort):
+    if sort == 'name':
+        value = item.get('file_name')
+    elif sort == 'last_time':
+        value = item.get('last_summary_time') or item.get('last_fix_time') or item.get('last_time')
+    else:
+        value = item.get('created_time')
+    return [value or '', item.get('id') or '']
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key, ensure_ascii=False).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(key, list) or len(key) != 2 or not all(isinstance(k, str) for k in key):
+        return None
+    return key
+
+
+def parse_files_query(args):
+    """
+    解析 /api/v1/files 的查询参数
+
+    Returns:
+        tuple: (参数 dict, 错误信息)
+    """
+    statuses = {s.strip() for s in (args.get('status') or '').split(',') if s.strip()}
+    if statuses - set(FILE_STATUSES):
+        return None, f"status 仅支持 {', '.join(FILE_STATUSES)}"
+    date_from = (args.get('from') or '').strip()
+    date_to = (args.get('to') or '').strip()
+    if (date_from and not DATE_RE.match(date_from)) or (date_to and not DATE_RE.match(date_to)):
+        return None, 'from/to 需为 YYYY-MM-DD 格式'
+    sort = args.get('sort') or 'created_time'
+    if sort not in FILE_SORT_FIELDS:
+        return None, f"sort 仅支持 {', '.join(sorted(FILE_SORT_FIELDS))}"
+    order = (args.get('order') or 'desc').lower()
+    if order not in ('asc', 'desc'):
+        return None, 'order 仅支持 asc 或 desc'
+    try:
+        limit = min(max(1, int(args.get('limit') or FILES_PAGE_SIZE)), FILES_MAX_PAGE_SIZE)
+    except ValueError:
+        return None, 'limit 需为整数'
+    cursor = None
+    if args.get('cursor'):
+        cursor = decode_cursor(args['cursor'])
+        if cursor is None:
+            return None, 'cursor 无效'
+    since = None
+    if args.get('since') not in (None, ''):
+        try:
+            since = int(args['since'])
+        except ValueError:
+            return None, 'since 需为整数修订号'
+    return {
+        'statuses': statuses, 'date_from': date_from, 'date_to': date_to, 'sort': sort, 'order': order,
+        'limit': limit, 'cursor': cursor, 'since': since,
+    }, None
+
+
+def match_files_filter(item, query):
+    if query['statuses'] and file_status(item) not in query['statuses']:
+        return False
+    created = (item.get('created_time') or '')[:10]
+    if query['date_from'] and created < query['date_from']:
+        return False
+    if query['date_to'] and created > query['date_to']:
+        return False
+    return True
 
 
 @app.route('/test')
@@ -284,7 +569,66 @@ def index():
 
 @app.route('/files')
 def list_files():
-    return jsonify({'status': 'success', 'code': Codes.SUCCESS, 'files': get_files_info()})
+    init_records()
+    # 先取修订号再取列表，期间发生的修改会在下一次 since 增量查询中再次返回
+    version = record_index.version()
+    return jsonify({'status': 'success', 'code': Codes.SUCCESS, 'files': get_files_info(), 'version': version})
+
+@app.route('/api/v1/files')
+def api_list_files():
+    """
+    分页的文件列表
+
+    参数：status（pending/transcribed/fixed/summarized，可逗号分隔多个）、from/to（创建日期 YYYY-MM-DD）、
+    sort（created_time/name/last_time）、order（asc/desc）、limit、cursor（上一页返回的 next_cursor）；
+    since=<修订号> 时只返回该修订号之后变化的文件与被移除的文件 id。
+    响应带 ETag（当前修订号），列表未变化时返回 304。
+    """
+    query, error = parse_files_query(request.args)
+    if error:
+        return jsonify({'status': 'error', 'code': Codes.INVALID_ARGS, 'message': error}), 400
+    init_records()
+    version = record_index.version()
+    etag = f'r{version}'
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    if query['since'] is not None:
+        version, changed, removed = record_index.changes(query['since'])
+        files = []
+        for item in changed:
+            if match_files_filter(item, query):
+                files.append(dict(file_info(item), revision=item['revision']))
+            else:
+                # 不再符合筛选条件的文件，客户端应从列表中移除
+                removed.append(item['id'])
+        data = {'version': version, 'since': query['since'], 'files': files, 'removed': sorted(removed)}
+    else:
+        items = [item for item in record_index.items() if match_files_filter(item, query)]
+        reverse = query['order'] == 'desc'
+        items.sort(key=lambda item: file_sort_key(item, query['sort']), reverse=reverse)
+        total = len(items)
+        if query['cursor'] is not None:
+            cursor = query['cursor']
+            items = [item for item in items
+                     if (file_sort_key(item, query['sort']) < cursor if reverse
+                         else file_sort_key(item, query['sort']) > cursor)]
+        page = items[:query['limit']]
+        next_cursor = None
+        if len(items) > query['limit']:
+            next_cursor = encode_cursor(file_sort_key(page[-1], query['sort']))
+        data = {
+            'version': version,
+            'total': total,
+            'files': [dict(file_info(item), revision=item['revision']) for item in page],
+            'next_cursor': next_cursor,
+        }
+    response = jsonify({'status': 'success', 'code': Codes.SUCCESS, 'data': data})
+    response.set_etag(f'r{version}', weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/download', methods=['POST'])
 def download_video():
@@ -342,6 +686,7 @@ def upload_files():
     auto_start = request.form.get('auto_start', '1') == '1'
     model_type = (request.form.get('model_type') or '').strip() or None
     model_size = (request.form.get('model_size') or '').strip() or None
+    priority = parse_priority(request.form.get('priority'))
 
     if not files:
         return jsonify({'status': 'error', 'code': Codes.INVALID_ARGS, 'message': '未选择文件'})
@@ -352,6 +697,7 @@ def upload_files():
     saved = []
     errors = []
     queued = []
+    jobs = []
 
     for f in files:
         original_name = f.filename
@@ -385,8 +731,9 @@ def upload_files():
                 create_if_missing=True
             )
             if auto_start:
-                enqueue_task(file_id, steps, model_type, model_size)
+                job_id = enqueue_task(file_id, steps, model_type, model_size, priority)
                 queued.append(safe_name)
+                jobs.append({'name': safe_name, 'file_id': file_id, 'job_id': job_id})
             logger.info(f"上传成功: {safe_name}")
         except Exception as e:
             errors.append({'file': original_name, 'code': Codes.UPLOAD_FAIL, 'message': str(e)})
@@ -394,7 +741,8 @@ def upload_files():
 
     status = 'success' if saved else 'error'
     code = Codes.SUCCESS if saved else Codes.UPLOAD_FAIL
-    return jsonify({'status': status, 'code': code, 'saved': saved, 'queued': queued, 'errors': errors})
+    return jsonify({'status': status, 'code': code, 'saved': saved, 'queued': queued, 'jobs': jobs,
+                    'errors': errors})
 
 
 @app.route('/text_input', methods=['POST'])
@@ -414,6 +762,7 @@ def create_text_input():
         auto_start=auto_start,
         model_type=model_type,
         model_size=model_size,
+        priority=parse_priority(data.get('priority')),
     )
     if error:
         code, message = error
@@ -438,6 +787,7 @@ def api_create_text_input():
         auto_start=auto_start,
         model_type=model_type,
         model_size=model_size,
+        priority=parse_priority(data.get('priority')),
     )
     if error:
         code, message = error
@@ -454,16 +804,17 @@ def api_create_text_input():
 def start_transcribe():
     filename = request.form.get('filename')
     steps = request.form.get('steps', '12')  # 默认只执行转写步骤
+    target = (request.form.get('target') or '').strip() or None
     model_type = (request.form.get('model_type') or '').strip() or None
     model_size = (request.form.get('model_size') or '').strip() or None
+    priority = parse_priority(request.form.get('priority'))
 
     if not filename:
         return jsonify({'status': 'error', 'code': Codes.INVALID_ARGS, 'message': '未提供文件名'})
-    if not is_valid_steps(steps):
+    if not target and not is_valid_steps(steps):
         return jsonify({'status': 'error', 'code': Codes.INVALID_ARGS, 'message': 'steps 参数不合法'})
     # 允许 filename 传入 file_id
-    records = load_records()
-    record = storage.find_record(records, file_id=filename, filename=filename)
+    record = find_record(filename)
     if record:
         if record.get('id'):
             filename = record.get('id')
@@ -471,18 +822,24 @@ def start_transcribe():
         stored_name = (record.get('stored_name') or display_name)
         if not os.path.exists(os.path.join(app.root_path, UPLOAD_FOLDER, stored_name)):
             return jsonify({'status': 'error', 'code': Codes.INPUT_NOT_FOUND, 'message': '文件不存在'})
+        if target:
+            # 按目标产物推导步骤链，未过期的步骤在执行时会被跳过
+            from src.pipeline import plan_target_steps
+            try:
+                steps = ''.join(str(s) for s in plan_target_steps(display_name, target))
+            except ValueError as e:
+                return jsonify({'status': 'error', 'code': Codes.INVALID_ARGS, 'message': str(e)})
         if is_text_file(display_name) and not is_valid_text_steps(steps):
             return jsonify({'status': 'error', 'code': Codes.INVALID_ARGS, 'message': 'txt 文件仅支持步骤 34 或 4'})
     else:
         return jsonify({'status': 'error', 'code': Codes.INPUT_NOT_FOUND, 'message': '文件记录不存在，请刷新列表'})
     
-    enqueue_task(filename, steps, model_type, model_size)
-    return jsonify({'status': 'success', 'code': Codes.SUCCESS, 'message': '已加入任务队列'})
+    job_id = enqueue_task(filename, steps, model_type, model_size, priority)
+    return jsonify({'status': 'success', 'code': Codes.SUCCESS, 'message': '已加入任务队列', 'job_id': job_id})
 
 @app.route('/transcribe/<filename>')
 def view_transcription(filename):
-    records = load_records()
-    record = storage.find_record(records, file_id=filename, filename=filename)
+    record = find_record(filename)
     if record:
         norm = storage.normalize_record(record, ALLOWED_EXTS)
         base_name = norm['output_folder']
@@ -499,7 +856,7 @@ def view_transcription(filename):
     # 获取目录下的所有文件
     files = []
     if os.path.exists(file_output_dir):
-        files = [{'name': f} for f in os.listdir(file_output_dir)]
+        files = [{'name': f} for f in os.listdir(file_output_dir) if not f.startswith('.')]
 
     # 获取默认显示的文件内容（优先 _转写.md）
     default_candidates = []
@@ -615,8 +972,7 @@ def save_output_file(folder, filename):
 def delete_all_file(filename):
     import shutil
 
-    records = load_records()
-    record = storage.find_record(records, file_id=filename, filename=filename)
+    record = find_record(filename)
     if record:
         norm = storage.normalize_record(record, ALLOWED_EXTS)
         stored_name = norm['stored_name']
@@ -648,12 +1004,7 @@ def delete_all_file(filename):
             return jsonify({'status': 'error', 'code': Codes.FILE_IO, 'message': f'删除输出文件夹时出错: {str(e)}'})
     
     # 删除转写记录
-    records = load_records()
-    records['records'] = [
-        r for r in records.get('records', [])
-        if not (isinstance(r, dict) and (r.get('id') == filename or r.get('file_name') == display_name))
-    ]
-    storage.save_records(RECORDS_PATH, records)
+    record_index.delete(file_id=filename, filename=display_name)
     
     return jsonify({'status': 'success', 'code': Codes.SUCCESS, 'message': '文件删除成功'})
 
@@ -682,13 +1033,8 @@ def update_transcription_record(filename=None, file_id=None, stored_name=None, o
     if not file_id and not filename:
         logger.error(format_message(Codes.INVALID_ARGS, '转写记录文件名无效', str(filename)))
         return
-    records = load_records()
-    existing = storage.find_record(records, file_id=file_id, filename=filename)
-    if not existing and not create_if_missing:
-        logger.error(format_message(Codes.INPUT_NOT_FOUND, '转写记录不存在', str(filename or file_id)))
-        return
-    storage.upsert_record(
-        records,
+    init_records()
+    record = record_index.upsert(
         file_name=filename or stored_name or file_id,
         file_id=file_id,
         stored_name=stored_name,
@@ -700,38 +1046,16 @@ def update_transcription_record(filename=None, file_id=None, stored_name=None, o
         last_fix_time=last_fix_time,
         last_summary_time=last_summary_time,
         created_time=created_time,
+        create_if_missing=create_if_missing,
     )
-    storage.save_records(RECORDS_PATH, records)
+    if record is None:
+        logger.error(format_message(Codes.INPUT_NOT_FOUND, '转写记录不存在', str(filename or file_id)))
 
 
-def transcribe_task(file_ref, steps='12', model_type=None, model_size=None):
-    records = load_records()
-    record = storage.find_record(records, file_id=file_ref, filename=file_ref)
-    if record:
-        norm = storage.normalize_record(record, ALLOWED_EXTS)
-        stored_name = norm['stored_name']
-        display_name = norm['file_name']
-        output_folder = norm['output_folder']
-        file_id = norm['id']
-    else:
-        logger.error(format_message(Codes.INPUT_NOT_FOUND, '转写记录不存在', str(file_ref)))
-        socketio.emit('transcribe_progress', {'data': f'转写记录不存在：{file_ref}，请刷新列表'})
-        return
-
-    input_file = os.path.join(app.root_path, UPLOAD_FOLDER, stored_name)
-    file_output_dir = os.path.join(app.root_path, OUTPUT_FOLDER, output_folder)
-    os.makedirs(file_output_dir, exist_ok=True)
-    
-    update_transcription_record(
-        filename=display_name,
-        file_id=file_id,
-        stored_name=stored_name,
-        output_folder=output_folder,
-        create_if_missing=False
-    )
-    logger.info(f"开始任务: {display_name} steps={steps} model_type={model_type or 'default'} model_size={model_size or 'default'}")
-    socketio.emit('transcribe_progress', {'data': f'开始转写：{display_name} (步骤：{steps})'})
-    
+def run_task_subprocess(input_file, file_output_dir, steps, prompts_dir, model_type=None, model_size=None,
+                        incremental=False, emit=None):
+    """隔离模式：每个任务启动一个 cli.py 子进程，并逐行转发其输出"""
+    emit = emit or socketio.emit
     python_exec = sys.executable or 'python'
     cmd = [
         python_exec,
@@ -740,14 +1064,17 @@ def transcribe_task(file_ref, steps='12', model_type=None, model_size=None):
         '-i', input_file,
         '-o', file_output_dir,
         '--steps', steps,
-        '--prompts-dir', str(WEB_DIR / 'data' / 'prompts'),
+        '--prompts-dir', prompts_dir,
         '--nobanner'
     ]
     if model_type:
         cmd.extend(['--transcribe-model-type', model_type])
     if model_size:
         cmd.extend(['--transcribe-model-size', model_size])
-    
+    if incremental:
+        cmd.append('--incremental')
+
+    master_fd = None
     try:
         if IS_WINDOWS:
             process = subprocess.Popen(
@@ -761,7 +1088,7 @@ def transcribe_task(file_ref, steps='12', model_type=None, model_size=None):
                 for line in process.stdout:
                     line = clean_output_line(line)
                     if not should_skip_output(line):
-                        socketio.emit('transcribe_progress', {'data': line})
+                        emit('transcribe_progress', {'data': line})
             return_code = process.wait()
         else:
             import pty
@@ -774,7 +1101,7 @@ def transcribe_task(file_ref, steps='12', model_type=None, model_size=None):
                 bufsize=1
             )
             os.close(slave_fd)  # 关闭子进程中不再需要的文件描述符
-            
+
             # 实时读取输出
             while True:
                 try:
@@ -786,12 +1113,116 @@ def transcribe_task(file_ref, steps='12', model_type=None, model_size=None):
                     for line in output.splitlines():
                         line = clean_output_line(line)
                         if not should_skip_output(line):
-                            socketio.emit('transcribe_progress', {'data': line})
+                            emit('transcribe_progress', {'data': line})
                 if process.poll() is not None:
                     break
-            
+
             return_code = process.wait()
-        if return_code == 0:
+    finally:
+        if master_fd is not None:
+            try:
+                os.close(master_fd)
+            except Exception:
+                pass
+    if return_code == 0:
+        return True, None
+    return False, f'返回码: {return_code}'
+
+
+# worker 模式下每个任务线程各自持有一个 worker 进程（worker 进程内任务串行执行）
+pipeline_workers = local()
+
+
+def run_task_pipeline(file_id, input_file, file_output_dir, steps, prompts_dir, model_type=None, model_size=None,
+                      incremental=False, emit=None, job_id=None):
+    """
+    在 web 进程内（inprocess）或常驻 worker 进程内（worker）执行流水线，
+    以结构化事件推送进度，模型池在任务之间复用
+    """
+    emit = emit or make_job_emitter(job_id, file_id)
+
+    def on_event(data):
+        data = dict(data, file_id=file_id)
+        event = data.get('event')
+        if event == 'summary_delta':
+            # 流式总结内容单独推送，不写入进度日志
+            emit('summary_delta', data)
+            return
+        emit('pipeline_event', data)
+        if data.get('message'):
+            emit('transcribe_progress', {'data': data['message']})
+        if event in ('step_queued', 'step_start', 'step_skipped'):
+            set_running_job(job_id, step=data.get('step'), step_state=event[len('step_'):])
+
+    def on_output(line):
+        line = clean_output_line(line)
+        if not should_skip_output(line):
+            emit('transcribe_progress', {'data': line})
+
+    job = dict(
+        input_file=input_file,
+        output_dir=file_output_dir,
+        steps=steps,
+        prompts_dir=prompts_dir,
+        model_type=model_type,
+        model_size=model_size,
+        incremental=incremental,
+    )
+    if config.TASK_EXEC_MODE == 'worker':
+        from src.pipeline import PipelineWorkerClient
+        client = getattr(pipeline_workers, 'client', None)
+        if client is None:
+            client = pipeline_workers.client = PipelineWorkerClient(ROOT_DIR, cwd=os.getcwd())
+        result = client.run(on_event=on_event, on_output=on_output, **job)
+    else:
+        from src.pipeline import run_pipeline
+        result = run_pipeline(on_event=on_event, **job)
+    if result.get('ok'):
+        return True, None
+    return False, format_message(result.get('code'), result.get('message'))
+
+
+def transcribe_task(file_ref, steps='12', model_type=None, model_size=None, job_id=None):
+    """执行一个任务，返回 (是否成功, 错误信息)；进度推送到 job:<job_id> 与 file:<文件ID> 房间"""
+    record = find_record(file_ref)
+    if record:
+        norm = storage.normalize_record(record, ALLOWED_EXTS)
+        stored_name = norm['stored_name']
+        display_name = norm['file_name']
+        output_folder = norm['output_folder']
+        file_id = norm['id']
+    else:
+        logger.error(format_message(Codes.INPUT_NOT_FOUND, '转写记录不存在', str(file_ref)))
+        make_job_emitter(job_id, file_ref)('transcribe_progress', {'data': f'转写记录不存在：{file_ref}，请刷新列表'})
+        return False, '转写记录不存在'
+    emit = make_job_emitter(job_id, file_id)
+    set_running_job(job_id, file_id=file_id, name=display_name, steps=steps, step=None, step_state=None,
+                    started=time.time())
+
+    input_file = os.path.join(app.root_path, UPLOAD_FOLDER, stored_name)
+    file_output_dir = os.path.join(app.root_path, OUTPUT_FOLDER, output_folder)
+    os.makedirs(file_output_dir, exist_ok=True)
+    
+    update_transcription_record(
+        filename=display_name,
+        file_id=file_id,
+        stored_name=stored_name,
+        output_folder=output_folder,
+        create_if_missing=False
+    )
+    logger.info(f"开始任务: {display_name} steps={steps} model_type={model_type or 'default'} model_size={model_size or 'default'} mode={config.TASK_EXEC_MODE}")
+    emit('transcribe_progress', {'data': f'开始转写：{display_name} (步骤：{steps})'})
+
+    prompts_dir = str(WEB_DIR / 'data' / 'prompts')
+    try:
+        incremental = config.WEB_INCREMENTAL
+        if config.TASK_EXEC_MODE == 'subprocess':
+            ok, error = run_task_subprocess(input_file, file_output_dir, steps, prompts_dir, model_type, model_size,
+                                            incremental, emit=emit)
+        else:
+            ok, error = run_task_pipeline(file_id, input_file, file_output_dir, steps, prompts_dir, model_type,
+                                          model_size, incremental, emit=emit, job_id=job_id)
+        if ok:
             normalize_output_filenames(file_output_dir, stored_name, display_name)
             did_transcribe = '2' in steps
             did_fix = '3' in steps
@@ -810,20 +1241,150 @@ def transcribe_task(file_ref, steps='12', model_type=None, model_size=None):
                 last_summary_time=now_ts if did_summary else None,
                 create_if_missing=False
             )
-            socketio.emit('transcribe_complete', {'filename': display_name})
+            # 列表页只需知道有文件完成，同时推送给 queue 频道
+            socketio.emit('transcribe_complete', {'filename': display_name, 'job_id': job_id, 'file_id': file_id},
+                          to=job_rooms(job_id, file_id) + [QUEUE_ROOM])
             logger.info(f"任务完成: {display_name}")
         else:
-            socketio.emit('transcribe_progress', {'data': f'转写失败，返回码: {return_code}'})
-            logger.error(format_message(Codes.TASK_FAIL, '转写失败', f'file={display_name} code={return_code}'))
+            emit('transcribe_progress', {'data': f'转写失败，{error}'})
+            logger.error(format_message(Codes.TASK_FAIL, '转写失败', f'file={display_name} {error}'))
+        return ok, error
     except Exception as e:
-        socketio.emit('transcribe_progress', {'data': f'转写出错: {str(e)}'})
-        logger.error(format_message(Codes.TASK_FAIL, '转写出错', f'file={filename} err={e}'))
-    finally:
-        if not IS_WINDOWS:
-            try:
-                os.close(master_fd)
-            except Exception:
-                pass
+        emit('transcribe_progress', {'data': f'转写出错: {str(e)}'})
+        logger.error(format_message(Codes.TASK_FAIL, '转写出错', f'file={display_name} err={e}'))
+        return False, str(e)
+
+
+@app.route('/api/v1/model-pool')
+def api_model_pool_stats():
+    if config.TASK_EXEC_MODE != 'inprocess':
+        return jsonify({
+            'status': 'error',
+            'code': Codes.INVALID_ARGS,
+            'message': f'当前执行模式为 {config.TASK_EXEC_MODE}，模型池不在 web 进程内',
+        }), 400
+    from src.model_pool import get_model_pool
+    return jsonify({'status': 'success', 'code': Codes.SUCCESS, 'data': get_model_pool().stats()})
+
+@app.route('/api/v1/ai-clients')
+def api_ai_client_stats():
+    if config.TASK_EXEC_MODE != 'inprocess':
+        return jsonify({
+            'status': 'error',
+            'code': Codes.INVALID_ARGS,
+            'message': f'当前执行模式为 {config.TASK_EXEC_MODE}，AI 客户端不在 web 进程内',
+        }), 400
+    from src.ai_service import get_client_pool_stats
+    return jsonify({'status': 'success', 'code': Codes.SUCCESS, 'data': get_client_pool_stats()})
+
+def recover_task_queue():
+    """启动时把上次异常退出时执行中的任务重新排队，并继续执行队列中的任务"""
+    try:
+        requeued = task_queue.recover()
+        pruned = task_queue.prune(config.WEB_TASK_RETENTION_DAYS * 86400)
+    except Exception as e:
+        logger.error(format_message(Codes.INTERNAL, '恢复任务队列失败', str(e)))
+        return
+    if requeued:
+        logger.info(f'已重新排队 {requeued} 个上次未完成的任务')
+    if pruned:
+        logger.debug(f'已清理 {pruned} 条过期的任务记录')
+    if task_queue.pending_count():
+        start_task_workers()
+
+
+@app.route('/api/v1/scheduler')
+def api_scheduler_stats():
+    with worker_lock:
+        workers = len([t for t in worker_threads if t.is_alive()])
+    data = {
+        'mode': config.TASK_EXEC_MODE,
+        'workers': workers,
+        'queue_depth': task_queue.pending_count(),
+        'jobs': task_queue.stats(),
+        'tasks': task_queue.list_jobs(),
+        'pools': None,
+    }
+    if config.TASK_EXEC_MODE == 'inprocess':
+        from src.scheduler import get_scheduler
+        data['pools'] = get_scheduler().stats()
+    return jsonify({'status': 'success', 'code': Codes.SUCCESS, 'data': data})
+
+@app.route('/api/v1/records')
+def api_records_stats():
+    init_records()
+    return jsonify({'status': 'success', 'code': Codes.SUCCESS, 'data': {
+        'startup': records_startup,
+        'index': record_index.stats(),
+        'sync_interval_seconds': config.WEB_RECORDS_SYNC_SECONDS,
+    }})
+
+@app.route('/api/v1/ai-cache')
+def api_ai_cache_stats():
+    from src.ai_service import get_response_cache
+    cache = get_response_cache()
+    if cache is None:
+        return jsonify({'status': 'error', 'code': Codes.INVALID_ARGS, 'message': 'AI响应缓存未启用'}), 400
+    return jsonify({'status': 'success', 'code': Codes.SUCCESS, 'data': cache.stats()})
+
+def parse_subscription(data):
+    """
+    解析订阅参数 {job_ids: [...], file_ids: [...], channel: 'queue'}（也接受单个 job_id / file_id）
+
+    Returns:
+        tuple: (房间列表, 错误信息)
+    """
+    if not isinstance(data, dict):
+        return None, '订阅参数需为对象'
+    job_ids = data.get('job_ids') or []
+    file_ids = data.get('file_ids') or []
+    if data.get('job_id') is not None:
+        job_ids = [*job_ids, data['job_id']]
+    if data.get('file_id'):
+        file_ids = [*file_ids, data['file_id']]
+    if not isinstance(job_ids, list) or not isinstance(file_ids, list):
+        return None, 'job_ids/file_ids 需为数组'
+    rooms = []
+    for job_id in job_ids:
+        try:
+            rooms.append(f'job:{int(job_id)}')
+        except (TypeError, ValueError):
+            return None, f'任务 ID 无效: {job_id}'
+    for file_id in file_ids:
+        if not isinstance(file_id, str) or not file_id or ':' in file_id:
+            return None, f'文件 ID 无效: {file_id}'
+        rooms.append(f'file:{file_id}')
+    channel = data.get('channel')
+    if channel not in (None, QUEUE_ROOM):
+        return None, f'未知的频道: {channel}'
+    if channel:
+        rooms.append(QUEUE_ROOM)
+    if len(rooms) > MAX_SUBSCRIBE_ROOMS:
+        return None, f'单次最多订阅 {MAX_SUBSCRIBE_ROOMS} 个房间'
+    return rooms, None
+
+
+@socketio.on('subscribe')
+def on_subscribe(data):
+    rooms, error = parse_subscription(data)
+    if error:
+        return {'status': 'error', 'code': Codes.INVALID_ARGS, 'message': error}
+    for room in rooms:
+        join_room(room)
+    if QUEUE_ROOM in rooms:
+        # 新订阅者立即收到一次当前状态
+        socketio.emit('queue_status', queue_status_snapshot(), to=request.sid)
+    return {'status': 'success', 'code': Codes.SUCCESS, 'rooms': rooms}
+
+
+@socketio.on('unsubscribe')
+def on_unsubscribe(data):
+    rooms, error = parse_subscription(data)
+    if error:
+        return {'status': 'error', 'code': Codes.INVALID_ARGS, 'message': error}
+    for room in rooms:
+        leave_room(room)
+    return {'status': 'success', 'code': Codes.SUCCESS, 'rooms': rooms}
 
 # Prompt管理相关路由
 @app.route('/list_prompts')
@@ -892,6 +1453,11 @@ if __name__ == '__main__':
     # app.logger.addHandler(log_handler)
     app.logger.setLevel(getattr(logging, config.LOG_LEVEL.upper(), logging.INFO))
 
+    # debug 模式下 reloader 的父进程只负责重启，不领取任务
+    if os.getenv('FLASK_ENV') == 'production' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        init_records()
+        recover_task_queue()
+
     # 根据环境变量判断运行模式
     if os.getenv('FLASK_ENV') == 'production':
         secret = os.getenv('SECRET_KEY')
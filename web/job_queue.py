@@ -0,0 +1,242 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+
+JOB_STATES = ('queued', 'running', 'done', 'failed')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    file_ref TEXT NOT NULL,
+    steps TEXT NOT NULL,
+    model_type TEXT,
+    model_size TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    worker TEXT,
+    heartbeat REAL,
+    lease_expires REAL,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs(state, priority DESC, id);
+CREATE INDEX IF NOT EXISTS idx_jobs_file ON jobs(file_ref, state);
+"""
+
+
+def worker_id():
+    """当前线程的 worker 标识：主机名:进程号:线程号"""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+def _row_to_dict(row):
+    return dict(row) if row is not None else None
+
+
+class JobQueue:
+    """
+    持久化在 SQLite 中的任务队列
+
+    任务按 priority 从高到低、同优先级按提交顺序领取；领取在一个写事务内完成，
+    多个线程或多个 web 进程共用同一个数据库也不会重复领取。同一文件同时只会有一个任务在执行。
+    执行中的任务持有租约，由 heartbeat() 定期续期；进程崩溃后租约过期的任务会被重新排队，
+    超过 max_attempts 次仍未完成的任务标记为失败。
+    """
+
+    def __init__(self, path, lease_seconds=120, max_attempts=3):
+        self.path = path
+        self.lease_seconds = float(lease_seconds)
+        self.max_attempts = max(1, int(max_attempts))
+        self._lock = threading.Lock()
+        self._conn = None
+        self._wakeup = threading.Condition()
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def enqueue(self, file_ref, steps, model_type=None, model_size=None, priority=0):
+        """提交任务，返回任务 ID"""
+        with self._lock:
+            cur = self._connect().execute(
+                'INSERT INTO jobs (file_ref, steps, model_type, model_size, priority, max_attempts, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (file_ref, steps, model_type, model_size, int(priority), self.max_attempts, time.time()),
+            )
+            job_id = cur.lastrowid
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def _expire_leases(self, conn, now):
+        """租约过期的任务重新排队，已达到最大尝试次数的标记为失败，需在写事务内调用"""
+        conn.execute(
+            "UPDATE jobs SET state = 'failed', finished = ?, worker = NULL, "
+            "error = COALESCE(error, '执行进程异常退出，已达到最大尝试次数') "
+            "WHERE state = 'running' AND lease_expires < ? AND attempts >= max_attempts",
+            (now, now),
+        )
+        conn.execute(
+            "UPDATE jobs SET state = 'queued', worker = NULL, lease_expires = NULL "
+            "WHERE state = 'running' AND lease_expires < ?",
+            (now,),
+        )
+
+    def claim(self, worker):
+        """
+        领取下一个可执行的任务，没有时返回 None
+
+        跳过已有任务在执行的文件，保证同一文件的任务串行。
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._expire_leases(conn, now)
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE state = 'queued' AND file_ref NOT IN "
+                    "(SELECT file_ref FROM jobs WHERE state = 'running') "
+                    "ORDER BY priority DESC, id LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE jobs SET state = 'running', attempts = attempts + 1, worker = ?, "
+                        "heartbeat = ?, lease_expires = ?, started = ?, error = NULL WHERE id = ?",
+                        (worker, now, now + self.lease_seconds, now, row['id']),
+                    )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        job = _row_to_dict(row)
+        job['attempts'] += 1
+        return job
+
+    def wait_for_job(self, timeout):
+        """等待本进程有新任务提交或超时（其他进程提交的任务依靠超时后轮询发现）"""
+        with self._wakeup:
+            self._wakeup.wait(timeout)
+
+    def heartbeat(self, job_id, worker):
+        """续期租约，任务已不属于该 worker 时返回 False"""
+        now = time.time()
+        with self._lock:
+            cur = self._connect().execute(
+                "UPDATE jobs SET heartbeat = ?, lease_expires = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                (now, now + self.lease_seconds, job_id, worker),
+            )
+            return cur.rowcount > 0
+
+    def finish(self, job_id, worker, ok, error=None):
+        with self._lock:
+            self._connect().execute(
+                "UPDATE jobs SET state = ?, error = ?, finished = ?, worker = NULL, lease_expires = NULL "
+                "WHERE id = ? AND worker = ?",
+                ('done' if ok else 'failed', error, time.time(), job_id, worker),
+            )
+        with self._wakeup:
+            # 同一文件的后续任务现在可以领取了
+            self._wakeup.notify_all()
+
+    def recover(self):
+        """
+        启动时调用（须在本进程的任务线程启动前）：本机已退出进程遗留的执行中任务立即重新排队（计入尝试次数），
+        其他主机的任务等租约过期后由 claim() 处理。
+
+        容器重启后新进程可能拿到与旧进程相同的 PID（如 PID 1），因此记录在本进程 PID 下的任务也视为遗留任务。
+
+        Returns:
+            int: 重新排队的任务数
+        """
+        host = socket.gethostname()
+        pid = os.getpid()
+        now = time.time()
+        requeued = 0
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute("SELECT id, worker, attempts, max_attempts FROM jobs WHERE state = 'running'").fetchall()
+                for row in rows:
+                    parts = (row['worker'] or '').split(':')
+                    if len(parts) != 3 or parts[0] != host or not parts[1].isdigit():
+                        continue
+                    owner = int(parts[1])
+                    if owner != pid and _pid_alive(owner):
+                        continue
+                    if row['attempts'] >= row['max_attempts']:
+                        conn.execute(
+                            "UPDATE jobs SET state = 'failed', finished = ?, worker = NULL, lease_expires = NULL, "
+                            "error = '执行进程异常退出，已达到最大尝试次数' WHERE id = ?",
+                            (now, row['id']),
+                        )
+                        continue
+                    conn.execute(
+                        "UPDATE jobs SET state = 'queued', worker = NULL, lease_expires = NULL WHERE id = ?",
+                        (row['id'],),
+                    )
+                    requeued += 1
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return requeued
+
+    def prune(self, retention_seconds):
+        """删除结束超过 retention_seconds 的任务记录"""
+        if retention_seconds <= 0:
+            return 0
+        with self._lock:
+            cur = self._connect().execute(
+                "DELETE FROM jobs WHERE state IN ('done', 'failed') AND finished < ?",
+                (time.time() - retention_seconds,),
+            )
+            return cur.rowcount
+
+    def pending_count(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+
+    def list_jobs(self, states=('queued', 'running'), limit=100):
+        placeholders = ', '.join('?' for _ in states)
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT * FROM jobs WHERE state IN ({placeholders}) "
+                "ORDER BY CASE state WHEN 'running' THEN 0 ELSE 1 END, priority DESC, id LIMIT ?",
+                (*states, int(limit)),
+            ).fetchall()
+        return [_row_to_dict(r) for r in rows]
+
+    def stats(self):
+        with self._lock:
+            rows = self._connect().execute('SELECT state, COUNT(*) AS n FROM jobs GROUP BY state').fetchall()
+        counts = dict.fromkeys(JOB_STATES, 0)
+        counts.update({r['state']: r['n'] for r in rows})
+        return counts
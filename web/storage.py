@@ -1,11 +1,48 @@
 import json
 import os
+import sqlite3
+import threading
 import time
 import uuid
 
 
 RECORDS_VERSION = 2
 
+RECORD_FIELDS = (
+    "id", "file_name", "stored_name", "output_folder", "transcribed", "fixed", "summarized",
+    "last_transcription_time", "last_fix_time", "last_summary_time", "created_time",
+)
+BOOL_FIELDS = ("transcribed", "fixed", "summarized")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    stored_name TEXT,
+    output_folder TEXT,
+    transcribed INTEGER NOT NULL DEFAULT 0,
+    fixed INTEGER NOT NULL DEFAULT 0,
+    summarized INTEGER NOT NULL DEFAULT 0,
+    last_transcription_time TEXT,
+    last_fix_time TEXT,
+    last_summary_time TEXT,
+    created_time TEXT,
+    revision INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_records_file_name ON records(file_name);
+CREATE INDEX IF NOT EXISTS idx_records_stored_name ON records(stored_name);
+CREATE INDEX IF NOT EXISTS idx_records_created ON records(created_time DESC);
+CREATE TABLE IF NOT EXISTS tombstones (
+    id TEXT PRIMARY KEY,
+    revision INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', 0);
+"""
+
 
 def generate_file_id():
     return uuid.uuid4().hex
@@ -32,12 +69,6 @@ def load_records(path):
     return {"version": RECORDS_VERSION, "records": []}
 
 
-def save_records(path, data):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
-
-
 def normalize_record(record, allowed_exts):
     if not isinstance(record, dict):
         return None
@@ -59,25 +90,11 @@ def normalize_record(record, allowed_exts):
         "last_fix_time": record.get("last_fix_time"),
         "last_summary_time": record.get("last_summary_time"),
         "created_time": record.get("created_time"),
+        "revision": record.get("revision", 0),
         "raw": record,
     }
 
 
-def find_record(data, file_id=None, filename=None):
-    if not isinstance(data, dict):
-        return None
-    items = data.get("records", [])
-    if file_id:
-        for record in items:
-            if isinstance(record, dict) and record.get("id") == file_id:
-                return record
-    if filename:
-        for record in items:
-            if isinstance(record, dict) and record.get("file_name") == filename:
-                return record
-    return None
-
-
 def migrate_records(data, upload_dir, output_dir, allowed_exts):
     changed = False
     if not isinstance(data, dict):
@@ -169,46 +186,255 @@ def migrate_records(data, upload_dir, output_dir, allowed_exts):
     return data, changed
 
 
-def upsert_record(data, file_name, file_id=None, stored_name=None, output_folder=None,
-                  transcribed=None, fixed=None, summarized=None,
-                  last_time=None, last_fix_time=None, last_summary_time=None,
-                  created_time=None):
-    record = find_record(data, file_id=file_id, filename=file_name)
-    if record is None:
-        record = {
-            "file_name": file_name,
-            "transcribed": False,
-            "last_transcription_time": None,
-            "created_time": created_time or time.strftime("%Y-%m-%d %H:%M:%S"),
-        }
-        data["records"].append(record)
-    if file_id:
-        record["id"] = file_id
-    if stored_name:
-        record["stored_name"] = stored_name
-    if output_folder:
-        record["output_folder"] = output_folder
-    if created_time and not record.get("created_time"):
-        record["created_time"] = created_time
-    if transcribed is not None:
-        record["transcribed"] = transcribed
-    if fixed is not None:
-        record["fixed"] = fixed
-    if summarized is not None:
-        record["summarized"] = summarized
-    if last_time is not None:
-        record["last_transcription_time"] = last_time
-    if last_fix_time is not None:
-        record["last_fix_time"] = last_fix_time
-    if last_summary_time is not None:
-        record["last_summary_time"] = last_summary_time
+def _row_to_record(row):
+    if row is None:
+        return None
+    record = dict(row)
+    for field in BOOL_FIELDS:
+        record[field] = bool(record[field])
     return record
 
 
-def sync_with_upload(data, upload_dir, allowed_exts):
-    changed = False
+class RecordStore:
+    """
+    保存在 SQLite 中的转写记录
+
+    按 id、file_name、stored_name 建有索引，查询与更新都只涉及单条记录；
+    使用 WAL 模式，每个线程各自持有连接，读不会被写阻塞。返回的记录与原 JSON 记录的字段一致。
+
+    每次写入递增全局修订号，被修改的记录记下该修订号，被删除的记录在 tombstones 中留下修订号，
+    用于增量返回某个修订号之后的变化。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            with self._init_lock:
+                if not self._initialized:
+                    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                conn = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+                conn.row_factory = sqlite3.Row
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                if not self._initialized:
+                    conn.executescript(SCHEMA)
+                    columns = {r["name"] for r in conn.execute("PRAGMA table_info(records)")}
+                    if "revision" not in columns:
+                        conn.execute("ALTER TABLE records ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+                    conn.execute("CREATE INDEX IF NOT EXISTS idx_records_revision ON records(revision)")
+                    self._initialized = True
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _next_revision(conn):
+        """递增并返回全局修订号，需在写事务内调用"""
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'revision'")
+        return conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+
+    def revision(self):
+        return self._connect().execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+
+    def tombstones(self):
+        """已删除记录的 {id: 删除时的修订号}"""
+        return {r["id"]: r["revision"] for r in self._connect().execute("SELECT id, revision FROM tombstones")}
+
+    def _find(self, conn, file_id=None, filename=None):
+        row = None
+        if file_id:
+            row = conn.execute("SELECT * FROM records WHERE id = ?", (file_id,)).fetchone()
+        if row is None and filename:
+            row = conn.execute(
+                "SELECT * FROM records WHERE file_name = ? ORDER BY created_time LIMIT 1", (filename,)
+            ).fetchone()
+        return row
+
+    def get(self, file_id=None, filename=None):
+        """按 id 查找，找不到时按文件名查找"""
+        return _row_to_record(self._find(self._connect(), file_id=file_id, filename=filename))
+
+    def all(self):
+        """全部记录，按创建时间倒序"""
+        rows = self._connect().execute("SELECT * FROM records ORDER BY created_time DESC").fetchall()
+        return [_row_to_record(r) for r in rows]
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def known_names(self):
+        """已登记的 (id 集合, stored_name 集合)，用于与上传目录对账"""
+        rows = self._connect().execute("SELECT id, stored_name FROM records").fetchall()
+        return {r["id"] for r in rows}, {r["stored_name"] for r in rows if r["stored_name"]}
+
+    def upsert(self, file_name, file_id=None, stored_name=None, output_folder=None,
+               transcribed=None, fixed=None, summarized=None,
+               last_time=None, last_fix_time=None, last_summary_time=None,
+               created_time=None, create_if_missing=True):
+        """
+        更新单条记录，只写入非 None 的字段；不存在时按 create_if_missing 决定是否新建
+
+        Returns:
+            dict: 更新后的记录，未找到且不新建时为 None
+        """
+        values = {
+            "stored_name": stored_name or None,
+            "output_folder": output_folder or None,
+            "transcribed": transcribed,
+            "fixed": fixed,
+            "summarized": summarized,
+            "last_transcription_time": last_time,
+            "last_fix_time": last_fix_time,
+            "last_summary_time": last_summary_time,
+        }
+        values = {k: v for k, v in values.items() if v is not None}
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._find(conn, file_id=file_id, filename=file_name)
+            if row is None and not create_if_missing:
+                conn.execute("ROLLBACK")
+                return None
+            values["revision"] = self._next_revision(conn)
+            if row is None:
+                record_id = file_id or generate_file_id()
+                record = {
+                    "id": record_id,
+                    "file_name": file_name,
+                    "transcribed": False,
+                    "fixed": False,
+                    "summarized": False,
+                    "created_time": created_time or time.strftime("%Y-%m-%d %H:%M:%S"),
+                }
+                record.update(values)
+                columns = ", ".join(record)
+                placeholders = ", ".join("?" for _ in record)
+                conn.execute(f"INSERT INTO records ({columns}) VALUES ({placeholders})", tuple(record.values()))
+            else:
+                record_id = row["id"]
+                if file_id and file_id != record_id:
+                    values["id"] = file_id
+                    conn.execute("INSERT OR REPLACE INTO tombstones (id, revision) VALUES (?, ?)",
+                                 (record_id, values["revision"]))
+                if created_time and not row["created_time"]:
+                    values["created_time"] = created_time
+                assignments = ", ".join(f"{k} = ?" for k in values)
+                conn.execute(f"UPDATE records SET {assignments} WHERE id = ?", (*values.values(), record_id))
+                record_id = values.get("id", record_id)
+            conn.execute("DELETE FROM tombstones WHERE id = ?", (record_id,))
+            result = conn.execute("SELECT * FROM records WHERE id = ?", (record_id,)).fetchone()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return _row_to_record(result)
+
+    def delete(self, file_id=None, filename=None):
+        """
+        删除 id 或文件名匹配的记录
+
+        Returns:
+            tuple: (被删除的 id 列表, 本次的修订号)，没有匹配的记录时修订号为 None
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            ids = [r["id"] for r in conn.execute(
+                "SELECT id FROM records WHERE id = ? OR file_name = ?", (file_id or "", filename or ""))]
+            revision = None
+            if ids:
+                revision = self._next_revision(conn)
+                placeholders = ", ".join("?" for _ in ids)
+                conn.execute(f"DELETE FROM records WHERE id IN ({placeholders})", ids)
+                conn.executemany("INSERT OR REPLACE INTO tombstones (id, revision) VALUES (?, ?)",
+                                 [(record_id, revision) for record_id in ids])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return ids, revision
+
+    def touch(self, ids):
+        """
+        不改动内容、只为记录分配新的修订号（例如源文件被移除或恢复），返回新的修订号
+        """
+        ids = list(ids)
+        if not ids:
+            return None
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            revision = self._next_revision(conn)
+            placeholders = ", ".join("?" for _ in ids)
+            conn.execute(f"UPDATE records SET revision = ? WHERE id IN ({placeholders})", (revision, *ids))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return revision
+
+    def import_json(self, json_path, upload_dir, output_dir, allowed_exts):
+        """
+        从旧版 transcription_records.json 一次性导入，导入前先执行 migrate_records
+
+        只在数据库为空时导入，完成后 JSON 文件改名为 *.imported，之后不再读取。
+
+        Returns:
+            int: 导入的记录数
+        """
+        if not os.path.exists(json_path) or self.count():
+            return 0
+        data, _ = migrate_records(load_records(json_path), upload_dir, output_dir, allowed_exts)
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            revision = self._next_revision(conn)
+            for record in data["records"]:
+                row = tuple(
+                    bool(record.get(f)) if f in BOOL_FIELDS else record.get(f)
+                    for f in RECORD_FIELDS
+                )
+                conn.execute(
+                    f"INSERT OR IGNORE INTO records ({', '.join(RECORD_FIELDS)}, revision) "
+                    f"VALUES ({', '.join('?' for _ in RECORD_FIELDS)}, ?)",
+                    (*row, revision),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        os.replace(json_path, f"{json_path}.imported")
+        return len(data["records"])
+
+
+def _parse_stored_name(file):
+    """拆分 <32位id>__<文件名> 形式的存储文件名，不是该形式时返回 (None, file)"""
+    if "__" in file:
+        prefix, rest = file.split("__", 1)
+        if len(prefix) == 32 and all(c in "0123456789abcdef" for c in prefix.lower()):
+            return prefix, rest or file
+    return None, file
+
+
+def sync_with_upload(store, upload_dir, allowed_exts):
+    """
+    为上传目录中没有记录的文件补建记录
+
+    store 需提供 known_names() 与 upsert()，RecordStore 与 RecordIndex 均可。
+
+    Returns:
+        tuple: (新建的记录数, 上传目录中现有的存储文件名集合)
+    """
     if not upload_dir or not os.path.exists(upload_dir):
-        return data, changed
+        return 0, set()
+    known_ids, known_stored = store.known_names()
+    added = 0
+    present = set()
     for file in os.listdir(upload_dir):
         if not isinstance(file, str):
             continue
@@ -216,16 +442,13 @@ def sync_with_upload(data, upload_dir, allowed_exts):
             continue
         if file.endswith("_转写.txt"):
             continue
-        record = find_record(data, file_id=file, filename=file)
-        if record:
+        if file in known_stored:
+            present.add(file)
+            continue
+        file_id, display_name = _parse_stored_name(file)
+        if file_id in known_ids:
+            present.add(file)
             continue
-        file_id = None
-        display_name = file
-        if "__" in file:
-            prefix, rest = file.split("__", 1)
-            if len(prefix) == 32 and all(c in "0123456789abcdef" for c in prefix.lower()):
-                file_id = prefix
-                display_name = rest or file
         if not file_id:
             file_id = generate_file_id()
             desired_name = f"{file_id}__{display_name}"
@@ -237,27 +460,231 @@ def sync_with_upload(data, upload_dir, allowed_exts):
                     file = desired_name
                 except Exception:
                     pass
-        upsert_record(
-            data,
+        store.upsert(
             file_name=display_name,
             file_id=file_id,
             stored_name=file,
             output_folder=file_id,
             created_time=time.strftime("%Y-%m-%d %H:%M:%S"),
         )
-        changed = True
-    return data, changed
+        present.add(file)
+        added += 1
+    return added, present
 
 
-def list_records(data, upload_dir, allowed_exts):
+def list_records(records, upload_dir, allowed_exts, present=None):
+    """
+    规范化记录并过滤掉源文件已不存在的记录，按创建时间倒序
+
+    传入 present（上传目录中的文件名集合）时按集合判断，不再逐个访问文件系统。
+    """
     items = []
-    for record in data.get("records", []):
+    for record in records:
         norm = normalize_record(record, allowed_exts)
         if not norm:
             continue
         stored_name = norm["stored_name"]
-        if upload_dir and not os.path.exists(os.path.join(upload_dir, stored_name)):
+        if present is not None:
+            if stored_name not in present:
+                continue
+        elif upload_dir and not os.path.exists(os.path.join(upload_dir, stored_name)):
             continue
         items.append(norm)
     items.sort(key=lambda x: x.get("created_time") or "", reverse=True)
     return items
+
+
+class RecordIndex:
+    """
+    转写记录的内存索引，写操作先写入 RecordStore 再更新索引（write-through）
+
+    请求只读内存，不访问数据库和文件系统；上传目录的对账由 sync() 完成，
+    目录修改时间未变化时直接跳过，由后台线程定期调用。
+    version() 为当前修订号，列表内容有任何变化（包括源文件被移除）都会使其增加。
+    """
+
+    def __init__(self, store, upload_dir, allowed_exts):
+        self.store = store
+        self.upload_dir = upload_dir
+        self.allowed_exts = allowed_exts
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self._by_id = {}
+        self._by_name = {}
+        self._present = None
+        self._upload_mtime = None
+        self._items = None
+        self._revision = 0
+        self._tombstones = {}
+        self._stats = {
+            "load_ms": 0.0, "reads": 0, "writes": 0,
+            "sync_runs": 0, "sync_skipped": 0, "sync_added": 0,
+            "sync_total_ms": 0.0, "sync_last_ms": 0.0, "sync_max_ms": 0.0, "last_sync": None,
+        }
+
+    def load(self):
+        """从数据库加载全部记录，返回记录数"""
+        start = time.perf_counter()
+        records = self.store.all()
+        tombstones = self.store.tombstones()
+        revision = self.store.revision()
+        with self._lock:
+            self._by_id = {}
+            self._by_name = {}
+            for record in records:
+                self._put(record)
+            self._tombstones = tombstones
+            self._revision = revision
+            self._stats["load_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        return len(records)
+
+    def _drop(self, record_id):
+        record = self._by_id.pop(record_id, None)
+        if record is not None:
+            ids = self._by_name.get(record["file_name"])
+            if ids:
+                ids.discard(record_id)
+                if not ids:
+                    del self._by_name[record["file_name"]]
+
+    def _put(self, record, old_id=None):
+        self._drop(old_id or record["id"])
+        self._drop(record["id"])
+        self._by_id[record["id"]] = record
+        self._by_name.setdefault(record["file_name"], set()).add(record["id"])
+        self._tombstones.pop(record["id"], None)
+        self._revision = max(self._revision, record.get("revision") or 0)
+        if self._present is not None and record.get("stored_name"):
+            # 记录由上传/下载接口写入时文件已经落盘，不必等下一次对账
+            self._present.add(record["stored_name"])
+        self._items = None
+
+    def _find(self, file_id=None, filename=None):
+        if file_id and file_id in self._by_id:
+            return self._by_id[file_id]
+        ids = self._by_name.get(filename) if filename else None
+        if ids:
+            return min((self._by_id[i] for i in ids), key=lambda r: r.get("created_time") or "")
+        return None
+
+    def get(self, file_id=None, filename=None):
+        with self._lock:
+            self._stats["reads"] += 1
+            record = self._find(file_id=file_id, filename=filename)
+            return dict(record) if record else None
+
+    def all(self):
+        with self._lock:
+            self._stats["reads"] += 1
+            return [dict(r) for r in self._by_id.values()]
+
+    def items(self):
+        """规范化后的记录列表（过滤掉源文件不存在的记录，按创建时间倒序），写入前缓存复用"""
+        with self._lock:
+            self._stats["reads"] += 1
+            if self._items is None:
+                self._items = list_records(list(self._by_id.values()), self.upload_dir, self.allowed_exts,
+                                           present=self._present)
+            return list(self._items)
+
+    def version(self):
+        with self._lock:
+            return self._revision
+
+    def changes(self, since):
+        """
+        修订号 since 之后的变化
+
+        Returns:
+            tuple: (当前修订号, 仍在列表中的变化记录（规范化后）, 已删除或源文件已不存在的 id 列表)
+        """
+        with self._lock:
+            self._stats["reads"] += 1
+            changed = [r for r in self._by_id.values() if (r.get("revision") or 0) > since]
+            items = list_records(changed, self.upload_dir, self.allowed_exts, present=self._present)
+            listed = {item["id"] for item in items}
+            removed = {record_id for record_id, rev in self._tombstones.items() if rev > since}
+            removed.update(r["id"] for r in changed if r["id"] not in listed)
+            return self._revision, items, sorted(removed)
+
+    def known_names(self):
+        with self._lock:
+            return set(self._by_id), {r["stored_name"] for r in self._by_id.values() if r.get("stored_name")}
+
+    def upsert(self, file_name, file_id=None, **fields):
+        with self._lock:
+            existing = self._find(file_id=file_id, filename=file_name)
+            record = self.store.upsert(file_name, file_id=file_id, **fields)
+            if record is not None:
+                old_id = existing["id"] if existing else None
+                self._put(record, old_id=old_id)
+                if old_id and old_id != record["id"]:
+                    self._tombstones[old_id] = record["revision"]
+                self._stats["writes"] += 1
+            return dict(record) if record else None
+
+    def delete(self, file_id=None, filename=None):
+        with self._lock:
+            removed, revision = self.store.delete(file_id=file_id, filename=filename)
+            for record_id in removed:
+                self._drop(record_id)
+                self._tombstones[record_id] = revision
+            if removed:
+                self._revision = max(self._revision, revision)
+                self._items = None
+            self._stats["writes"] += 1
+            return len(removed)
+
+    def sync(self, force=False):
+        """
+        与上传目录对账：补建新文件的记录，并更新源文件是否存在
+
+        Returns:
+            int: 新建的记录数；目录未变化而跳过时为 0
+        """
+        with self._sync_lock:
+            try:
+                mtime = os.stat(self.upload_dir).st_mtime_ns
+            except (OSError, TypeError):
+                mtime = None
+            if not force and mtime is not None and mtime == self._upload_mtime:
+                with self._lock:
+                    self._stats["sync_skipped"] += 1
+                return 0
+            start = time.perf_counter()
+            added, present = sync_with_upload(self, self.upload_dir, self.allowed_exts)
+            elapsed = (time.perf_counter() - start) * 1000
+            try:
+                # 补建记录时可能重命名了文件，记录重命名之后的修改时间
+                self._upload_mtime = os.stat(self.upload_dir).st_mtime_ns
+            except (OSError, TypeError):
+                self._upload_mtime = None
+            with self._lock:
+                previous = self._present
+                self._present = present
+                self._items = None
+                if previous is not None:
+                    # 源文件被移除或恢复的记录会出现/消失在列表中，分配新的修订号让增量查询能感知到
+                    flipped = [r["id"] for r in self._by_id.values() if r.get("stored_name")
+                               and (r["stored_name"] in previous) != (r["stored_name"] in present)]
+                    revision = self.store.touch(flipped)
+                    for record_id in flipped:
+                        self._by_id[record_id]["revision"] = revision
+                    if flipped:
+                        self._revision = max(self._revision, revision)
+                self._stats["sync_runs"] += 1
+                self._stats["sync_added"] += added
+                self._stats["sync_total_ms"] += elapsed
+                self._stats["sync_last_ms"] = round(elapsed, 2)
+                self._stats["sync_max_ms"] = round(max(self._stats["sync_max_ms"], elapsed), 2)
+                self._stats["last_sync"] = time.time()
+            return added
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["records"] = len(self._by_id)
+            stats["listed"] = len(self._items) if self._items is not None else None
+        runs = stats["sync_runs"]
+        stats["sync_avg_ms"] = round(stats.pop("sync_total_ms") / runs, 2) if runs else 0.0
+        return stats